@@ -1,6 +1,4 @@
-import json
 import logging
-import re
 
 from google import genai
 from google.genai import types
@@ -8,15 +6,17 @@ from google.genai import types
 from promptbeatai.app.entities.generation_prompt import GenerationPrompt
 from promptbeatai.loopmaker.serialize import song_from_json
 from promptbeatai.loopmaker.core import Song
-from promptbeatai.ai.util import SYSTEM_PROMPT, stringify_generation_prompt
+from promptbeatai.ai.json_extract import extract_json_from_response, song_from_json_seconds
+from promptbeatai.ai.util import get_system_prompt, prompt_token_report, stringify_generation_prompt
 from promptbeatai.ai.song_generator_client import SongGeneratorClient
 
 
-def request_composition_draft(
+def request_composition_drafts(
     client: genai.Client,
-    prompt: GenerationPrompt
-) -> str:
-    combined_prompt = f"{SYSTEM_PROMPT}\n\n{stringify_generation_prompt(prompt)}"
+    prompt: GenerationPrompt,
+    n: int = 1
+) -> list[str]:
+    combined_prompt = f"{get_system_prompt()}\n\n{stringify_generation_prompt(prompt)}"
     resp = client.models.generate_content(
         model="gemini-2.5-flash",
         contents=[
@@ -24,43 +24,62 @@ def request_composition_draft(
                 role="user",
                 parts=[types.Part(text=combined_prompt)]
             ),
-        ]
+        ],
+        # Several candidates of one prompt share its input tokens
+        config=types.GenerateContentConfig(candidate_count=n) if n > 1 else None
     )
-    return resp.text
-
-def extract_json_from_response(response: str) -> dict:
-    patterns = [
-        r'```json\s*(\{.*?\})\s*```',
-        r'```\s*(\{.*?\})\s*```',
-        r'(\{.*?\})',
+    if n == 1:
+        return [resp.text]
+    return [
+        ''.join(part.text or '' for part in candidate.content.parts)
+        for candidate in resp.candidates or []
+        if candidate.content and candidate.content.parts
     ]
 
-    for pattern in patterns:
-        m = re.search(pattern, response, re.DOTALL)
-        if m:
-            try:
-                return json.loads(m.group(1))
-            except json.JSONDecodeError:
-                continue
-
-    logging.error(f"Failed to extract JSON from Gemini response: {response}")
-    raise ValueError(f"No valid JSON block found in Gemini response. Response was: {response[:500]}...")
+def request_composition_draft(
+    client: genai.Client,
+    prompt: GenerationPrompt
+) -> str:
+    return request_composition_drafts(client, prompt)[0]
 
 def request_song_generation(
     client: genai.Client,
     prompt: GenerationPrompt
 ) -> Song:
     logging.info("Sending request to Gemini API")
+    logging.info(f'Estimated prompt tokens: {prompt_token_report(prompt)}')
     draft = request_composition_draft(client, prompt)
     logging.info(f"Gemini raw response: {draft}")
     song_dict = extract_json_from_response(draft)
-    song = song_from_json(song_dict)
+    with song_from_json_seconds.time():
+        song = song_from_json(song_dict)
     logging.info("Song generation successful")
     return song
 
+def request_song_variations(
+    client: genai.Client,
+    prompt: GenerationPrompt,
+    n: int
+) -> list[Song]:
+    logging.info(f"Sending request for {n} variations to Gemini API")
+    logging.info(f'Estimated prompt tokens: {prompt_token_report(prompt)}')
+    songs = []
+    for draft in request_composition_drafts(client, prompt, n):
+        try:
+            song_dict = extract_json_from_response(draft)
+            with song_from_json_seconds.time():
+                songs.append(song_from_json(song_dict))
+        except Exception as e:
+            logging.error(f"Skipping invalid variation: {e}")
+    logging.info(f"Generated {len(songs)}/{n} variations")
+    return songs
+
 class GeminiSongGeneratorClient(SongGeneratorClient):
     def __init__(self, gemini_client: genai.Client):
         self.client = gemini_client
 
     def request_song(self, prompt: GenerationPrompt) -> Song:
         return request_song_generation(self.client, prompt)
+
+    def request_songs(self, prompt: GenerationPrompt, n: int) -> list[Song]:
+        return request_song_variations(self.client, prompt, n)
@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from promptbeatai.ai.song_generator_client import SongGeneratorClient
+from promptbeatai.app.entities.generation_prompt import GenerationPrompt
+from promptbeatai.loopmaker.core import Song
+from promptbeatai.metrics import Counter, Histogram
+
+
+llm_request_seconds = Histogram(
+    'promptbeatai_llm_request_seconds',
+    'Latency of song generation requests per provider, including JSON extraction and parsing',
+    ('provider', 'outcome'),
+)
+llm_hedges_total = Counter(
+    'promptbeatai_llm_hedges_total',
+    'Requests sent to a provider because the previous one was slow or failed',
+    ('provider',),
+)
+llm_wins_total = Counter(
+    'promptbeatai_llm_wins_total',
+    'Requests answered first with a valid song, per provider',
+    ('provider',),
+)
+
+
+def validate_song(song: Song):
+    if not song.loops_in_context:
+        raise ValueError('Provider returned an empty song')
+
+
+class HedgedSongGeneratorClient(SongGeneratorClient):
+    """
+    Sends a request to several providers and returns the first valid Song.
+
+    Providers are tried in order. With hedge_delay_s=None the next provider is
+    only asked when the previous one fails, with a delay the next one is also
+    asked once that much time passed without an answer, and with 0 they all
+    race from the start. Losers are cancelled when they haven't started yet;
+    calls already in flight can't be interrupted, their results are dropped.
+    """
+    def __init__(self, providers: list[tuple[str, SongGeneratorClient]], hedge_delay_s: float | None = None):
+        if not providers:
+            raise ValueError('At least one provider is required')
+        self.providers = providers
+        self.hedge_delay_s = hedge_delay_s
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(providers), thread_name_prefix='song-generator')
+
+    def _request(self, name: str, client: SongGeneratorClient, prompt: GenerationPrompt, finished: threading.Event) -> Song:
+        start = time.perf_counter()
+        try:
+            song = client.request_song(prompt)
+            validate_song(song)
+        except Exception:
+            llm_request_seconds.observe(time.perf_counter() - start, provider=name, outcome='error')
+            raise
+        outcome = 'lost' if finished.is_set() else 'ok'
+        llm_request_seconds.observe(time.perf_counter() - start, provider=name, outcome=outcome)
+        return song
+
+    def request_song(self, prompt: GenerationPrompt) -> Song:
+        if len(self.providers) == 1:
+            name, client = self.providers[0]
+            song = self._request(name, client, prompt, threading.Event())
+            llm_wins_total.inc(provider=name)
+            return song
+
+        finished = threading.Event()
+        remaining = list(self.providers)
+        pending: dict[Future, str] = {}
+        errors: list[str] = []
+
+        def launch(hedge: bool):
+            name, client = remaining.pop(0)
+            if hedge:
+                llm_hedges_total.inc(provider=name)
+            pending[self._executor.submit(self._request, name, client, prompt, finished)] = name
+
+        launch(hedge=False)
+        while remaining and self.hedge_delay_s == 0:
+            launch(hedge=True)
+
+        while pending:
+            timeout = self.hedge_delay_s if remaining else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                logging.info(f'No answer after {self.hedge_delay_s}s, hedging with {remaining[0][0]}')
+                launch(hedge=True)
+                continue
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    song = future.result()
+                except Exception as e:
+                    logging.error(f'Provider {name} failed: {e}')
+                    errors.append(f'{name}: {e}')
+                    if remaining:
+                        launch(hedge=True)
+                    continue
+                finished.set()
+                for loser in pending:
+                    loser.cancel()
+                llm_wins_total.inc(provider=name)
+                return song
+
+        raise RuntimeError(f'All providers failed: {"; ".join(errors)}')
+
+    def request_songs(self, prompt: GenerationPrompt, n: int) -> list[Song]:
+        # Variations are a single, larger request; hedging it would double the spend, so only fall back on failure
+        for name, client in self.providers:
+            start = time.perf_counter()
+            try:
+                songs = [song for song in client.request_songs(prompt, n) if song.loops_in_context]
+            except Exception as e:
+                llm_request_seconds.observe(time.perf_counter() - start, provider=name, outcome='error')
+                logging.error(f'Provider {name} failed to generate variations: {e}')
+                continue
+            llm_request_seconds.observe(time.perf_counter() - start, provider=name, outcome='ok')
+            if songs:
+                llm_wins_total.inc(provider=name)
+                return songs
+        return []
@@ -0,0 +1,194 @@
+import json
+import logging
+from typing import Iterator
+
+from promptbeatai.metrics import Counter, Histogram
+
+
+json_extraction_total = Counter(
+    'promptbeatai_json_extraction_total',
+    'JSON extraction from LLM responses by outcome (direct, repaired, failed)',
+    ('outcome',),
+)
+json_extraction_seconds = Histogram(
+    'promptbeatai_json_extraction_seconds',
+    'Time spent extracting and repairing JSON from LLM responses',
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+song_from_json_seconds = Histogram(
+    'promptbeatai_song_from_json_seconds',
+    'Time spent building a Song from extracted JSON, including loading samples',
+)
+
+
+class JSONExtractionError(ValueError):
+    pass
+
+
+def iter_top_level_objects(text: str) -> Iterator[str]:
+    """
+    Yields every top-level {...} span in a single linear pass.
+
+    Braces inside JSON strings are ignored. Strings are only tracked inside an
+    object, so apostrophes and quotes in the surrounding prose don't matter.
+    An object that is still open at the end of the text (a truncated response)
+    is yielded as well, so it can be repaired.
+    """
+    depth = 0
+    start = -1
+    in_string = False
+    escaped = False
+    for i, c in enumerate(text):
+        if depth == 0:
+            if c == '{':
+                depth = 1
+                start = i
+            continue
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                yield text[start:i + 1]
+    if depth > 0:
+        yield text[start:]
+
+
+def repair_json(text: str) -> str:
+    """
+    Fixes the defects LLMs commonly produce: // and /* */ comments, trailing
+    commas, unterminated strings and missing closing brackets (truncated output).
+    """
+    out = []
+    stack = []
+    in_string = False
+    escaped = False
+    i = 0
+    n = len(text)
+    while i < n:
+        c = text[i]
+        if in_string:
+            out.append(c)
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+            i += 1
+            continue
+        if c == '/' and text.startswith('//', i):
+            newline = text.find('\n', i)
+            i = n if newline == -1 else newline
+            continue
+        if c == '/' and text.startswith('/*', i):
+            end = text.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        if c == '"':
+            in_string = True
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+        elif c in '}]':
+            _drop_trailing_comma(out)
+            if stack:
+                stack.pop()
+        out.append(c)
+        i += 1
+
+    if in_string:
+        if escaped:
+            out.pop()
+        out.append('"')
+    # A truncated response usually ends mid-value; cut back to the last complete one
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] in ',:':
+        if out[-1] == ':':
+            _drop_dangling_key(out)
+        else:
+            out.pop()
+    while stack:
+        _drop_trailing_comma(out)
+        out.append(stack.pop())
+    return ''.join(out)
+
+
+def _drop_trailing_comma(out: list[str]):
+    j = len(out) - 1
+    while j >= 0 and out[j].isspace():
+        j -= 1
+    if j >= 0 and out[j] == ',':
+        del out[j:]
+
+
+def _drop_dangling_key(out: list[str]):
+    # out ends with '"key":', remove the key and the comma before it
+    out.pop()
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == '"':
+        out.pop()
+        while out and not (out[-1] == '"' and (len(out) < 2 or out[-2] != '\\')):
+            out.pop()
+        if out:
+            out.pop()
+    _drop_trailing_comma(out)
+
+
+def _try_load(candidate: str) -> dict | None:
+    try:
+        obj = json.loads(candidate)
+    except json.JSONDecodeError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def _try_repair(candidate: str, max_cutbacks: int = 3) -> dict | None:
+    obj = _try_load(repair_json(candidate))
+    # Output truncated mid-value (e.g. '"steps": 1.' or '"no'): drop the incomplete member
+    end = len(candidate)
+    for _ in range(max_cutbacks):
+        if obj is not None:
+            break
+        end = candidate.rfind(',', 0, end)
+        if end == -1:
+            break
+        obj = _try_load(repair_json(candidate[:end]))
+    return obj
+
+
+def extract_json_from_response(response: str) -> dict:
+    """
+    Returns the largest valid top-level JSON object in an LLM response,
+    repairing common defects if no candidate parses as is.
+
+    Raises JSONExtractionError when nothing can be recovered, which is the only
+    case where the caller should re-prompt the model.
+    """
+    with json_extraction_seconds.time():
+        candidates = sorted(iter_top_level_objects(response), key=len, reverse=True)
+        for candidate in candidates:
+            obj = _try_load(candidate)
+            if obj is not None:
+                json_extraction_total.inc(outcome='direct')
+                return obj
+        for candidate in candidates:
+            obj = _try_repair(candidate)
+            if obj is not None:
+                logging.info('Recovered JSON from LLM response after repair')
+                json_extraction_total.inc(outcome='repaired')
+                return obj
+
+    json_extraction_total.inc(outcome='failed')
+    logging.error(f'Failed to extract JSON from response: {response}')
+    raise JSONExtractionError(f'No valid JSON object found in response. Response was: {response[:500]}...')
@@ -0,0 +1,138 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from pathlib import Path
+
+from promptbeatai.ai.json_extract import extract_json_from_response, song_from_json_seconds
+from promptbeatai.ai.song_generator_client import SongGeneratorClient
+from promptbeatai.app.entities.generation_prompt import GenerationPrompt
+from promptbeatai.loopmaker.core import Song
+from promptbeatai.loopmaker.serialize import song_from_json
+
+
+# Directory of *.json songs or a JSONL file, the built-in synth-only corpus when unset
+MOCK_CORPUS = os.getenv('MOCK_CORPUS', None)
+# Latency is log-normal: median seconds and the sigma of its logarithm
+MOCK_LATENCY_MEDIAN_S = float(os.getenv('MOCK_LATENCY_MEDIAN_S', 2.0))
+MOCK_LATENCY_SIGMA = float(os.getenv('MOCK_LATENCY_SIGMA', 0.5))
+# Probability of an API error, and of a response whose JSON is cut off mid-way
+MOCK_FAILURE_RATE = float(os.getenv('MOCK_FAILURE_RATE', 0.0))
+MOCK_TRUNCATION_RATE = float(os.getenv('MOCK_TRUNCATION_RATE', 0.0))
+
+
+class MockProviderError(RuntimeError):
+    pass
+
+
+def _synth_track(waveform: str, notes: list[tuple[int, str, float]], gain: float) -> dict:
+    return {
+        'gen': {
+            'type': 'synth',
+            'waveform': waveform,
+            'ahdsr_envelope': {'attack_ms': 10, 'hold_ms': 20, 'decay_ms': 120, 'sustain_level': 0.6, 'release_ms': 150},
+            'amplitude': 0.5,
+            'sample_rate': 44100,
+        },
+        'hits': [{'step': step, 'note': note, 'steps': steps} for step, note, steps in notes],
+        'gain': gain,
+        'mute': False,
+    }
+
+
+def default_corpus() -> list[dict]:
+    """A few synth-only songs, renderable without any sample files."""
+    chords = ['C4', 'A3', 'F3', 'G3']
+    songs = []
+    for bpm, bars, repeats in ((90, 4, 2), (120, 2, 4), (75, 4, 4)):
+        lead = [(i * 2, chords[(i // 8) % 4][0] + '5', 1.0) for i in range(8 * bars)]
+        bass = [(i * 16, chords[i % 4][0] + '2', 12.0) for i in range(bars)]
+        pad = [(i * 16, chords[i % 4], 16.0) for i in range(bars)]
+        loop = {
+            'bars': bars,
+            'gain': -3.0,
+            'mute': False,
+            'tracks': {
+                'lead': _synth_track('square', lead, -12.0),
+                'bass': _synth_track('sawtooth', bass, -8.0),
+                'pad': _synth_track('sine', pad, -10.0),
+            },
+        }
+        songs.append({
+            'bpm': bpm,
+            'beats_per_bar': 4,
+            'steps_per_beat': 4,
+            'loops_in_context': [{'loop': loop, 'start_bar': 0, 'repeat_times': repeats}],
+        })
+    return songs
+
+
+def load_corpus(path: str) -> list[dict]:
+    corpus_path = Path(path)
+    if corpus_path.is_dir():
+        documents = []
+        for song_file in sorted(corpus_path.glob('*.json')):
+            with open(song_file) as f:
+                documents.append(json.load(f))
+    else:
+        with open(corpus_path) as f:
+            documents = [json.loads(line) for line in f if line.strip()]
+    # Accept GET /song/{id} responses as well as bare songs
+    songs = [d.get('result', d) for d in documents]
+    if not songs:
+        raise ValueError(f'Mock corpus {path} is empty')
+    return songs
+
+
+class MockSongGeneratorClient(SongGeneratorClient):
+    """
+    Stands in for an LLM provider in load tests: waits a random, log-normally
+    distributed time, fails at a configured rate, and otherwise answers with a
+    song from the corpus. The answer goes through the same JSON extraction and
+    parsing as a real response, so that work shows up under load too.
+    """
+    def __init__(
+        self,
+        corpus: list[dict] | None = None,
+        latency_median_s: float = MOCK_LATENCY_MEDIAN_S,
+        latency_sigma: float = MOCK_LATENCY_SIGMA,
+        failure_rate: float = MOCK_FAILURE_RATE,
+        truncation_rate: float = MOCK_TRUNCATION_RATE,
+        seed: int | None = None,
+    ):
+        self.corpus = corpus or default_corpus()
+        self.latency_median_s = latency_median_s
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.truncation_rate = truncation_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _draw(self) -> tuple[float, float, float, dict]:
+        with self._lock:
+            latency = self.latency_median_s * self._rng.lognormvariate(0.0, self.latency_sigma) if self.latency_median_s > 0 else 0.0
+            return latency, self._rng.random(), self._rng.random(), self._rng.choice(self.corpus)
+
+    def request_song(self, prompt: GenerationPrompt) -> Song:
+        latency, failure_roll, truncation_roll, song_json = self._draw()
+        time.sleep(latency)
+        if failure_roll < self.failure_rate:
+            raise MockProviderError(f'Simulated provider failure after {latency:.2f}s')
+
+        response = f'Here is your song:\n```json\n{json.dumps(song_json, indent=2)}\n```'
+        if truncation_roll < self.truncation_rate:
+            response = response[:len(response) * 3 // 4]
+        song_dict = extract_json_from_response(response)
+        with song_from_json_seconds.time():
+            return song_from_json(song_dict)
+
+
+def create_mock_client() -> MockSongGeneratorClient:
+    corpus = load_corpus(MOCK_CORPUS) if MOCK_CORPUS else None
+    logging.info(
+        f'Mock provider: {len(corpus) if corpus else len(default_corpus())} songs, '
+        f'median latency {MOCK_LATENCY_MEDIAN_S}s, failure rate {MOCK_FAILURE_RATE}'
+    )
+    return MockSongGeneratorClient(corpus)
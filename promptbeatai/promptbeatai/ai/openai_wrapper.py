@@ -1,42 +1,43 @@
-import json
 import logging
 import openai
-import re
 from typing import cast
 
 from promptbeatai.app.entities.generation_prompt import GenerationPrompt
 from promptbeatai.loopmaker.serialize import song_from_json, song_to_json
 from promptbeatai.loopmaker.core import Song
-from promptbeatai.ai.util import SYSTEM_PROMPT, stringify_generation_prompt
+from promptbeatai.ai.json_extract import extract_json_from_response, song_from_json_seconds
+from promptbeatai.ai.util import get_system_prompt, prompt_token_report, stringify_generation_prompt
 from promptbeatai.ai.song_generator_client import SongGeneratorClient
 
 
-def request_composition_draft(client: openai.OpenAI, prompt: GenerationPrompt) -> str:
+def request_composition_drafts(client: openai.OpenAI, prompt: GenerationPrompt, n: int = 1) -> list[str]:
+    # n > 1 samples several completions of the same prompt, input tokens are only billed once
     response = client.chat.completions.create(
         model='gpt-4o',
         messages=[
-            {'role': 'system', 'content': SYSTEM_PROMPT},
+            {'role': 'system', 'content': get_system_prompt()},
             {'role': 'user', 'content': stringify_generation_prompt(prompt)}
         ],
         temperature=0.9,
-        max_completion_tokens=16384
+        max_completion_tokens=16384,
+        n=n
     )
-    s = response.choices[0].message.content
-    if isinstance(s, str):
-        return s
-    raise RuntimeError(f'Expected OpenAI API to return str, got {str(s.__class__)} instead')
+    drafts = []
+    for choice in response.choices:
+        s = choice.message.content
+        if not isinstance(s, str):
+            raise RuntimeError(f'Expected OpenAI API to return str, got {str(s.__class__)} instead')
+        drafts.append(s)
+    return drafts
 
 
-def extract_json_from_response(response: str) -> dict:
-    match = re.search(r'```json\s*(\{.*?\})\s*```', response, re.DOTALL)
-    if match:
-        json_str = match.group(1)
-        return json.loads(json_str)
-    raise ValueError('No JSON block found!')
+def request_composition_draft(client: openai.OpenAI, prompt: GenerationPrompt) -> str:
+    return request_composition_drafts(client, prompt)[0]
 
 
 def request_song_generation(client: openai.OpenAI, prompt: GenerationPrompt) -> Song:
     logging.info(f'Sending request to OpenAI API')
+    logging.info(f'Estimated prompt tokens: {prompt_token_report(prompt)}')
     response = request_composition_draft(client, prompt)
     logging.debug(f'Received response {response}')
     song_dict = extract_json_from_response(response)
@@ -48,14 +49,33 @@ def request_song_generation(client: openai.OpenAI, prompt: GenerationPrompt) ->
         # jsonschema.validate(instance=song_dict, schema=schm)
     # except jsonschema.ValidationError:
         # raise jsonschema.ValidationError('OpenAI returned JSON which does not match song schema')
-    song = song_from_json(song_dict)
+    with song_from_json_seconds.time():
+        song = song_from_json(song_dict)
     logging.info(f'Song generation succesful')
     return song
 
 
+def request_song_variations(client: openai.OpenAI, prompt: GenerationPrompt, n: int) -> list[Song]:
+    logging.info(f'Sending request for {n} variations to OpenAI API')
+    logging.info(f'Estimated prompt tokens: {prompt_token_report(prompt)}')
+    songs = []
+    for response in request_composition_drafts(client, prompt, n):
+        try:
+            song_dict = extract_json_from_response(response)
+            with song_from_json_seconds.time():
+                songs.append(song_from_json(song_dict))
+        except Exception as e:
+            logging.error(f'Skipping invalid variation: {e}')
+    logging.info(f'Generated {len(songs)}/{n} variations')
+    return songs
+
+
 class OpenAISongGeneratorClient(SongGeneratorClient):
     def __init__(self, openai_client: openai.OpenAI):
         self.openai_client = openai_client
 
     def request_song(self, prompt: GenerationPrompt):
         return request_song_generation(self.openai_client, prompt)
+
+    def request_songs(self, prompt: GenerationPrompt, n: int) -> list[Song]:
+        return request_song_variations(self.openai_client, prompt, n)
@@ -0,0 +1,126 @@
+import json
+import os
+from collections import Counter, defaultdict
+from typing import Any
+
+
+# Keys that carry no information once the schema has been unrolled
+_SCHEMA_NOISE_KEYS = {'$schema', 'definitions', '$id'}
+# Keys whose values map property names to schemas, those names are kept whatever they are
+_SCHEMA_NAME_KEYS = {'properties', 'patternProperties'}
+
+# Rough average for English text and JSON with the GPT/Gemini tokenizers
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def minify_json(obj: Any) -> str:
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def _strip_schema(obj: Any, names: bool = False) -> Any:
+    if isinstance(obj, dict):
+        if names:
+            return {k: _strip_schema(v) for k, v in obj.items()}
+        return {k: _strip_schema(v, k in _SCHEMA_NAME_KEYS) for k, v in obj.items() if k not in _SCHEMA_NOISE_KEYS}
+    if isinstance(obj, list):
+        return [_strip_schema(i) for i in obj]
+    return obj
+
+
+def minify_schema(schema: dict) -> str:
+    """Minified JSON of an unrolled schema, without the now redundant definitions."""
+    return minify_json(_strip_schema(schema))
+
+
+def compact_file_catalog(files: list[str]) -> str:
+    """
+    Groups files by folder, one line per folder: 'drums/: kick.wav, snare.wav'.
+
+    Files are expected in sorted order, the output is deterministic so the
+    system prompt stays byte-identical across requests.
+    """
+    groups: dict[str, list[str]] = defaultdict(list)
+    for f in files:
+        folder, name = os.path.split(f)
+        groups[folder].append(name)
+    lines = []
+    for folder in sorted(groups):
+        names = ', '.join(groups[folder])
+        # Top-level entries have no folder to group them by
+        lines.append(f'{folder}/: {names}' if folder else names)
+    return '\n'.join(lines)
+
+
+def compact_folder_catalog(folders: list[str]) -> str:
+    """Groups leaf folders by parent: 'piano/: grand, lofi_piano'."""
+    return compact_file_catalog(folders)
+
+
+def _hits_to_str(hits: list[dict]) -> str:
+    return ' '.join(f'{h.get("step")}:{h.get("note", "C5")}:{h.get("steps")}' for h in hits)
+
+
+def summarize_composition(song_json: dict) -> str:
+    """
+    Compact, lossless rendition of a song JSON for use as a reference composition.
+
+    Identical loops are defined once and referenced by id from the arrangement,
+    hits are written as 'step:note:steps' and hit patterns that repeat across
+    tracks are defined once and referenced as '@P<n>'.
+    """
+    loop_ids: dict[str, str] = {}
+    loops: dict[str, dict] = {}
+    arrangement = []
+    for lic in song_json.get('loops_in_context', []):
+        loop = lic.get('loop', {})
+        key = minify_json(loop)
+        if key not in loop_ids:
+            loop_ids[key] = f'L{len(loop_ids)}'
+            loops[loop_ids[key]] = loop
+        arrangement.append({
+            'loop': loop_ids[key],
+            'start_bar': lic.get('start_bar'),
+            'repeat_times': lic.get('repeat_times', 1),
+        })
+
+    pattern_counts = Counter(
+        _hits_to_str(track.get('hits', []))
+        for loop in loops.values()
+        for track in loop.get('tracks', {}).values()
+    )
+    patterns = {}
+    pattern_ids = {}
+    for pattern, count in pattern_counts.items():
+        if count > 1 and pattern:
+            pattern_ids[pattern] = f'P{len(pattern_ids)}'
+            patterns[pattern_ids[pattern]] = pattern
+
+    compact_loops = {}
+    for loop_id, loop in loops.items():
+        tracks = {}
+        for name, track in loop.get('tracks', {}).items():
+            hits = _hits_to_str(track.get('hits', []))
+            tracks[name] = {**track, 'hits': f'@{pattern_ids[hits]}' if hits in pattern_ids else hits}
+        compact_loops[loop_id] = {**loop, 'tracks': tracks}
+
+    summary = {
+        'bpm': song_json.get('bpm'),
+        'beats_per_bar': song_json.get('beats_per_bar', 4),
+        'steps_per_beat': song_json.get('steps_per_beat', 4),
+        'loops': compact_loops,
+        'arrangement': arrangement,
+    }
+    if patterns:
+        summary['patterns'] = patterns
+    return minify_json(summary)
+
+
+COMPOSITION_SUMMARY_LEGEND = (
+    'Loops are defined once under "loops" and placed by id in "arrangement". '
+    'Hits are written as "step:note:steps" separated by spaces, "@P<n>" refers to a pattern in "patterns". '
+    'Answer with the regular Song schema, not this compact form.'
+)
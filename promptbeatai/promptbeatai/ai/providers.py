@@ -0,0 +1,67 @@
+import functools
+import logging
+import os
+
+from promptbeatai.ai.hedged_client import HedgedSongGeneratorClient
+from promptbeatai.ai.song_generator_client import SongGeneratorClient
+
+
+PROVIDER_API_KEYS = {
+    'gemini': 'GEMINI_API_KEY',
+    'openai': 'OPENAI_API_KEY',
+}
+
+
+def configured_providers() -> list[str]:
+    """
+    Providers in the order they are tried, without constructing any client.
+
+    SONG_PROVIDERS (e.g. 'openai,gemini') sets the order explicitly, otherwise
+    every provider with an API key is used, Gemini first. 'mock' serves songs
+    from a local corpus with simulated latency and failures, for load tests.
+    """
+    names = os.getenv('SONG_PROVIDERS', None)
+    if names:
+        return [n.strip().lower() for n in names.split(',') if n.strip()]
+    return [name for name, key in PROVIDER_API_KEYS.items() if os.getenv(key, None)]
+
+
+def configured_provider() -> str | None:
+    """Name of the primary provider."""
+    providers = configured_providers()
+    return providers[0] if providers else None
+
+
+def hedge_delay_s() -> float | None:
+    # Unset: fall back to the next provider only on failure, 0: race all providers
+    delay = os.getenv('HEDGE_DELAY_S', None)
+    return float(delay) if delay not in (None, '') else None
+
+
+def create_song_generator_client(provider: str) -> SongGeneratorClient:
+    # Provider SDKs are imported here so that importing the app stays cheap
+    match provider:
+        case 'gemini':
+            import google.genai
+            from promptbeatai.ai.gemini_wrapper import GeminiSongGeneratorClient
+            return GeminiSongGeneratorClient(google.genai.Client(api_key=os.getenv('GEMINI_API_KEY')))
+        case 'openai':
+            import openai
+            from promptbeatai.ai.openai_wrapper import OpenAISongGeneratorClient
+            return OpenAISongGeneratorClient(openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY')))
+        case 'mock':
+            from promptbeatai.ai.mock_client import create_mock_client
+            return create_mock_client()
+    raise ValueError(f'Unknown song generation provider: {provider}')
+
+
+@functools.cache
+def get_song_generator_client() -> SongGeneratorClient:
+    providers = configured_providers()
+    if not providers:
+        raise RuntimeError('No API key provided for either Gemini or OpenAI')
+    logging.info(f'Initializing song generator clients: {", ".join(providers)}')
+    return HedgedSongGeneratorClient(
+        [(name, create_song_generator_client(name)) for name in providers],
+        hedge_delay_s=hedge_delay_s(),
+    )
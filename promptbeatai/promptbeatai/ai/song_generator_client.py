@@ -1,3 +1,4 @@
+import logging
 from abc import ABC, abstractmethod
 
 from promptbeatai.app.entities.generation_prompt import GenerationPrompt
@@ -17,3 +18,25 @@ class SongGeneratorClient(ABC):
             Song: The generated song.
         """
         raise NotImplementedError("Subclasses must implement this method.")
+
+    def request_songs(self, prompt: GenerationPrompt, n: int) -> list[Song]:
+        """
+        Generate up to n variations of a song based on the given prompt.
+
+        Providers that can sample several completions of one prompt in a single
+        request should override this, the default makes n separate requests.
+
+        Args:
+            prompt (GenerationPrompt): The prompt to generate the songs from.
+            n (int): The number of variations to generate.
+
+        Returns:
+            list[Song]: The variations that were generated successfully, at most n.
+        """
+        songs = []
+        for _ in range(n):
+            try:
+                songs.append(self.request_song(prompt))
+            except Exception as e:
+                logging.error(f'Variation generation failed: {e}')
+        return songs
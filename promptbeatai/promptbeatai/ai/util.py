@@ -1,40 +1,68 @@
+import functools
+import hashlib
 import json
-import jsonref
 import logging
 import os
 from pathlib import Path
 
+from promptbeatai.ai.prompt_builder import (
+    COMPOSITION_SUMMARY_LEGEND,
+    compact_file_catalog,
+    compact_folder_catalog,
+    estimate_tokens,
+    minify_schema,
+    summarize_composition,
+)
 from promptbeatai.app.entities.generation_prompt import GenerationPrompt
 
 
 SAMPLE_FOLDER = os.getenv('SAMPLE_FOLDER', None)
+SONG_SCHEMA_PATH = os.getenv('SONG_SCHEMA_PATH', './schemas/loopmaker/Song.schema.json')
+# Catalog + unrolled schema are persisted here and reused while the fingerprint matches
+PROMPT_CACHE_PATH = os.getenv('PROMPT_CACHE_PATH', './.cache/prompt_artifact.json')
+PROMPT_ARTIFACT_VERSION = 1
 
 
-def list_files_and_folders(folder):
-    if SAMPLE_FOLDER is None:
+def list_files_and_folders(folder) -> tuple[list[str], list[str]]:
+    if folder is None:
         logging.warning('Sample folder not set!')
-        return '', ''
-    folder_path = Path(folder)
+        return [], []
     files = []
     folders = []
 
-    for p in folder_path.rglob('*'):
-        rel_path = str(p.relative_to(folder_path))
-        if p.is_file():
-            files.append(rel_path)
-        elif p.is_dir():
-            # Only add folder if it has no subfolders
-            if not any(child.is_dir() for child in p.iterdir()):
-                folders.append(rel_path)
+    # A single os.walk pass: dirnames already tells us whether a folder is a leaf
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, folder)
+        prefix = '' if rel_dir == '.' else rel_dir + os.sep
+        files.extend(prefix + f for f in sorted(filenames))
+        # Only add folder if it has no subfolders
+        if rel_dir != '.' and not dirnames:
+            folders.append(rel_dir)
 
-    files_str = '\n'.join(files)
-    folders_str = '\n'.join(folders)
-    return files_str, folders_str
+    return files, folders
 
-files, folders = list_files_and_folders(SAMPLE_FOLDER)
+
+def sample_tree_fingerprint(folder, schema_path: str = SONG_SCHEMA_PATH) -> str:
+    """
+    Cheap fingerprint of the sample tree and schema files.
+
+    Directory mtimes change whenever an entry is added, removed or renamed,
+    which is exactly what the catalog depends on, so only directories are stat'ed.
+    """
+    h = hashlib.sha1(f'v{PROMPT_ARTIFACT_VERSION}'.encode())
+    for schema_file in sorted(Path(schema_path).parent.glob('*.schema.json')):
+        h.update(f'{schema_file.name}:{schema_file.stat().st_mtime_ns}\n'.encode())
+    if folder is not None and os.path.isdir(folder):
+        for dirpath, dirnames, _ in os.walk(folder):
+            dirnames.sort()
+            h.update(f'{os.path.relpath(dirpath, folder)}:{os.stat(dirpath).st_mtime_ns}\n'.encode())
+    return h.hexdigest()
 
 
 def unroll_schema(path):
+    import jsonref
+
     with open(path) as f:
         raw = json.load(f)
 
@@ -57,12 +85,65 @@ def to_plain_dict(obj):
         return obj
 
 
-song_schema = unroll_schema('./schemas/loopmaker/Song.schema.json')
+def _load_prompt_artifact(path: str, fingerprint: str) -> dict | None:
+    try:
+        with open(path) as f:
+            artifact = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if artifact.get('fingerprint') != fingerprint:
+        return None
+    return artifact
+
+
+def _store_prompt_artifact(path: str, artifact: dict):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(artifact, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logging.warning(f'Could not persist prompt artifact to {path}: {e}')
+
+
+def build_prompt_artifact(folder=SAMPLE_FOLDER, schema_path: str = SONG_SCHEMA_PATH) -> dict:
+    files, folders = list_files_and_folders(folder)
+    return {
+        'files': files,
+        'folders': folders,
+        'song_schema': to_plain_dict(unroll_schema(schema_path)),
+    }
+
+
+@functools.cache
+def get_prompt_artifact() -> dict:
+    """
+    Sample catalog and unrolled song schema, computed on first use.
+
+    The artifact is persisted to PROMPT_CACHE_PATH and only rebuilt when the
+    sample tree's fingerprint changes.
+    """
+    fingerprint = sample_tree_fingerprint(SAMPLE_FOLDER)
+    artifact = _load_prompt_artifact(PROMPT_CACHE_PATH, fingerprint)
+    if artifact is not None:
+        logging.info('Loaded prompt artifact from cache')
+        return artifact
+
+    logging.info('Building prompt artifact')
+    artifact = build_prompt_artifact()
+    artifact['fingerprint'] = fingerprint
+    _store_prompt_artifact(PROMPT_CACHE_PATH, artifact)
+    return artifact
+
+
+def get_song_schema() -> dict:
+    return get_prompt_artifact()['song_schema']
 
 
 # Suprisingly it works really well with gpt-4o, cost is ~2-3 cents per song
-# FIXME song_schema is passed as str(dict), not json string
-SYSTEM_PROMPT = f'''
+# Everything in here is static for a given sample library, so providers can cache it as a prompt prefix
+SYSTEM_PROMPT_TEMPLATE = '''
 You are a creative music producer that creates structured musical pieces based on a user prompt and parameters like tempo, mood, and intensity. Your output must follow a two-step process:
 
 1. **Sketch**: generate a verbose textual draft of the musical idea — describe its mood, instrumentation, musical scale and harmony, structure (e.g. intro-verse-chorus), and rhythm. Select an appropriate musical scale. Write out melodies and chord progressions here as well. Please use different loops and vary the structure, so the song is actually interesting!
@@ -113,6 +194,9 @@ For example, if you want a four-to-the-floor pattern, you would fill steps 0, 4,
 Here is a list of samples you can use:
 ---
 
+Paths are grouped by folder, one folder per line, like `drums/: kick.wav, snare.wav`.
+The full path is the folder followed by the name, e.g. `drums/kick.wav`. Top-level entries are listed without a folder.
+
 **Filepath**:
 ```
 {files}
@@ -148,17 +232,64 @@ NEVER EVER RETURN JUST AN EMPTY SONG - EVEN A SHORT MELODY IS BETTER THAN NOTHIN
 '''
 
 
+@functools.cache
+def get_system_prompt_sections() -> dict[str, str]:
+    artifact = get_prompt_artifact()
+    return {
+        'song_schema': minify_schema(artifact['song_schema']),
+        'files': compact_file_catalog(artifact['files']),
+        'folders': compact_folder_catalog(artifact['folders']),
+    }
+
+
+@functools.cache
+def get_system_prompt() -> str:
+    return SYSTEM_PROMPT_TEMPLATE.format(**get_system_prompt_sections())
+
+
+def __getattr__(name: str):
+    # Backwards compatible lazy module attributes, nothing is computed at import
+    if name == 'SYSTEM_PROMPT':
+        return get_system_prompt()
+    if name == 'song_schema':
+        return get_song_schema()
+    if name == 'files':
+        return '\n'.join(get_prompt_artifact()['files'])
+    if name == 'folders':
+        return '\n'.join(get_prompt_artifact()['folders'])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 # TODO secure against prompt injection attacks
-def stringify_generation_prompt(prompt: GenerationPrompt) -> str:
+def generation_prompt_sections(prompt: GenerationPrompt) -> dict[str, str]:
     # TODO gpt-4o doesn't support sending in audio files through the API, but it may be possible with assistants
-    s = ''
+    sections = {}
     if prompt.reference_composition:
-        s += '**Use the following composition as your reference**:\n'
-        s += json.dumps(prompt.reference_composition)
-        s += '\n'
+        sections['reference_composition'] = (
+            '**Use the following composition as your reference**:\n'
+            f'{COMPOSITION_SUMMARY_LEGEND}\n'
+            f'{summarize_composition(prompt.reference_composition)}\n'
+        )
     if prompt.other_settings:
-        s += '**Users supplied these parameters**\n'
-        s += '\n'.join(f'{k}: {v}' for k, v in prompt.other_settings.items())
-        s += '\n'
-    s += f"**This is the user's request**:\n{prompt.text_prompt}\n"
-    return s
+        sections['other_settings'] = (
+            '**Users supplied these parameters**\n'
+            + '\n'.join(f'{k}: {v}' for k, v in prompt.other_settings.items())
+            + '\n'
+        )
+    sections['text_prompt'] = f"**This is the user's request**:\n{prompt.text_prompt}\n"
+    return sections
+
+
+def stringify_generation_prompt(prompt: GenerationPrompt) -> str:
+    return ''.join(generation_prompt_sections(prompt).values())
+
+
+def prompt_token_report(prompt: GenerationPrompt) -> dict[str, int]:
+    """Estimated input tokens per prompt section, static system prompt sections first."""
+    system_sections = get_system_prompt_sections()
+    report = {name: estimate_tokens(text) for name, text in system_sections.items()}
+    report['instructions'] = estimate_tokens(get_system_prompt()) - sum(report.values())
+    for name, text in generation_prompt_sections(prompt).items():
+        report[name] = estimate_tokens(text)
+    report['total'] = sum(report.values())
+    return report
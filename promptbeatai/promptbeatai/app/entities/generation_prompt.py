@@ -1,6 +1,6 @@
 from types import NoneType
 from typing import Any, Optional
-from pydantic import BaseModel, ConfigDict, field_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator
 
 from promptbeatai.loopmaker.core import Song
 from promptbeatai.loopmaker.serialize import song_from_json, song_to_json
@@ -9,3 +9,10 @@ class GenerationPrompt(BaseModel):
     text_prompt: str
     other_settings: dict[str, Any]
     reference_composition: Optional[dict[str, Any]] = None
+
+
+MAX_VARIATIONS = 4
+
+
+class BatchGenerationPrompt(GenerationPrompt):
+    n: int = Field(default=3, ge=1, le=MAX_VARIATIONS)
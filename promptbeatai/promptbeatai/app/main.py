@@ -1,4 +1,8 @@
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 import os
 import logging
@@ -6,15 +10,39 @@ from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 
+from .middleware.event_loop_lag import monitor_event_loop_lag
 from .middleware.rate_limiter import limiter
-from .routers.generate_song import router as generate_song_router
+from .render.formats import available_formats, log_encoder_availability
+from .routers.generate_song import router as generate_song_router, warm_pool
+from promptbeatai.loopmaker.blocks import RenderMemoryExceeded
+from promptbeatai.loopmaker.serialize import warm_instruments
+from promptbeatai.metrics import render_prometheus
 
 
 logging.basicConfig(level=logging.INFO)
 
+# Decode every sample under SAMPLE_FOLDER before serving, songs then share the decoded instruments
+SAMPLE_WARMUP = os.getenv('SAMPLE_WARMUP', '0') == '1'
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Probe ffmpeg once, instead of discovering missing encoders on every request
+    log_encoder_availability()
+    if SAMPLE_WARMUP:
+        await asyncio.to_thread(warm_instruments)
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    pool_filler = asyncio.create_task(warm_pool.run()) if warm_pool is not None else None
+    yield
+    lag_monitor.cancel()
+    if pool_filler is not None:
+        pool_filler.cancel()
+
+
 app = FastAPI(
     title='PromptBeatAI API',
     description='Backend API for PromptBeatAI',
+    lifespan=lifespan,
 )
 
 origins_env = os.getenv('ALLOWED_ORIGINS', None)
@@ -44,6 +72,11 @@ app.state.limiter = limiter
 app.add_middleware(SlowAPIMiddleware)
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler) # type: ignore
 
+
+@app.exception_handler(RenderMemoryExceeded)
+async def render_memory_exceeded_handler(request: Request, exc: RenderMemoryExceeded):
+    return JSONResponse(status_code=413, content={'detail': f'Song too large to render: {exc}'})
+
 app.include_router(generate_song_router)
 
 @app.get('/health')
@@ -63,5 +96,14 @@ async def health_check(request: Request):
     return {
         'status': 'healthy',
         'ai_service': ai_service,
+        'audio_formats': available_formats(),
         'version': '1.0.0'
     }
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+@limiter.exempt
+async def metrics(request: Request):
+    """Prometheus metrics: per-stage latency histograms, cache hit/miss counters, queue and store sizes"""
+    # Gauge callbacks may query the job queue database, keep them off the event loop
+    return PlainTextResponse(await run_in_threadpool(render_prometheus), media_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,19 @@
+import os
+import secrets
+
+from fastapi import HTTPException, Request
+
+
+# Admin-only features (profiling) are disabled unless a token is configured
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', None)
+ADMIN_TOKEN_HEADER = 'X-Admin-Token'
+
+
+def is_admin(request: Request) -> bool:
+    token = request.headers.get(ADMIN_TOKEN_HEADER)
+    return bool(ADMIN_TOKEN) and token is not None and secrets.compare_digest(token, ADMIN_TOKEN)
+
+
+def require_admin(request: Request):
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail=f'Admin token required ({ADMIN_TOKEN_HEADER} header)')
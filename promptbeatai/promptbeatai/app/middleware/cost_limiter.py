@@ -0,0 +1,72 @@
+import os
+import threading
+import time
+
+from fastapi import HTTPException, Request
+from slowapi.util import get_remote_address
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_s: float):
+        self.capacity = capacity
+        self.refill_per_s = refill_per_s
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_per_s)
+        self.updated = now
+
+    def seconds_until(self, amount: float) -> float:
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.refill_per_s) if self.refill_per_s > 0 else float('inf')
+
+
+class CostLimiter:
+    """
+    Token buckets charged by estimated render cost instead of by request count,
+    one per client plus a global one that protects the whole box.
+
+    Like slowapi's default storage the buckets live in process memory.
+    """
+    def __init__(self, client_capacity: float, client_refill_per_s: float, global_capacity: float, global_refill_per_s: float):
+        self.client_capacity = client_capacity
+        self.client_refill_per_s = client_refill_per_s
+        self.global_bucket = TokenBucket(global_capacity, global_refill_per_s)
+        self.client_buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def try_charge(self, key: str, cost: float) -> float:
+        """Charges cost to both buckets and returns 0, or returns the seconds to wait without charging anything."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.client_buckets.get(key)
+            if bucket is None:
+                bucket = self.client_buckets[key] = TokenBucket(self.client_capacity, self.client_refill_per_s)
+            buckets = (bucket, self.global_bucket)
+            for b in buckets:
+                b._refill(now)
+            # A single job larger than a bucket is allowed once that bucket is full
+            wait = max(b.seconds_until(cost) for b in buckets)
+            if wait > 0:
+                return wait
+            for b in buckets:
+                b.tokens -= cost
+            return 0.0
+
+    def charge(self, request: Request, cost: float):
+        wait = self.try_charge(get_remote_address(request), cost)
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail=f'Render budget exhausted, retry in {wait:.0f}s',
+                headers={'Retry-After': str(int(wait) + 1)},
+            )
+
+
+cost_limiter = CostLimiter(
+    client_capacity=float(os.getenv('CLIENT_RENDER_COST_CAPACITY', 2000)),
+    client_refill_per_s=float(os.getenv('CLIENT_RENDER_COST_REFILL_PER_S', 1.0)),
+    global_capacity=float(os.getenv('GLOBAL_RENDER_COST_CAPACITY', 10000)),
+    global_refill_per_s=float(os.getenv('GLOBAL_RENDER_COST_REFILL_PER_S', 10.0)),
+)
@@ -0,0 +1,22 @@
+import asyncio
+import os
+import time
+
+from promptbeatai.metrics import Histogram
+
+
+EVENT_LOOP_LAG_INTERVAL_S = float(os.getenv('EVENT_LOOP_LAG_INTERVAL_S', 0.5))
+
+event_loop_lag_seconds = Histogram(
+    'promptbeatai_event_loop_lag_seconds',
+    'How late the event loop woke up a sleeping task, blocking work on the loop shows up here',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+
+async def monitor_event_loop_lag(interval_s: float = EVENT_LOOP_LAG_INTERVAL_S):
+    """Sleeps for interval_s in a loop and records how much longer than that each sleep took."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval_s)
+        event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - start - interval_s))
@@ -1,5 +1,12 @@
+import os
+
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
 
-limiter = Limiter(key_func=get_remote_address, default_limits=["100/hour"])
+# Load tests drive thousands of requests from one address, they turn the limits off or up
+RATE_LIMIT_ENABLED = os.getenv('RATE_LIMIT_ENABLED', '1') == '1'
+DEFAULT_RATE_LIMIT = os.getenv('DEFAULT_RATE_LIMIT', '100/hour')
+GENERATE_RATE_LIMIT = os.getenv('GENERATE_RATE_LIMIT', '10/hour')
+
+limiter = Limiter(key_func=get_remote_address, default_limits=[DEFAULT_RATE_LIMIT], enabled=RATE_LIMIT_ENABLED)
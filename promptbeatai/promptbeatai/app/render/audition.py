@@ -0,0 +1,24 @@
+import dataclasses
+
+from promptbeatai.loopmaker.core import Loop, LoopInContext, Song
+
+
+def audition_song(song: Song, loop_index: int, track: str | None = None) -> Song:
+    """
+    One repetition of the loop in context at loop_index, or of a single track
+    of it, as a song of its own. Muted loops and a muted track are unmuted, an
+    audition should be audible; a solo track isn't choked by the rest of its group.
+    Rendered and cached like any song, under its own fingerprint.
+    Raises IndexError and KeyError for a loop or track the song doesn't have.
+    """
+    source = song.loops_in_context[loop_index].loop
+    loop = Loop(source.bars, source.gain)
+    if track is None:
+        for name, t in source.tracks.items():
+            loop.add_track(name, t)
+    else:
+        loop.add_track(track, dataclasses.replace(source.tracks[track], mute=False))
+    audition = Song(song.bpm, song.beats_per_bar, song.steps_per_beat)
+    audition.loops_in_context.append(LoopInContext(loop, 0, 1))
+    return audition
+
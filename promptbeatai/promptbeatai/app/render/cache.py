@@ -0,0 +1,378 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, cast
+
+from pydub import AudioSegment
+
+from promptbeatai.app.render.formats import AudioVariant, export_variant
+from promptbeatai.app.render.peaks import song_audio_peaks, song_timeline_peaks
+from promptbeatai.app.render.profiling import record_stage
+from promptbeatai.app.render.wav import read_wav, write_wav, write_wav_blocks
+from promptbeatai.loopmaker.blocks import BlockRenderer, StemStore
+from promptbeatai.loopmaker.core import Song, Track, render_observers
+from promptbeatai.loopmaker.serialize import json_fingerprint, song_fingerprint, song_to_json, stems_from_json
+from promptbeatai.metrics import Counter, Histogram
+
+
+# Rendered songs live in <RENDER_CACHE_DIR>/<hash[:2]>/<hash>/, a lossless master plus one file per encoded variant
+RENDER_CACHE_DIR = os.getenv('RENDER_CACHE_DIR', './.cache/renders')
+MASTER_FILENAME = 'master.wav'
+# Tracks of remixes and of the songs they remix are also kept alone in <RENDER_CACHE_DIR>/stems/, so remixes reuse
+# the tracks they didn't change. Other songs render without stems
+STEM_CACHE = os.getenv('STEM_CACHE', '1') == '1'
+# Marks the cache directory of a song whose master renders through the stem cache
+STEMS_MARKER = 'stems'
+# Masters are rendered in blocks of this length straight into the file, so memory doesn't grow with the song
+RENDER_BLOCK_MS = int(os.getenv('RENDER_BLOCK_MS', 10_000))
+# Songs whose render doesn't fit in this are refused instead of rendered. It bounds rendering the master only,
+# encoding and audio peaks load the whole master (its length is capped by MAX_SONG_DURATION_S)
+RENDER_MEMORY_LIMIT_MB = float(os.getenv('RENDER_MEMORY_LIMIT_MB', 512))
+# Once the cache grows past this, the least recently used songs and stems are deleted. 0: unbounded,
+# clean up with tools/prune_render_cache.py instead
+RENDER_CACHE_MAX_MB = float(os.getenv('RENDER_CACHE_MAX_MB', 0))
+# Walking the whole cache is slow, renders check its size at most this often
+RENDER_CACHE_PRUNE_INTERVAL_S = float(os.getenv('RENDER_CACHE_PRUNE_INTERVAL_S', 300))
+# Entries used this recently are never pruned, they may be being served or rendered
+PRUNE_MIN_AGE_S = 60
+
+render_cache_requests_total = Counter(
+    'promptbeatai_render_cache_requests_total',
+    'Render cache lookups by kind (master, variant, peaks, stem) and result (hit, miss)',
+    ('kind', 'result'),
+)
+song_render_seconds = Histogram(
+    'promptbeatai_song_render_seconds',
+    'Time spent rendering a song to its master WAV',
+)
+audio_encode_seconds = Histogram(
+    'promptbeatai_audio_encode_seconds',
+    'Time spent encoding a rendered song, per output format',
+    ('format',),
+)
+loop_render_seconds = Histogram(
+    'promptbeatai_loop_render_seconds',
+    'Time spent rendering one loop in context and mixing it onto the song',
+)
+remix_stems_total = Counter(
+    'promptbeatai_remix_stems_total',
+    'Tracks of remixes by whether they are unchanged from the reference composition or have to be rendered',
+    ('result',),
+)
+render_cache_evictions_total = Counter(
+    'promptbeatai_render_cache_evictions_total',
+    'Least recently used render cache entries deleted by kind (song, stem)',
+    ('kind',),
+)
+track_render_seconds = Histogram(
+    'promptbeatai_track_render_seconds',
+    'Time spent rendering one track of a loop, per generator type',
+    ('generator',),
+)
+
+
+def _observe_render(kind: str, name: str, obj: object, seconds: float):
+    if kind == 'loop':
+        loop_render_seconds.observe(seconds)
+    elif kind == 'track':
+        track_render_seconds.observe(seconds, generator=type(cast(Track, obj).gen).__name__)
+
+
+render_observers.append(_observe_render)
+
+
+_master_locks: dict[str, tuple[threading.Lock, int]] = {}
+_master_locks_guard = threading.Lock()
+
+
+_last_prune = 0.0
+_prune_lock = threading.Lock()
+
+
+def song_cache_dir(fingerprint: str) -> Path:
+    return Path(RENDER_CACHE_DIR) / fingerprint[:2] / fingerprint
+
+
+def atomic_write(path: Path, write: Callable[[str], None]):
+    """Writes through a temporary file, so readers never see a partially written file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        write(str(tmp_path))
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _touch(path: Path):
+    """Marks a cache hit, the cache is pruned by modification time."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def cache_entries() -> list[tuple[float, int, str, Path]]:
+    """(last used, bytes, kind, path) of every song directory and stem in the cache."""
+    entries = []
+    root = Path(RENDER_CACHE_DIR)
+    if not root.is_dir():
+        return entries
+    for shard in root.iterdir():
+        if not shard.is_dir():
+            continue
+        if shard.name == 'stems':
+            candidates = [('stem', p) for stems_shard in shard.iterdir() if stems_shard.is_dir() for p in stems_shard.iterdir()]
+        else:
+            candidates = [('song', p) for p in shard.iterdir()]
+        for kind, entry in candidates:
+            # Temporary files of writes in progress
+            if entry.name.startswith('.'):
+                continue
+            try:
+                files = [entry] if entry.is_file() else [f for f in entry.iterdir() if f.is_file()]
+                stats = [f.stat() for f in files]
+            except OSError:
+                # Deleted or replaced meanwhile
+                continue
+            if stats:
+                entries.append((max(st.st_mtime for st in stats), sum(st.st_size for st in stats), kind, entry))
+    return entries
+
+
+def prune_render_cache(max_bytes: int) -> tuple[int, int]:
+    """
+    Deletes the least recently used songs (master, variants and peaks together)
+    and stems until the cache fits in max_bytes, or only entries used within
+    PRUNE_MIN_AGE_S are left. Returns how many entries and bytes were deleted.
+    """
+    entries = sorted(cache_entries())
+    total = sum(size for _, size, _, _ in entries)
+    deleted = freed = 0
+    for last_used, size, kind, path in entries:
+        if total - freed <= max_bytes or time.time() - last_used < PRUNE_MIN_AGE_S:
+            break
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        render_cache_evictions_total.inc(kind=kind)
+        deleted += 1
+        freed += size
+    if deleted:
+        logging.info(f'Render cache: deleted {deleted} least recently used entries, {freed / 2**20:.0f} MB')
+    return deleted, freed
+
+
+def _maybe_prune():
+    global _last_prune
+    if not RENDER_CACHE_MAX_MB or time.monotonic() - _last_prune < RENDER_CACHE_PRUNE_INTERVAL_S:
+        return
+    # One pruning thread at a time, the others carry on rendering
+    if not _prune_lock.acquire(blocking=False):
+        return
+    try:
+        _last_prune = time.monotonic()
+        prune_render_cache(int(RENDER_CACHE_MAX_MB * 2**20))
+    except OSError as e:
+        logging.warning(f'Render cache: pruning failed: {e}')
+    finally:
+        _prune_lock.release()
+
+
+class DiskStemStore(StemStore):
+    def path(self, key: str) -> Path:
+        return Path(RENDER_CACHE_DIR) / 'stems' / key[:2] / f'{key}.wav'
+
+    def get(self, key: str) -> AudioSegment | None:
+        path = self.path(key)
+        if not path.exists():
+            render_cache_requests_total.inc(kind='stem', result='miss')
+            return None
+        render_cache_requests_total.inc(kind='stem', result='hit')
+        _touch(path)
+        return read_wav(path)
+
+    def put(self, key: str, audio: AudioSegment):
+        atomic_write(self.path(key), lambda tmp: write_wav(audio, tmp))
+
+
+stem_store = DiskStemStore() if STEM_CACHE else None
+
+
+def _mark_stems(fingerprint: str):
+    path = song_cache_dir(fingerprint) / STEMS_MARKER
+    if not path.exists():
+        atomic_write(path, lambda tmp: open(tmp, 'w').close())
+
+
+def _stem_store(fingerprint: str) -> StemStore | None:
+    """The stem store for songs marked by diff_remix, None for the others."""
+    if stem_store is not None and (song_cache_dir(fingerprint) / STEMS_MARKER).exists():
+        return stem_store
+    return None
+
+
+def diff_remix(reference_json: dict, song: Song) -> tuple[int, int]:
+    """
+    Compares a remix with its reference composition track by track. Returns
+    how many of its stems are unchanged and how many are new or modified.
+    Both are compared as JSON, the reference's samples are never loaded.
+
+    Marks the remix and the reference to render through the stem cache, the
+    unchanged stems come from it when the reference (or another remix of it)
+    was rendered after being remixed.
+    """
+    fingerprint = song_fingerprint(song)
+    if stem_store is not None:
+        _mark_stems(fingerprint)
+        try:
+            _mark_stems(json_fingerprint(reference_json))
+        except Exception as e:
+            logging.warning(f'Reference composition could not be marked for the stem cache: {e}')
+    try:
+        reference_stems = stems_from_json(reference_json)
+    except Exception as e:
+        logging.warning(f'Reference composition could not be compared, every track of the remix counts as changed: {e}')
+        reference_stems = set()
+    stems = stems_from_json(song_to_json(song))
+    unchanged = len(stems & reference_stems)
+    remix_stems_total.inc(unchanged, result='unchanged')
+    remix_stems_total.inc(len(stems) - unchanged, result='changed')
+    logging.info(f'Remix {fingerprint[:12]}: {unchanged} of {len(stems)} tracks unchanged from the reference')
+    return unchanged, len(stems) - unchanged
+
+
+@contextmanager
+def _master_lock(fingerprint: str):
+    """Held while a master is rendered, so different renders needing the same master (an MP3 and the peaks) render it once."""
+    with _master_locks_guard:
+        lock, users = _master_locks.get(fingerprint, (threading.Lock(), 0))
+        _master_locks[fingerprint] = (lock, users + 1)
+    try:
+        with lock:
+            yield
+    finally:
+        with _master_locks_guard:
+            lock, users = _master_locks[fingerprint]
+            if users == 1:
+                del _master_locks[fingerprint]
+            else:
+                _master_locks[fingerprint] = (lock, users - 1)
+
+
+def render_master(song: Song, fingerprint: str | None = None, force: bool = False) -> Path:
+    """
+    Path of the song's master WAV, rendered block by block into the file when
+    it isn't cached (or forced). Raises RenderMemoryExceeded when the song's
+    loops don't fit in RENDER_MEMORY_LIMIT_MB.
+    """
+    fingerprint = fingerprint or song_fingerprint(song)
+    path = song_cache_dir(fingerprint) / MASTER_FILENAME
+    if path.exists() and not force:
+        render_cache_requests_total.inc(kind='master', result='hit')
+        _touch(path)
+        return path
+
+    with _master_lock(fingerprint):
+        if path.exists() and not force:
+            # Rendered by another thread while this one waited
+            render_cache_requests_total.inc(kind='master', result='hit')
+            return path
+        render_cache_requests_total.inc(kind='master', result='miss')
+        start = time.perf_counter()
+        renderer = BlockRenderer(song, RENDER_BLOCK_MS, int(RENDER_MEMORY_LIMIT_MB * 2**20), _stem_store(fingerprint))
+        renderer.prepare()
+        atomic_write(path, lambda tmp: write_wav_blocks(
+            tmp, renderer.blocks(), renderer.frames, renderer.channels, renderer.sample_width, renderer.frame_rate,
+        ))
+        elapsed = time.perf_counter() - start
+        song_render_seconds.observe(elapsed)
+        record_stage('render', elapsed)
+    _maybe_prune()
+    return path
+
+
+def get_master(song: Song, fingerprint: str | None = None, force: bool = False) -> AudioSegment:
+    """Rendered audio of a song, from the cache when it was rendered before (unless forced)."""
+    return read_wav(render_master(song, fingerprint, force))
+
+
+def is_rendered(song: Song, variant: AudioVariant | None = None, fingerprint: str | None = None) -> bool:
+    """Whether the master (and the variant, when given) can be served without rendering."""
+    cache_dir = song_cache_dir(fingerprint or song_fingerprint(song))
+    if not (cache_dir / MASTER_FILENAME).exists():
+        return False
+    return variant is None or variant.format.name == 'wav' and not variant.mono or (cache_dir / variant.filename).exists()
+
+
+def get_encoded(song: Song, variant: AudioVariant, force: bool = False, fingerprint: str | None = None) -> Path:
+    """
+    Path of the song encoded as variant. Every variant is encoded once and cached
+    next to the master, force renders and encodes it again. A fingerprint can be
+    passed for renders that differ from what the song JSON says, like previews.
+    """
+    fingerprint = fingerprint or song_fingerprint(song)
+    cache_dir = song_cache_dir(fingerprint)
+    if variant.format.name == 'wav' and not variant.mono:
+        # The master already is the plain WAV variant
+        return render_master(song, fingerprint, force)
+
+    path = cache_dir / variant.filename
+    if path.exists() and not force:
+        render_cache_requests_total.inc(kind='variant', result='hit')
+        _touch(path)
+        return path
+
+    render_cache_requests_total.inc(kind='variant', result='miss')
+    audio = get_master(song, fingerprint, force)
+    start = time.perf_counter()
+    atomic_write(path, lambda tmp: export_variant(audio, variant, tmp))
+    elapsed = time.perf_counter() - start
+    audio_encode_seconds.observe(elapsed, format=variant.format.name)
+    record_stage('encode', elapsed)
+    logging.info(f'Encoded {fingerprint[:12]} as {variant.key} in {elapsed:.2f}s')
+    return path
+
+
+def get_peaks(song: Song, source: str = 'auto', force: bool = False) -> dict:
+    """
+    Waveform peaks of a song, cached next to its render.
+
+    'audio' renders the song if needed, 'timeline' estimates peaks from the hits
+    without rendering, and 'auto' uses audio peaks only when the song was already rendered.
+    """
+    fingerprint = song_fingerprint(song)
+    cache_dir = song_cache_dir(fingerprint)
+    if source == 'auto':
+        source = 'audio' if (cache_dir / MASTER_FILENAME).exists() else 'timeline'
+    if source not in ('audio', 'timeline'):
+        raise ValueError(f'Unknown peaks source {source}')
+
+    path = cache_dir / f'peaks-{source}.json'
+    if path.exists() and not force:
+        render_cache_requests_total.inc(kind='peaks', result='hit')
+        _touch(path)
+        with open(path) as f:
+            return json.load(f)
+
+    render_cache_requests_total.inc(kind='peaks', result='miss')
+    if source == 'audio':
+        master = get_master(song, fingerprint, force)
+        start = time.perf_counter()
+        result = song_audio_peaks(song, master, _stem_store(fingerprint))
+    else:
+        start = time.perf_counter()
+        result = song_timeline_peaks(song)
+    record_stage('peaks', time.perf_counter() - start)
+
+    def write(tmp: str):
+        with open(tmp, 'w') as f:
+            json.dump(result, f, separators=(',', ':'))
+    atomic_write(path, write)
+    return result
@@ -0,0 +1,158 @@
+import dataclasses
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from promptbeatai.loopmaker.core import Hit, HitArray, Loop, LoopInContext, Song, Track, hit_columns
+from promptbeatai.loopmaker.piano import Piano
+from promptbeatai.loopmaker.sampler import Sampler
+from promptbeatai.loopmaker.synth import SimpleSynth
+
+
+# Cost is measured in "audio seconds processed", weighted by how expensive the work is.
+# Relative cost of producing one second of a hit, per generator type
+GENERATOR_WEIGHTS = {
+    SimpleSynth: 1.0,   # waveform and envelope computed with NumPy/SciPy
+    Piano: 0.6,         # pitch-shifted once per note, then reused
+    Sampler: 0.2,       # a slice of a preloaded sample
+}
+# Every overlay copies the whole canvas it is mixed onto
+OVERLAY_WEIGHT = 0.05
+
+# Songs above this cost are downgraded or rejected before rendering starts
+MAX_RENDER_COST = float(os.getenv('MAX_RENDER_COST', 1000))
+# Hard cap on length, encoding and audio peaks still load the whole rendered master
+MAX_SONG_DURATION_S = float(os.getenv('MAX_SONG_DURATION_S', 600))
+# 'downgrade' shortens songs that are too expensive, 'reject' fails them
+RENDER_COST_POLICY = os.getenv('RENDER_COST_POLICY', 'downgrade')
+
+
+class RenderBudgetExceeded(ValueError):
+    pass
+
+
+@dataclass
+class RenderCost:
+    total: float
+    duration_s: float
+    active_tracks: int
+    hits: int
+
+
+def _track_cost(track: Track, step_s: float, loop_s: float) -> tuple[float, int]:
+    weight = GENERATOR_WEIGHTS.get(type(track.gen), 1.0)
+    _, _, lengths = hit_columns(track.hits)
+    hit_s = float(np.minimum(lengths * step_s, loop_s).sum())
+    return weight * hit_s + OVERLAY_WEIGHT * loop_s * len(track.hits), len(track.hits)
+
+
+def estimate_render_cost(song: Song) -> RenderCost:
+    """
+    Estimated cost of Song.generate, from the song structure alone.
+
+    Every loop in context is rendered once (hits × loop length for the
+    overlays, plus generating each hit) and then overlaid on the whole song
+    canvas, so cost grows with duration × active tracks × hits × generator type.
+    """
+    duration_s = song.duration_ms / 1000
+    step_s = song.bar_duration_ms / (song.beats_per_bar * song.steps_per_beat) / 1000
+    total = 0.0
+    active_tracks = 0
+    hits = 0
+    for lic, _, times in song.placements():
+        if lic.loop.mute or times == 0:
+            continue
+        loop_s = lic.loop.duration_ms(song.bpm, song.beats_per_bar, song.steps_per_beat) / 1000
+        for track in lic.loop.tracks.values():
+            if track.mute:
+                continue
+            cost, n = _track_cost(track, step_s, loop_s)
+            total += cost
+            active_tracks += 1
+            hits += n
+        total += OVERLAY_WEIGHT * duration_s
+    return RenderCost(total=total, duration_s=duration_s, active_tracks=active_tracks, hits=hits)
+
+
+def _hits_before(hits: list[Hit] | HitArray, step: int) -> list[Hit] | HitArray:
+    if isinstance(hits, HitArray):
+        return hits.select(hits.step < step)
+    return [hit for hit in hits if hit['step'] < step]
+
+
+def _shortened_loop(loop: Loop, bars: int, steps_per_bar: int) -> Loop:
+    """The first bars of a loop, sounding like the loop up to there. Generators are shared."""
+    shortened = Loop(bars, loop.gain, loop.mute)
+    for name, track in loop.tracks.items():
+        shortened.add_track(name, dataclasses.replace(track, hits=_hits_before(track.hits, bars * steps_per_bar)))
+    return shortened
+
+
+def truncated_song(song: Song, max_bars: int) -> Song:
+    """
+    The song up to max_bars, sounding like its prefix. Repetitions are counted
+    out, a repetition crossing the cut is replaced by a shortened copy of the
+    loop with the hits before the cut. Other loops are shared, not copied.
+    """
+    truncated = Song(song.bpm, song.beats_per_bar, song.steps_per_beat)
+    cut = min(max_bars, song.duration_ms // max(song.bar_duration_ms, 1))
+    shortened: dict[tuple[int, int], Loop] = {}
+    for lic, _, times in song.placements():
+        loop = lic.loop
+        if times == 0 or lic.start_bar >= cut:
+            continue
+        available = cut - lic.start_bar
+        full = min(times, available // loop.bars)
+        if full:
+            truncated.loops_in_context.append(LoopInContext(loop, lic.start_bar, full))
+        rest = available - full * loop.bars
+        if times > full and rest > 0:
+            key = (id(loop), rest)
+            if key not in shortened:
+                shortened[key] = _shortened_loop(loop, rest, song.beats_per_bar * song.steps_per_beat)
+            truncated.loops_in_context.append(LoopInContext(shortened[key], lic.start_bar + full * loop.bars, 1))
+    return truncated
+
+
+def admit_song(
+    song: Song,
+    max_cost: float = MAX_RENDER_COST,
+    policy: str = RENDER_COST_POLICY,
+    max_duration_s: float = MAX_SONG_DURATION_S,
+) -> Song:
+    """
+    Checks a song against the render budget before any work starts.
+
+    A song that is too expensive or too long is cut to the longest prefix that
+    fits. Raises RenderBudgetExceeded when the policy is 'reject' or even the
+    first bar is over budget.
+    """
+    cost = estimate_render_cost(song)
+    if cost.total <= max_cost and cost.duration_s <= max_duration_s:
+        return song
+    reason = f'Estimated render cost {cost.total:.0f} (budget {max_cost:.0f}), duration {cost.duration_s:.0f}s (limit {max_duration_s:.0f}s)'
+    if policy != 'downgrade':
+        raise RenderBudgetExceeded(reason)
+
+    def fits(c: RenderCost) -> bool:
+        return c.total <= max_cost and c.duration_s <= max_duration_s
+
+    # Cost and duration only grow with the number of bars kept, so binary search the longest prefix that fits
+    low, high = 0, song.duration_ms // max(song.bar_duration_ms, 1)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if fits(estimate_render_cost(truncated_song(song, mid))):
+            low = mid
+        else:
+            high = mid - 1
+    if low < 1:
+        raise RenderBudgetExceeded(f'{reason}, even the first bar is over budget')
+
+    downgraded = truncated_song(song, low)
+    downgraded_cost = estimate_render_cost(downgraded)
+    if not fits(downgraded_cost):
+        raise RenderBudgetExceeded(f'{reason}, no prefix of the song fits')
+    logging.warning(f'{reason}; downgraded to {low} bars, cost {downgraded_cost.total:.0f}, duration {downgraded_cost.duration_s:.0f}s')
+    return downgraded
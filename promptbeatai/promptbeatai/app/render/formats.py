@@ -0,0 +1,195 @@
+import functools
+import logging
+import subprocess
+from dataclasses import dataclass
+
+from pydub import AudioSegment
+
+from promptbeatai.app.render.wav import write_wav
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    name: str
+    media_type: str
+    extension: str
+    # Arguments for AudioSegment.export
+    export_format: str
+    codec: str | None
+    # ffmpeg encoder that has to be available, None for formats pydub writes natively
+    encoder: str | None
+    default_bitrate: str | None
+    parameters: tuple[str, ...] = ()
+
+
+AUDIO_FORMATS = {
+    f.name: f for f in (
+        AudioFormat('mp3', 'audio/mpeg', 'mp3', 'mp3', None, 'libmp3lame', '192k'),
+        # libopus only takes 48 kHz and its divisors
+        AudioFormat('opus', 'audio/ogg; codecs=opus', 'opus', 'ogg', 'libopus', 'libopus', '64k', ('-ar', '48000')),
+        AudioFormat('aac', 'audio/aac', 'aac', 'adts', 'aac', 'aac', '128k'),
+        AudioFormat('flac', 'audio/flac', 'flac', 'flac', None, 'flac', None),
+        AudioFormat('wav', 'audio/wav', 'wav', 'wav', None, None, None),
+    )
+}
+
+DEFAULT_FORMAT = 'mp3'
+FALLBACK_FORMAT = 'wav'
+
+ALLOWED_BITRATES = ('32k', '48k', '64k', '96k', '128k', '160k', '192k', '256k', '320k')
+
+_MEDIA_TYPE_TO_FORMAT = {
+    'audio/mpeg': 'mp3',
+    'audio/mp3': 'mp3',
+    'audio/ogg': 'opus',
+    'audio/opus': 'opus',
+    'audio/aac': 'aac',
+    'audio/mp4': 'aac',
+    'audio/flac': 'flac',
+    'audio/x-flac': 'flac',
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/wave': 'wav',
+}
+
+
+@dataclass(frozen=True)
+class AudioVariant:
+    format: AudioFormat
+    bitrate: str | None = None
+    mono: bool = False
+
+    @property
+    def key(self) -> str:
+        """Cache key, unique per encoded file."""
+        key = f'{self.format.name}-{self.bitrate or "default"}'
+        return f'{key}-mono' if self.mono else key
+
+    @property
+    def filename(self) -> str:
+        return f'{self.key}.{self.format.extension}'
+
+
+# Low-bitrate mono MP3, small enough to start playing almost immediately
+PREVIEW_VARIANT = AudioVariant(AUDIO_FORMATS['mp3'], '64k', mono=True)
+
+
+class UnsupportedFormatError(ValueError):
+    pass
+
+
+@functools.cache
+def available_encoders() -> frozenset[str]:
+    """ffmpeg encoders pydub can use, detected once instead of on every failed export."""
+    try:
+        proc = subprocess.run(
+            [AudioSegment.converter, '-hide_banner', '-encoders'],
+            capture_output=True,
+            text=True,
+            timeout=10,
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning(f'ffmpeg is not available ({e}), only WAV output is supported')
+        return frozenset()
+    encoders = set()
+    for line in proc.stdout.splitlines():
+        # ' A....D libmp3lame           libmp3lame MP3 (MPEG audio layer 3) (codec mp3)'
+        parts = line.split()
+        if len(parts) >= 2 and parts[0].startswith('A'):
+            encoders.add(parts[1])
+    return frozenset(encoders)
+
+
+def is_format_available(audio_format: AudioFormat) -> bool:
+    return audio_format.encoder is None or audio_format.encoder in available_encoders()
+
+
+def available_formats() -> list[str]:
+    return [name for name, f in AUDIO_FORMATS.items() if is_format_available(f)]
+
+
+def log_encoder_availability():
+    formats = available_formats()
+    missing = [name for name in AUDIO_FORMATS if name not in formats]
+    logging.info(f'Available audio formats: {", ".join(formats)}')
+    if missing:
+        logging.warning(f'Audio formats unavailable (missing ffmpeg encoders): {", ".join(missing)}')
+
+
+def _parse_accept(accept: str) -> list[str]:
+    """Media types from an Accept header, by descending q-value."""
+    entries = []
+    for i, item in enumerate(accept.split(',')):
+        media_type, *params = [p.strip() for p in item.split(';')]
+        q = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type and q > 0:
+            entries.append((-q, i, media_type.lower()))
+    return [media_type for _, _, media_type in sorted(entries)]
+
+
+def negotiate_variant(
+    format_name: str | None = None,
+    bitrate: str | None = None,
+    accept: str | None = None,
+    default_format: str = DEFAULT_FORMAT,
+) -> AudioVariant:
+    """
+    Picks the output variant for a request.
+
+    An explicit format (query parameter) wins and must be available, otherwise
+    the Accept header is matched against the available formats. When nothing
+    matches, the default format is used, falling back to WAV without ffmpeg.
+    """
+    if bitrate is not None and bitrate not in ALLOWED_BITRATES:
+        raise UnsupportedFormatError(f'Unsupported bitrate {bitrate}, use one of {", ".join(ALLOWED_BITRATES)}')
+
+    if format_name is not None:
+        if format_name.lower() == 'preview':
+            if not is_format_available(PREVIEW_VARIANT.format):
+                raise UnsupportedFormatError('Preview format is not available on this server')
+            return PREVIEW_VARIANT
+        audio_format = AUDIO_FORMATS.get(format_name.lower())
+        if audio_format is None:
+            raise UnsupportedFormatError(f'Unknown format {format_name}, use one of {", ".join(AUDIO_FORMATS)}')
+        if not is_format_available(audio_format):
+            raise UnsupportedFormatError(f'Format {format_name} is not available on this server')
+    else:
+        audio_format = None
+        for media_type in _parse_accept(accept or ''):
+            if media_type in ('*/*', 'audio/*'):
+                break
+            candidate = AUDIO_FORMATS.get(_MEDIA_TYPE_TO_FORMAT.get(media_type, ''))
+            if candidate is not None and is_format_available(candidate):
+                audio_format = candidate
+                break
+        if audio_format is None:
+            audio_format = AUDIO_FORMATS[default_format]
+            if not is_format_available(audio_format):
+                audio_format = AUDIO_FORMATS[FALLBACK_FORMAT]
+
+    if audio_format.default_bitrate is None:
+        # Lossless formats ignore the bitrate
+        return AudioVariant(audio_format)
+    return AudioVariant(audio_format, bitrate or audio_format.default_bitrate)
+
+
+def export_variant(audio: AudioSegment, variant: AudioVariant, out_path: str):
+    if variant.mono:
+        audio = audio.set_channels(1)
+    if variant.format.name == 'wav':
+        write_wav(audio, out_path)
+        return
+    f = audio.export(
+        out_path,
+        format=variant.format.export_format,
+        codec=variant.format.codec,
+        bitrate=variant.bitrate,
+        parameters=list(variant.format.parameters) or None,
+    )
+    f.close()
@@ -0,0 +1,185 @@
+import numpy as np
+from pydub import AudioSegment
+
+from promptbeatai.loopmaker.blocks import StemStore, mix_loop_stems
+from promptbeatai.loopmaker.core import Loop, Song, Track, hit_columns
+from promptbeatai.loopmaker.synth import SimpleSynth
+
+
+# Resolutions of the song overview, finest first; each is a divisor of the previous one
+OVERVIEW_LEVELS = (4096, 1024, 256)
+STEM_BINS = 256
+# Peaks are quantized to signed bytes to keep the payload small
+QUANT_SCALE = 127
+# Rough level of a sample/piano hit for timeline peaks, synths use their own amplitude
+SAMPLE_HIT_AMPLITUDE = 0.5
+
+
+def audio_to_array(audio: AudioSegment) -> np.ndarray:
+    """Mono float32 samples in [-1, 1]."""
+    samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
+    if audio.channels > 1:
+        samples = samples.reshape(-1, audio.channels).mean(axis=1)
+    return samples / float(1 << (8 * audio.sample_width - 1))
+
+
+def _bin_stats(samples: np.ndarray, bins: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """min, max and mean square per bin, in one vectorized pass."""
+    per_bin = max(1, -(-len(samples) // bins))
+    padded = np.zeros(per_bin * bins, dtype=np.float32)
+    padded[:len(samples)] = samples[:per_bin * bins]
+    frames = padded.reshape(bins, per_bin)
+    return frames.min(axis=1), frames.max(axis=1), np.square(frames).mean(axis=1)
+
+
+def _quantize(mins: np.ndarray, maxs: np.ndarray, mean_squares: np.ndarray) -> dict[str, list[int]]:
+    def q(a: np.ndarray) -> list[int]:
+        return np.clip(np.rint(a * QUANT_SCALE), -QUANT_SCALE, QUANT_SCALE).astype(np.int8).tolist()
+    return {'min': q(mins), 'max': q(maxs), 'rms': q(np.sqrt(mean_squares))}
+
+
+def multires_peaks(samples: np.ndarray, levels: tuple[int, ...] = OVERVIEW_LEVELS) -> list[dict]:
+    """Peaks at every level, coarser levels are reduced from the finest one instead of rescanning the audio."""
+    mins, maxs, mean_squares = _bin_stats(samples, levels[0])
+    result = []
+    for bins in levels:
+        factor = levels[0] // bins
+        result.append({
+            'bins': bins,
+            **_quantize(
+                mins.reshape(bins, factor).min(axis=1),
+                maxs.reshape(bins, factor).max(axis=1),
+                mean_squares.reshape(bins, factor).mean(axis=1),
+            ),
+        })
+    return result
+
+
+def peaks(samples: np.ndarray, bins: int = STEM_BINS) -> dict[str, list[int]]:
+    return _quantize(*_bin_stats(samples, bins))
+
+
+def _loop_summary(song: Song, index: int, position_ms: int, times: int) -> dict:
+    lic = song.loops_in_context[index]
+    return {
+        'index': index,
+        'start_ms': position_ms,
+        'duration_ms': lic.loop.duration_ms(song.bpm, song.beats_per_bar, song.steps_per_beat),
+        'repetitions': times,
+        'mute': lic.loop.mute,
+    }
+
+
+def song_audio_peaks(song: Song, master: AudioSegment, stems: StemStore | None = None) -> dict:
+    """
+    Peaks of the rendered song, plus one repetition of every loop and each of
+    its tracks rendered on its own. Every loop is rendered once, as its stems
+    (from the stem store when given), however often it is placed; a loop's
+    peaks are those of its summed stems.
+    """
+    # Tracks that don't sound keep flat peaks
+    silent = peaks(np.zeros(0, dtype=np.float32))
+    loop_peaks: dict[int, dict] = {}
+    loops = []
+    for index, (lic, position_ms, times) in enumerate(song.placements()):
+        loop = lic.loop
+        if id(loop) not in loop_peaks:
+            tracks = {name: silent for name in loop.tracks}
+
+            def track_peaks(name: str, stem: AudioSegment):
+                tracks[name] = peaks(audio_to_array(stem.apply_gain(loop.gain)))
+            loop_audio = mix_loop_stems(song, loop, stems, track_peaks).apply_gain(loop.gain)
+            loop_peaks[id(loop)] = {'peaks': peaks(audio_to_array(loop_audio)), 'tracks': tracks}
+        loops.append({
+            **_loop_summary(song, index, position_ms, times),
+            **loop_peaks[id(loop)],
+        })
+    return {
+        'source': 'audio',
+        'duration_ms': len(master),
+        'scale': QUANT_SCALE,
+        'overview': multires_peaks(audio_to_array(master)),
+        'loops': loops,
+    }
+
+
+def _track_amplitude(track: Track, loop: Loop) -> float:
+    level = track.gen.amplitude if isinstance(track.gen, SimpleSynth) else SAMPLE_HIT_AMPLITUDE
+    return level * 10 ** ((track.gain + loop.gain) / 20)
+
+
+def _envelope(starts_ms: np.ndarray, ends_ms: np.ndarray, amplitude: float, duration_ms: int, bins: int) -> np.ndarray:
+    """Sum of rectangular hit envelopes, built with a difference array."""
+    diff = np.zeros(bins + 1, dtype=np.float32)
+    scale = bins / max(duration_ms, 1)
+    start_bins = np.clip((starts_ms * scale).astype(np.int64), 0, bins)
+    end_bins = np.clip(np.ceil(ends_ms * scale).astype(np.int64), 0, bins)
+    np.add.at(diff, start_bins, amplitude)
+    np.add.at(diff, end_bins, -amplitude)
+    return np.cumsum(diff[:-1])
+
+
+def _timeline_peaks(env: np.ndarray) -> dict[str, list[int]]:
+    env = np.clip(env, 0.0, 1.0)
+    # A full-scale sine has an RMS of 1/sqrt(2) of its peak
+    return _quantize(-env, env, np.square(env) / 2)
+
+
+def _hit_bounds(track: Track, step_ms: int) -> tuple[np.ndarray, np.ndarray]:
+    steps, _, lengths = hit_columns(track.hits)
+    steps = steps.astype(np.float64)
+    return steps * step_ms, (steps + lengths) * step_ms
+
+
+def song_timeline_peaks(song: Song) -> dict:
+    """Approximate peaks straight from the hits, available before any audio is rendered."""
+    duration_ms = song.duration_ms
+    finest = OVERVIEW_LEVELS[0]
+    overview = np.zeros(finest, dtype=np.float32)
+    step_ms = Loop.step_duration_ms(song.bpm, song.steps_per_beat)
+    loops = []
+    for index, (lic, position_ms, times) in enumerate(song.placements()):
+        loop = lic.loop
+        loop_ms = loop.duration_ms(song.bpm, song.beats_per_bar, song.steps_per_beat)
+        loop_env = np.zeros(STEM_BINS, dtype=np.float32)
+        tracks = {}
+        for name, track in loop.tracks.items():
+            if not len(track.hits):
+                tracks[name] = _timeline_peaks(np.zeros(STEM_BINS, dtype=np.float32))
+                continue
+            starts, ends = _hit_bounds(track, step_ms)
+            # Hits are cut off at the end of the loop
+            ends = np.minimum(ends, loop_ms)
+            amplitude = 0.0 if track.mute else _track_amplitude(track, loop)
+            env = _envelope(starts, ends, amplitude, loop_ms, STEM_BINS)
+            tracks[name] = _timeline_peaks(env)
+            loop_env += env
+            if times and not loop.mute:
+                offsets = position_ms + loop_ms * np.arange(times)
+                overview += _envelope(
+                    (offsets[:, None] + starts).ravel(),
+                    np.minimum((offsets[:, None] + ends).ravel(), duration_ms),
+                    amplitude, duration_ms, finest,
+                )
+        loops.append({
+            **_loop_summary(song, index, position_ms, times),
+            'peaks': _timeline_peaks(loop_env),
+            'tracks': tracks,
+        })
+
+    overview = np.clip(overview, 0.0, 1.0)
+    return {
+        'source': 'timeline',
+        'duration_ms': duration_ms,
+        'scale': QUANT_SCALE,
+        'overview': multires_peaks_from_envelope(overview),
+        'loops': loops,
+    }
+
+
+def multires_peaks_from_envelope(env: np.ndarray, levels: tuple[int, ...] = OVERVIEW_LEVELS) -> list[dict]:
+    result = []
+    for bins in levels:
+        reduced = env.reshape(bins, levels[0] // bins).max(axis=1)
+        result.append({'bins': bins, **_timeline_peaks(reduced)})
+    return result
@@ -0,0 +1,95 @@
+import copy
+import os
+import threading
+import weakref
+from pathlib import Path
+
+from promptbeatai.app.render.cache import get_encoded
+from promptbeatai.app.render.cost import truncated_song
+from promptbeatai.app.render.formats import AUDIO_FORMATS, PREVIEW_VARIANT, AudioVariant, is_format_available
+from promptbeatai.loopmaker.core import Loop, LoopInContext, SoundGenerator, Song, Track
+from promptbeatai.loopmaker.piano import Piano
+from promptbeatai.loopmaker.sampler import Sampler
+from promptbeatai.loopmaker.serialize import song_fingerprint
+from promptbeatai.loopmaker.synth import SimpleSynth
+
+
+# The preview tier renders at a quarter of the CD data rate: half the frame rate, mono
+PREVIEW_FRAME_RATE = int(os.getenv('PREVIEW_FRAME_RATE', 22050))
+PREVIEW_BARS = int(os.getenv('PREVIEW_BARS', 8))
+
+# Preview copy of every generator previewed so far, dropped with the generator. Songs are previewed
+# more than once (every bar count, every request), the copies keep their downsampled samples and pitch shifts
+_preview_generators: 'weakref.WeakKeyDictionary[SoundGenerator, SoundGenerator]' = weakref.WeakKeyDictionary()
+_preview_generators_lock = threading.Lock()
+
+
+def preview_variant() -> AudioVariant:
+    """Low-bitrate mono MP3, or mono WAV when there is no MP3 encoder."""
+    if is_format_available(PREVIEW_VARIANT.format):
+        return PREVIEW_VARIANT
+    return AudioVariant(AUDIO_FORMATS['wav'], mono=True)
+
+
+def preview_fingerprint(song: Song, max_bars: int = PREVIEW_BARS) -> str:
+    """Render cache key of the preview, the preview song itself doesn't know its samples were downsampled."""
+    return f'{song_fingerprint(song)}-preview-{max_bars}-{PREVIEW_FRAME_RATE}'
+
+
+def _preview_generator(gen: SoundGenerator) -> SoundGenerator:
+    # Copies, the full-quality render may be using the originals at the same time
+    if isinstance(gen, SimpleSynth):
+        preview = copy.copy(gen)
+        preview.sample_rate = PREVIEW_FRAME_RATE
+        return preview
+    if isinstance(gen, Sampler):
+        preview = copy.copy(gen)
+        preview.sound = gen.sound.set_channels(1).set_frame_rate(PREVIEW_FRAME_RATE)
+        return preview
+    if isinstance(gen, Piano):
+        preview = copy.copy(gen)
+        preview.samples = {note: s.set_channels(1).set_frame_rate(PREVIEW_FRAME_RATE) for note, s in gen.samples.items()}
+        # Its own memo, the original's holds full-rate shifts
+        preview.shifted = {}
+        preview.fast_pitch_shift = True
+        return preview
+    return gen
+
+
+def _cached_preview_generator(gen: SoundGenerator) -> SoundGenerator:
+    with _preview_generators_lock:
+        preview = _preview_generators.get(gen)
+    if preview is None:
+        preview = _preview_generator(gen)
+        with _preview_generators_lock:
+            # Another request may have built one meanwhile, every caller gets the same copy
+            preview = _preview_generators.setdefault(gen, preview)
+    return preview
+
+
+def preview_song(song: Song, max_bars: int = PREVIEW_BARS) -> Song:
+    """
+    The first max_bars of the song with every generator working at
+    PREVIEW_FRAME_RATE in mono, and cheaper pitch shifting for pianos.
+    Pydub mixes at the highest rate and channel count of its inputs, so the
+    whole render stays at the preview rate. The preview generators are built
+    once per source generator and reused by later previews.
+    """
+    truncated = truncated_song(song, max_bars)
+    generators: dict[int, SoundGenerator] = {}
+    loops: dict[int, Loop] = {}
+    for i, lic in enumerate(truncated.loops_in_context):
+        loop = loops.get(id(lic.loop))
+        if loop is None:
+            loop = Loop(lic.loop.bars, lic.loop.gain, lic.loop.mute)
+            for name, track in lic.loop.tracks.items():
+                if id(track.gen) not in generators:
+                    generators[id(track.gen)] = _cached_preview_generator(track.gen)
+                loop.add_track(name, Track(generators[id(track.gen)], track.hits, track.gain, track.mute, track.polyphony, track.choke_group))
+            loops[id(lic.loop)] = loop
+        truncated.loops_in_context[i] = LoopInContext(loop, lic.start_bar, lic.repeat_times)
+    return truncated
+
+
+def render_preview(song: Song, variant: AudioVariant, max_bars: int = PREVIEW_BARS) -> Path:
+    return get_encoded(preview_song(song, max_bars), variant, fingerprint=preview_fingerprint(song, max_bars))
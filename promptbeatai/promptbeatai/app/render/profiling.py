@@ -0,0 +1,151 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, TypeVar, cast
+
+from promptbeatai.loopmaker.core import LoopInContext, Track, render_observers
+
+
+# Profile every render that actually happens (cache misses), not only the ones an admin asks for
+PROFILE_RENDERS = os.getenv('PROFILE_RENDERS', '0') == '1'
+# Profiles live in <PROFILE_DIR>/<song id>/, a JSON summary plus the raw pstats dump
+PROFILE_DIR = os.getenv('PROFILE_DIR', './.cache/profiles')
+PROFILES_KEPT_PER_SONG = int(os.getenv('PROFILES_KEPT_PER_SONG', 5))
+TOP_FUNCTIONS = 40
+
+T = TypeVar('T')
+
+# Breakdown of the render running on the current thread, None when it isn't profiled
+_local = threading.local()
+# cProfile hooks the whole interpreter on 3.12+, profiles are taken one at a time
+_profiler_lock = threading.Lock()
+
+
+def _breakdown() -> dict | None:
+    return getattr(_local, 'breakdown', None)
+
+
+def record_stage(stage: str, seconds: float):
+    """Adds time spent in a render stage (render, encode, peaks) to the current profile, if any."""
+    breakdown = _breakdown()
+    if breakdown is not None:
+        breakdown['stages'][stage] = breakdown['stages'].get(stage, 0.0) + seconds
+
+
+def _observe_render(kind: str, name: str, obj: object, seconds: float):
+    breakdown = _breakdown()
+    if breakdown is None:
+        return
+    if kind == 'track':
+        track = cast(Track, obj)
+        generator = type(track.gen).__name__
+        breakdown['tracks'].append({'track': name, 'generator': generator, 'hits': len(track.hits), 'seconds': seconds})
+        breakdown['generators'][generator] = breakdown['generators'].get(generator, 0.0) + seconds
+    elif kind == 'loop':
+        lic = cast(LoopInContext, obj)
+        breakdown['loops'].append({
+            'index': int(name),
+            'start_bar': lic.start_bar,
+            'bars': lic.loop.bars,
+            'repeat_times': lic.repeat_times,
+            'seconds': seconds,
+        })
+
+
+render_observers.append(_observe_render)
+
+
+def _top_functions(profiler: cProfile.Profile, limit: int = TOP_FUNCTIONS) -> list[dict]:
+    stats = pstats.Stats(profiler).stats  # type: ignore[attr-defined]
+    rows = []
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.items():
+        rows.append({
+            'function': f'{filename}:{line}({function})',
+            'calls': calls,
+            'tottime': round(tottime, 6),
+            'cumtime': round(cumtime, 6),
+        })
+    rows.sort(key=lambda r: r['cumtime'], reverse=True)
+    return rows[:limit]
+
+
+def _song_profile_dir(song_id: str) -> Path:
+    # Song ids are UUIDs, anything else is flattened so it can't escape PROFILE_DIR
+    return Path(PROFILE_DIR) / re.sub(r'[^A-Za-z0-9_-]', '_', song_id)
+
+
+def _store_profile(song_id: str, summary: dict, profiler: cProfile.Profile):
+    directory = _song_profile_dir(song_id)
+    directory.mkdir(parents=True, exist_ok=True)
+    # Nanosecond timestamps sort in creation order
+    name = f'{time.time_ns()}-{summary["label"]}'
+    profiler.dump_stats(directory / f'{name}.prof')
+    with open(directory / f'{name}.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    for old in sorted(directory.glob('*.json'))[:-PROFILES_KEPT_PER_SONG]:
+        old.unlink(missing_ok=True)
+        old.with_suffix('.prof').unlink(missing_ok=True)
+
+
+class ProfilerBusy(RuntimeError):
+    pass
+
+
+def run_profiled(song_id: str, label: str, fn: Callable[..., T], *args, required: bool = False, **kwargs) -> T:
+    """
+    Runs a render under cProfile and stores the profile for the song, with a
+    per-stage, per-generator, per-loop and per-track timing breakdown.
+
+    Must be called on the thread that does the rendering, the breakdown only
+    sees the current thread. Only one profiler can be active per process (on
+    Python 3.12+ a second one raises), a sampled render started while another
+    is profiled runs unprofiled. A required profile raises ProfilerBusy instead.
+    """
+    if not _profiler_lock.acquire(blocking=False):
+        if required:
+            raise ProfilerBusy(f'Another render is being profiled, {song_id} ({label}) was not rendered')
+        logging.info(f'Another render is being profiled, rendering {song_id} ({label}) without a profile')
+        return fn(*args, **kwargs)
+    _local.breakdown = {'stages': {}, 'generators': {}, 'loops': [], 'tracks': []}
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    try:
+        profiler.enable()
+        return fn(*args, **kwargs)
+    finally:
+        profiler.disable()
+        _profiler_lock.release()
+        total = time.perf_counter() - start
+        breakdown = _breakdown() or {}
+        _local.breakdown = None
+        breakdown['tracks'].sort(key=lambda t: t['seconds'], reverse=True)
+        summary = {
+            'song_id': song_id,
+            'label': label,
+            'created_at': time.time(),
+            'total_seconds': total,
+            **breakdown,
+            'top_functions': _top_functions(profiler),
+        }
+        try:
+            _store_profile(song_id, summary, profiler)
+            logging.info(f'Stored render profile for {song_id} ({label}, {total:.2f}s)')
+        except OSError as e:
+            logging.warning(f'Could not store render profile for {song_id}: {e}')
+
+
+def list_profiles(song_id: str) -> list[Path]:
+    """Stored profile summaries of a song, oldest first."""
+    return sorted(_song_profile_dir(song_id).glob('*.json'))
+
+
+def load_profile(path: Path) -> dict:
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+from promptbeatai.metrics import Counter, Gauge
+
+
+coalesced_requests_total = Counter(
+    'promptbeatai_coalesced_render_requests_total',
+    'Requests that waited on a render another request had already started, instead of rendering again',
+    ('render',),
+)
+coalesced_waiters = Gauge('promptbeatai_coalesced_render_waiters', 'Requests currently waiting on a render another request started')
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time: callers arriving while a call
+    for their key is running await that call's result instead of starting
+    their own. The call runs as its own task, a caller that disconnects
+    doesn't cancel it for the others.
+    """
+    def __init__(self):
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def in_flight(self, key: str) -> bool:
+        return key in self._in_flight
+
+    def _done(self, key: str, task: asyncio.Task):
+        self._in_flight.pop(key, None)
+        # Marks a failure as retrieved when every caller is gone, callers still waiting get it raised
+        if not task.cancelled():
+            task.exception()
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]], metric_label: str | None = None) -> Any:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+            return await asyncio.shield(task)
+
+        coalesced_requests_total.inc(render=metric_label or key)
+        coalesced_waiters.inc()
+        try:
+            return await asyncio.shield(task)
+        finally:
+            coalesced_waiters.dec()
+
+
+render_flights = SingleFlight()
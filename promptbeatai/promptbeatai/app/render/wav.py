@@ -0,0 +1,148 @@
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator
+
+import numpy as np
+from pydub import AudioSegment
+
+
+# Uncompressed output needs no encoder: a RIFF header followed by the PCM buffer exactly as it was rendered
+WAVE_FORMAT_PCM = 1
+PCM_ENCODINGS = ('s16le', 'f32le')
+PCM_CHUNK_BYTES = 1 << 18
+
+
+@dataclass
+class WavInfo:
+    channels: int
+    sample_width: int
+    frame_rate: int
+    data_offset: int
+    data_size: int
+
+
+def wav_header(data_size: int, channels: int, sample_width: int, frame_rate: int) -> bytes:
+    block_align = channels * sample_width
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, WAVE_FORMAT_PCM, channels, frame_rate, frame_rate * block_align, block_align, sample_width * 8,
+        b'data', data_size,
+    )
+
+
+def write_wav(audio: AudioSegment, path: str):
+    """Like audio.export(path, format='wav'), but writes the sample buffer straight to the file instead of copying it first."""
+    data = memoryview(audio.raw_data)
+    with open(path, 'wb') as f:
+        f.write(wav_header(data.nbytes, audio.channels, audio.sample_width, audio.frame_rate))
+        f.write(data)
+
+
+def write_wav_blocks(path: str, blocks: Iterable[np.ndarray], frames: int, channels: int, sample_width: int, frame_rate: int):
+    """
+    Writes a WAV file of the given length from (frames, channels) sample blocks,
+    copied into a memory map of the file so the song never has to be in memory
+    as a whole.
+    """
+    data_size = frames * channels * sample_width
+    header = wav_header(data_size, channels, sample_width, frame_rate)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.truncate(len(header) + data_size)
+    if frames == 0:
+        return
+    out = np.memmap(path, dtype=f'<i{sample_width}', mode='r+', offset=len(header), shape=(frames, channels))
+    try:
+        position = 0
+        for block in blocks:
+            out[position:position + len(block)] = block
+            position += len(block)
+        out.flush()
+    finally:
+        del out
+
+
+def read_wav_info(path: Path) -> WavInfo:
+    """Format and position of the sample data, skipping any chunks other encoders put before it."""
+    with open(path, 'rb') as f:
+        riff, _, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError(f'{path} is not a WAV file')
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(f'{path} has no data chunk')
+            chunk_id, size = struct.unpack('<4sI', chunk_header)
+            if chunk_id == b'fmt ':
+                format_tag, channels, frame_rate, _, _, bits = struct.unpack('<HHIIHH', f.read(16))
+                if format_tag != WAVE_FORMAT_PCM:
+                    raise ValueError(f'{path} is not integer PCM')
+                fmt = (channels, bits // 8, frame_rate)
+                f.seek(size - 16 + size % 2, 1)
+            elif chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError(f'{path} has no fmt chunk before its data')
+                return WavInfo(*fmt, data_offset=f.tell(), data_size=size)
+            else:
+                f.seek(size + size % 2, 1)
+
+
+def read_wav(path: Path) -> AudioSegment:
+    """AudioSegment.from_wav with a single read of the sample data."""
+    info = read_wav_info(path)
+    with open(path, 'rb') as f:
+        f.seek(info.data_offset)
+        data = f.read(info.data_size)
+    return AudioSegment(data, sample_width=info.sample_width, frame_rate=info.frame_rate, channels=info.channels)
+
+
+# Signed little-endian sample types of the widths masters are written with
+_PCM_DTYPES = {1: '<i1', 2: '<i2', 4: '<i4'}
+
+
+def pcm_size(info: WavInfo, encoding: str) -> int:
+    frames = info.data_size // (info.sample_width * info.channels)
+    return frames * info.channels * (2 if encoding == 's16le' else 4)
+
+
+def _convert_pcm(chunk: bytes, sample_width: int, encoding: str) -> bytes:
+    if encoding == 's16le' and sample_width == 2:
+        return chunk
+    samples = np.frombuffer(chunk, dtype=_PCM_DTYPES[sample_width])
+    if encoding == 's16le':
+        shift = 8 * (sample_width - 2)
+        samples = samples >> shift if shift > 0 else samples.astype('<i4') << -shift
+        return samples.astype('<i2').tobytes()
+    return (samples.astype(np.float64) / 2 ** (8 * sample_width - 1)).astype('<f4').tobytes()
+
+
+def _pcm_chunks(path: Path, info: WavInfo, encoding: str, chunk_bytes: int) -> Iterator[bytes]:
+    with open(path, 'rb') as f:
+        f.seek(info.data_offset)
+        remaining = info.data_size
+        while remaining > 0:
+            chunk = f.read(min(chunk_bytes, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield _convert_pcm(chunk, info.sample_width, encoding)
+
+
+def iter_pcm(path: Path, encoding: str = 's16le', chunk_bytes: int = PCM_CHUNK_BYTES, info: WavInfo | None = None) -> Iterator[bytes]:
+    """
+    The sample data of a WAV file as raw interleaved PCM: s16le, or f32le
+    scaled to [-1, 1), converted from whatever width the file has. Read in
+    chunks, the file is never loaded as a whole. The encoding and format are
+    checked before the first chunk is read, so errors come before a response starts.
+    """
+    if encoding not in PCM_ENCODINGS:
+        raise ValueError(f'Unknown PCM encoding {encoding}')
+    info = info or read_wav_info(path)
+    if info.sample_width not in _PCM_DTYPES:
+        raise ValueError(f'{path} has {info.sample_width * 8}-bit samples, expected 8, 16 or 32')
+    # Whole frames per chunk
+    chunk_bytes -= chunk_bytes % (info.channels * info.sample_width)
+    return _pcm_chunks(path, info, encoding, chunk_bytes)
@@ -1,38 +1,82 @@
-import google.genai
-from io import BytesIO
+from pathlib import Path
 from typing import cast
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Request
-from fastapi.responses import StreamingResponse, Response, RedirectResponse
-import openai
+import asyncio
+import functools
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, RedirectResponse, StreamingResponse
+from slowapi.util import get_remote_address
 import os
 import logging
+import time
 import uuid
 
-from promptbeatai.ai.openai_wrapper import OpenAISongGeneratorClient
-from promptbeatai.ai.gemini_wrapper import GeminiSongGeneratorClient
-from promptbeatai.app.entities.generation_prompt import GenerationPrompt
-from promptbeatai.app.middleware.rate_limiter import limiter
-from promptbeatai.loopmaker.serialize import song_to_json
+from promptbeatai.ai.providers import configured_provider, get_song_generator_client
+from promptbeatai.app.entities.generation_prompt import BatchGenerationPrompt, GenerationPrompt
+from promptbeatai.app.middleware.admin import require_admin
+from promptbeatai.app.middleware.cost_limiter import cost_limiter
+from promptbeatai.app.middleware.rate_limiter import GENERATE_RATE_LIMIT, limiter
+from promptbeatai.app.render.audition import audition_song
+from promptbeatai.app.render.cache import diff_remix, get_encoded, get_peaks, is_rendered
+from promptbeatai.app.render.cost import RenderBudgetExceeded, admit_song, estimate_render_cost, truncated_song
+from promptbeatai.app.render.formats import AUDIO_FORMATS, DEFAULT_FORMAT, AudioVariant, UnsupportedFormatError, negotiate_variant
+from promptbeatai.app.render.preview import PREVIEW_BARS, preview_fingerprint, preview_variant, render_preview
+from promptbeatai.app.render.profiling import PROFILE_RENDERS, ProfilerBusy, list_profiles, load_profile, run_profiled
+from promptbeatai.app.render.singleflight import render_flights
+from promptbeatai.app.render.wav import PCM_ENCODINGS, iter_pcm, pcm_size, read_wav_info
+from promptbeatai.app.warm_pool import get_warm_pool
+from promptbeatai.jobs.queue import DONE, FAILED, QUEUED, RUNNING, Job, JobQueue, get_job_queue
+from promptbeatai.jobs.tasks import generate_payload, render_job_id, render_payload
+from promptbeatai.loopmaker.serialize import song_from_json, song_to_json
 from promptbeatai.loopmaker.core import Song
+from promptbeatai.metrics import Counter, Gauge
 
 
-router = APIRouter()
-
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', None)
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY', None)
+# How long an audio request waits for a queued render before answering 202
+RENDER_WAIT_S = float(os.getenv('RENDER_WAIT_S', 60))
+JOB_POLL_INTERVAL_S = float(os.getenv('JOB_POLL_INTERVAL_S', 0.2))
 
-if GEMINI_API_KEY:
-    client = google.genai.Client(api_key=GEMINI_API_KEY)
-    song_generator_client = GeminiSongGeneratorClient(client)
-elif OPENAI_API_KEY:
-    client = openai.OpenAI(api_key=OPENAI_API_KEY)
-    song_generator_client = OpenAISongGeneratorClient(client)
-else:
-    raise RuntimeError("No API key provided for either Gemini or OpenAI")
+router = APIRouter()
 
+# With JOB_QUEUE set, generation and rendering run in worker processes (python -m promptbeatai.jobs.worker),
+# song_store then only caches songs parsed from finished generate jobs
+job_queue = get_job_queue()
+# With WARM_POOL_CONFIG set, matching /generate requests get a song generated and rendered ahead of time
+warm_pool = get_warm_pool()
 song_store = {}
 failed_songs = set()
 
+song_store_size = Gauge('promptbeatai_song_store_size', 'Songs held in memory, including pending and failed ones')
+song_store_size.set_function(lambda: len(song_store))
+failed_songs_size = Gauge('promptbeatai_failed_songs', 'Songs whose generation failed')
+failed_songs_size.set_function(lambda: len(failed_songs))
+pending_songs = Gauge('promptbeatai_pending_songs', 'Songs queued or being generated')
+pending_songs.set_function(lambda: sum(1 for k, v in list(song_store.items()) if v is None and k not in failed_songs))
+renders_in_progress = Gauge('promptbeatai_renders_in_progress', 'Audio and peaks requests waiting for or running in the render threadpool')
+# Both queue gauges are read in one scrape, they share one query
+JOB_COUNTS_TTL_S = 1.0
+_job_counts: tuple[float, dict[str, int]] = (float('-inf'), {})
+
+
+def _cached_job_counts() -> dict[str, int]:
+    global _job_counts
+    at, counts = _job_counts
+    if time.monotonic() - at > JOB_COUNTS_TTL_S:
+        counts = cast(JobQueue, job_queue).counts()
+        _job_counts = (time.monotonic(), counts)
+    return counts
+
+
+queued_jobs = Gauge('promptbeatai_jobs_queued', 'Jobs waiting in the job queue for a worker')
+queued_jobs.set_function(lambda: _cached_job_counts()[QUEUED] if job_queue else 0)
+running_jobs = Gauge('promptbeatai_jobs_running', 'Jobs leased to a worker')
+running_jobs.set_function(lambda: _cached_job_counts()[RUNNING] if job_queue else 0)
+generation_attempts_total = Counter(
+    'promptbeatai_generation_attempts_total',
+    'Song generation attempts by outcome (ok, retry, failed, rejected)',
+    ('outcome',),
+)
+
 
 def generate_and_store_song(prompt: GenerationPrompt, song_id: str):
     successful = False
@@ -40,30 +84,96 @@ def generate_and_store_song(prompt: GenerationPrompt, song_id: str):
     while not successful and i < 3:
         try:
             song_store[song_id] = None
-            song = song_generator_client.request_song(prompt)
-            song_store[song_id] = song
+            song = get_song_generator_client().request_song(prompt)
+            song_store[song_id] = admit_song(song)
+            if prompt.reference_composition:
+                diff_remix(prompt.reference_composition, song_store[song_id])
             successful = True
+            generation_attempts_total.inc(outcome='ok')
+        except RenderBudgetExceeded as e:
+            logging.error(f"Rejected song {song_id}: {e}")
+            generation_attempts_total.inc(outcome='rejected')
+            break
         except Exception as e:
             logging.error(f"Something went wrong {e}")
             i += 1
+            generation_attempts_total.inc(outcome='retry' if i < 3 else 'failed')
     if not successful:
         failed_songs.add(song_id)
 
 
+def generate_and_store_variations(prompt: GenerationPrompt, song_ids: list[str]):
+    try:
+        songs = get_song_generator_client().request_songs(prompt, len(song_ids))
+    except Exception as e:
+        logging.error(f"Something went wrong {e}")
+        songs = []
+    for song_id, song in zip(song_ids, songs):
+        try:
+            song_store[song_id] = admit_song(song)
+            if prompt.reference_composition:
+                diff_remix(prompt.reference_composition, song_store[song_id])
+        except RenderBudgetExceeded as e:
+            logging.error(f"Rejected song {song_id}: {e}")
+            failed_songs.add(song_id)
+    # Variations that didn't come back valid are generated one by one
+    for song_id in song_ids[len(songs):]:
+        generate_and_store_song(prompt, song_id)
+
+
 @router.post('/generate')
-@limiter.limit('10/hour')
+@limiter.limit(GENERATE_RATE_LIMIT)
 async def generate_song(prompt: GenerationPrompt, request: Request, background_tasks: BackgroundTasks):
     logging.info('Song generation started')
     if os.getenv('DEBUG', 0) == '1':
         return {'id': '0', 'mode': 'mock'}
+    # Determine which API is being used
+    mode = configured_provider()
+    if mode is None:
+        raise HTTPException(status_code=503, detail='No API key provided for either Gemini or OpenAI')
     song_id = str(uuid.uuid4())
+    if warm_pool is not None:
+        warm_pool.note_request()
+        song = warm_pool.take(prompt)
+        if song is not None:
+            # Served by the web process in either mode, song_store is checked before the job queue
+            song_store[song_id] = song
+            return {'id': song_id, 'mode': mode}
+    if job_queue is not None:
+        await run_in_threadpool(job_queue.enqueue, 'generate', generate_payload(prompt), song_id)
+        return {'id': song_id, 'mode': mode}
+    # Registered before responding, so polling right away says pending instead of 404
+    song_store[song_id] = None
     background_tasks.add_task(generate_and_store_song, prompt, song_id)
 
-    # Determine which API is being used
-    mode = 'gemini' if GEMINI_API_KEY else 'openai'
     return {'id': song_id, 'mode': mode}
 
 
+@router.post('/generate/batch')
+@limiter.limit(GENERATE_RATE_LIMIT)
+async def generate_song_variations(prompt: BatchGenerationPrompt, request: Request, background_tasks: BackgroundTasks):
+    logging.info(f'Generation of {prompt.n} variations started')
+    if os.getenv('DEBUG', 0) == '1':
+        return {'ids': ['0'] * prompt.n, 'mode': 'mock'}
+    mode = configured_provider()
+    if mode is None:
+        raise HTTPException(status_code=503, detail='No API key provided for either Gemini or OpenAI')
+    song_ids = [str(uuid.uuid4()) for _ in range(prompt.n)]
+    if warm_pool is not None:
+        warm_pool.note_request()
+    base_prompt = GenerationPrompt(**prompt.model_dump(exclude={'n'}))
+    if job_queue is not None:
+        # One job per variation, so they are spread over the generate workers
+        for song_id in song_ids:
+            await run_in_threadpool(job_queue.enqueue, 'generate', generate_payload(base_prompt), song_id)
+        return {'ids': song_ids, 'mode': mode}
+    for song_id in song_ids:
+        song_store[song_id] = None
+    background_tasks.add_task(generate_and_store_variations, base_prompt, song_ids)
+
+    return {'ids': song_ids, 'mode': mode}
+
+
 @router.get('/song/{song_id}')
 async def get_song(song_id: str):
     if song_id == '0':
@@ -247,6 +357,13 @@ async def get_song(song_id: str):
                 }
             ]
         }
+    if song_id not in song_store and job_queue is not None:
+        job = await _get_generate_job(song_id)
+        if job.status == FAILED:
+            return {'id': song_id, 'status': 'failed'}
+        if job.status != DONE:
+            return {'id': song_id, 'status': 'pending'}
+        return {'id': song_id, 'status': 'complete', 'result': job.result}
     if song_id not in song_store:
         raise HTTPException(status_code=404, detail='Song not found')
     song = song_store[song_id]
@@ -271,7 +388,7 @@ async def options_song_mp3(song_id: str = None):
     )
 
 @router.head('/song/mp3/{song_id}')
-async def head_song_mp3(song_id: str):
+async def head_song_mp3(song_id: str, bitrate: str | None = None):
     """HEAD request for MP3 - returns headers without body"""
     if song_id == '0':
         return Response(
@@ -285,56 +402,372 @@ async def head_song_mp3(song_id: str):
             }
         )
 
-    if song_id not in song_store:
-        raise HTTPException(status_code=404, detail='Song not found')
-    song = cast(Song, song_store[song_id])
-    if song is None:
-        raise HTTPException(status_code=202, detail='Song still generating')
+    song = await _get_ready_song(song_id)
+    variant = _negotiate(None, bitrate, None)
 
     return Response(
         status_code=200,
         headers={
-            "Content-Type": "audio/mpeg",
+            "Content-Type": variant.format.media_type,
             "Accept-Ranges": "bytes",
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
-            "Access-Control-Allow-Headers": "*"
+            "Access-Control-Allow-Headers": "*",
+            **_cache_headers(song, variant)
         }
     )
 
-@router.get('/song/mp3/{song_id}')
-async def get_song_mp3(song_id: str, download: bool = False):
-    if song_id == '0':
-        return RedirectResponse(url="/beat-freestyle.mp3")
+async def _get_generate_job(song_id: str) -> Job:
+    job = await run_in_threadpool(cast(JobQueue, job_queue).get, song_id)
+    if job is None or job.kind != 'generate':
+        raise HTTPException(status_code=404, detail='Song not found')
+    return job
+
+
+async def _get_ready_song(song_id: str) -> Song:
+    if song_id not in song_store and job_queue is not None:
+        job = await _get_generate_job(song_id)
+        if job.status != DONE:
+            raise HTTPException(status_code=202, detail='Song still generating')
+        # Parsed once per web process, loading the samples blocks
+        song_store[song_id] = await run_in_threadpool(song_from_json, job.result)
     if song_id not in song_store:
         raise HTTPException(status_code=404, detail='Song not found')
     song = cast(Song, song_store[song_id])
     if song is None:
         raise HTTPException(status_code=202, detail='Song still generating')
+    return song
 
-    audio = song.generate()
-    buffer = BytesIO()
 
+def _negotiate(format: str | None, bitrate: str | None, accept: str | None, default_format: str = DEFAULT_FORMAT) -> AudioVariant:
     try:
-        audio.export(buffer, format='mp3')
-        media_type = "audio/mpeg"
-        filename = "sound.mp3"
-    except FileNotFoundError:
-        buffer = BytesIO()
-        audio.export(buffer, format='wav')
-        media_type = "audio/wav"
-        filename = "sound.wav"
+        return negotiate_variant(format, bitrate, accept, default_format)
+    except UnsupportedFormatError as e:
+        raise HTTPException(status_code=406, detail=str(e))
 
-    buffer.seek(0)
 
-    return StreamingResponse(
-        buffer,
-        media_type=media_type,
+def _flight_key(song_id: str, label: str) -> str:
+    return f'{song_id}:{label}'
+
+
+def _job_flight_key(song_id: str, flight: str) -> str:
+    # Waiting on a render worker returns the job, not what the in-process render returns, the two never share a flight
+    return _flight_key(song_id, f'job:{flight}')
+
+
+def _charge_render(request: Request, song: Song, variant: AudioVariant | None = None, force: bool = False, label: str | None = None, song_id: str | None = None) -> bool:
+    """
+    Charges the render by its estimated cost, returns whether it was free: cached,
+    or (given a label and song id) already being rendered for another request.
+    """
+    if not force and label is not None and song_id is not None and render_flights.in_flight(_flight_key(song_id, label)):
+        return True
+    cached = is_rendered(song, variant) and not force
+    if not cached:
+        cost_limiter.charge(request, estimate_render_cost(song).total)
+    return cached
+
+
+async def _run_render(song_id: str, label: str, profile: bool, cached: bool, fn, *args, flight: str | None = None):
+    """
+    Runs fn(*args) in the threadpool, profiled under label. Requests share a
+    render by song id and flight, the label by default; labels are also metric
+    labels, renders told apart by more (like auditions) pass a flight.
+    """
+    # Rendering and encoding are CPU bound, keep them off the event loop
+    renders_in_progress.inc()
+    try:
+        if profile:
+            # A requested profile always measures a fresh render, not a cache hit
+            try:
+                return await run_in_threadpool(run_profiled, song_id, label, fn, *args, required=True, force=True)
+            except ProfilerBusy as e:
+                raise HTTPException(status_code=503, detail=str(e), headers={'Retry-After': '5'})
+        if PROFILE_RENDERS and not cached:
+            render = functools.partial(run_in_threadpool, run_profiled, song_id, label, fn, *args)
+        else:
+            render = functools.partial(run_in_threadpool, fn, *args)
+        # Concurrent requests for the same render (audio element, download button, HEAD probes) share one
+        return await render_flights.run(_flight_key(song_id, flight or label), render, label)
+    finally:
+        renders_in_progress.dec()
+
+
+async def _wait_for_job(job_id: str, timeout_s: float) -> Job | None:
+    queue = cast(JobQueue, job_queue)
+    deadline = asyncio.get_running_loop().time() + timeout_s
+    while True:
+        job = await run_in_threadpool(queue.get, job_id)
+        if job is None or job.status in (DONE, FAILED) or asyncio.get_running_loop().time() >= deadline:
+            return job
+        await asyncio.sleep(JOB_POLL_INTERVAL_S)
+
+
+async def _enqueue_and_wait(song: Song, variant: AudioVariant, job_id: str) -> Job | None:
+    await run_in_threadpool(cast(JobQueue, job_queue).enqueue, 'render', render_payload(song, variant), job_id)
+    return await _wait_for_job(job_id, RENDER_WAIT_S)
+
+
+async def _render_in_worker(song_id: str, song: Song, variant: AudioVariant, label: str | None = None, flight: str | None = None) -> Path:
+    """Queues the render for a render worker and waits for it, requests for the same render share one job."""
+    job_id = render_job_id(song, variant)
+    renders_in_progress.inc()
+    try:
+        # One poller per render in this process, the other requests wait on it
+        job = await render_flights.run(
+            _job_flight_key(song_id, flight or variant.key), lambda: _enqueue_and_wait(song, variant, job_id), label or variant.key,
+        )
+    finally:
+        renders_in_progress.dec()
+    if job is not None and job.status == DONE:
+        return Path(job.result['path'])
+    if job is not None and job.status == FAILED:
+        logging.error(f'Render job {job_id} failed: {job.error}')
+        raise HTTPException(status_code=500, detail='Render failed')
+    raise HTTPException(status_code=202, detail='Song still rendering', headers={'Retry-After': '5'})
+
+
+async def _render_audio(
+    request: Request, song_id: str, song: Song, variant: AudioVariant, profile: bool = False, label: str | None = None, flight: str | None = None,
+) -> Path:
+    """
+    Path of the song encoded as variant, rendered by a render worker when there
+    is a job queue. The song can be a clip of the song with song_id, with its
+    own label and flight (see _run_render).
+    """
+    if profile:
+        require_admin(request)
+    label = label or variant.key
+    flight = flight or variant.key
+    # Profiles are always taken in the web process, it is an admin tool
+    if job_queue is not None and not profile:
+        _charge_render(request, song, variant, label=f'job:{flight}', song_id=song_id)
+        # Requests joining a render that is in flight wait on the same job
+        if not is_rendered(song, variant):
+            return await _render_in_worker(song_id, song, variant, label, flight)
+        return await _run_render(song_id, label, False, True, get_encoded, song, variant, flight=flight)
+    cached = _charge_render(request, song, variant, force=profile, label=flight, song_id=song_id)
+    return await _run_render(song_id, label, profile, cached, get_encoded, song, variant, flight=flight)
+
+
+def _cache_headers(song: Song, variant: AudioVariant) -> dict[str, str]:
+    """Whether the variant was rendered before this request, HEAD and GET report it alike."""
+    return {"X-Cache": 'hit' if is_rendered(song, variant) else 'miss', "Access-Control-Expose-Headers": "X-Cache"}
+
+
+async def _audio_response(request: Request, song_id: str, song: Song, variant: AudioVariant, download: bool = False, profile: bool = False) -> FileResponse:
+    headers = _cache_headers(song, variant)
+    path = await _render_audio(request, song_id, song, variant, profile)
+    return _file_response(path, variant, download, headers)
+
+
+def _file_response(path: Path, variant: AudioVariant, download: bool = False, headers: dict[str, str] | None = None) -> FileResponse:
+    disposition = 'attachment' if download else 'inline'
+    return FileResponse(
+        path,
+        media_type=variant.format.media_type,
+        headers={
+            "Content-Disposition": f"{disposition}; filename=sound.{variant.format.extension}",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
+            "Access-Control-Allow-Headers": "*",
+            "Accept-Ranges": "bytes",
+            "Vary": "Accept",
+            **(headers or {})
+        }
+    )
+
+
+@router.get('/song/mp3/{song_id}')
+async def get_song_mp3(song_id: str, request: Request, download: bool = False, bitrate: str | None = None, profile: bool = False):
+    if song_id == '0':
+        return RedirectResponse(url="/beat-freestyle.mp3")
+    song = await _get_ready_song(song_id)
+    # Always MP3, or WAV when no MP3 encoder is available
+    variant = _negotiate(None, bitrate, None)
+    return await _audio_response(request, song_id, song, variant, download, profile)
+
+
+@router.options('/song/audio/{song_id}')
+async def options_song_audio(song_id: str = None):
+    """OPTIONS request for CORS preflight"""
+    return await options_song_mp3(song_id)
+
+
+@router.head('/song/audio/{song_id}')
+async def head_song_audio(song_id: str, request: Request, format: str | None = None, bitrate: str | None = None):
+    """HEAD request for the negotiated audio format - returns headers without body"""
+    variant = _negotiate(format, bitrate, request.headers.get('accept'))
+    cache_headers = {}
+    if song_id != '0':
+        cache_headers = _cache_headers(await _get_ready_song(song_id), variant)
+    return Response(
+        status_code=200,
         headers={
-            "Content-Disposition": f"inline; filename={filename}",
+            "Content-Type": variant.format.media_type,
+            "Accept-Ranges": "bytes",
             "Access-Control-Allow-Origin": "*",
             "Access-Control-Allow-Methods": "GET, HEAD, OPTIONS",
             "Access-Control-Allow-Headers": "*",
-            "Accept-Ranges": "bytes"
+            "Vary": "Accept",
+            **cache_headers
         }
     )
+
+
+@router.get('/song/audio/{song_id}')
+async def get_song_audio(song_id: str, request: Request, format: str | None = None, bitrate: str | None = None, download: bool = False, profile: bool = False):
+    """
+    Song audio in a negotiated format: ?format= (mp3, opus, aac, flac, wav or preview)
+    and ?bitrate= take precedence over the Accept header.
+    ?profile=true (admin only) re-renders the song under the profiler.
+    """
+    if song_id == '0':
+        return RedirectResponse(url="/beat-freestyle.mp3")
+    variant = _negotiate(format, bitrate, request.headers.get('accept'))
+    song = await _get_ready_song(song_id)
+    return await _audio_response(request, song_id, song, variant, download, profile)
+
+
+@router.get('/song/audition/{song_id}/{loop_index}')
+async def get_song_audition(song_id: str, loop_index: int, request: Request, track: str | None = None, format: str | None = None, bitrate: str | None = None):
+    """
+    A short clip of one repetition of the loop in context at loop_index, or of
+    ?track= alone, in the same formats as /song/audio. Renders only that loop
+    and is cached separately from the full song.
+    """
+    variant = _negotiate(format, bitrate, request.headers.get('accept'))
+    song = await _get_ready_song(song_id)
+    if not 0 <= loop_index < len(song.loops_in_context):
+        raise HTTPException(status_code=404, detail='Loop not found')
+    if track is not None and track not in song.loops_in_context[loop_index].loop.tracks:
+        raise HTTPException(status_code=404, detail='Track not found')
+    clip = audition_song(song, loop_index, track)
+    # Track names come from the model, they only tell flights apart and never end up in metric labels
+    flight = f'audition-{loop_index}-{track or ""}-{variant.key}'
+    path = await _render_audio(request, song_id, clip, variant, label='audition', flight=flight)
+    return _file_response(path, variant)
+
+
+@router.get('/song/pcm/{song_id}')
+async def get_song_pcm(song_id: str, request: Request, encoding: str = 's16le', profile: bool = False):
+    """
+    Raw interleaved PCM for clients doing their own processing, no container:
+    encoding=s16le (as rendered) or f32le (scaled to [-1, 1)). The sample rate
+    and channel count are in the X-Sample-Rate and X-Channels headers.
+    """
+    if encoding not in PCM_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f'encoding must be one of {", ".join(PCM_ENCODINGS)}')
+    song = await _get_ready_song(song_id)
+    # Served from the lossless master, converted from its sample width on the fly
+    path = await _render_audio(request, song_id, song, AudioVariant(AUDIO_FORMATS['wav']), profile)
+    info = read_wav_info(path)
+    try:
+        chunks = iter_pcm(path, encoding, info=info)
+    except ValueError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(
+        chunks,
+        media_type='application/octet-stream',
+        headers={
+            "Content-Length": str(pcm_size(info, encoding)),
+            "Content-Disposition": f"inline; filename=sound.{encoding}",
+            "X-Sample-Rate": str(info.frame_rate),
+            "X-Channels": str(info.channels),
+            "X-Encoding": encoding,
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Expose-Headers": "X-Sample-Rate, X-Channels, X-Encoding",
+        }
+    )
+
+
+async def _render_full_quality(song_id: str, song: Song, variant: AudioVariant):
+    try:
+        # Through the same single flight as /song/mp3, so a download started meanwhile waits on this render
+        await _run_render(song_id, variant.key, False, False, get_encoded, song, variant)
+    except Exception as e:
+        logging.error(f"Background render failed: {e}")
+
+
+@router.get('/song/preview/{song_id}')
+async def get_song_preview(
+    song_id: str,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    bars: int = Query(default=PREVIEW_BARS, ge=1, le=64),
+    profile: bool = False,
+):
+    """
+    Fast low-fidelity preview: the first bars of the song rendered at 22.05 kHz
+    mono and encoded at a low bitrate. The full-quality render is started in the
+    background, X-Full-Render says whether it is ready, rendering or deferred
+    (over the render budget, it is rendered when requested).
+    """
+    if song_id == '0':
+        return RedirectResponse(url="/beat-freestyle.mp3")
+    if profile:
+        require_admin(request)
+    song = await _get_ready_song(song_id)
+    variant = preview_variant()
+    cached = is_rendered(song, variant, preview_fingerprint(song, bars)) and not profile
+    if not profile and render_flights.in_flight(_flight_key(song_id, f'preview-{bars}')):
+        cached = True
+    if not cached:
+        cost_limiter.charge(request, estimate_render_cost(truncated_song(song, bars)).total)
+    path = await _run_render(song_id, f'preview-{bars}', profile, cached, render_preview, song, variant, bars)
+
+    full_variant = _negotiate(None, None, None)
+    full_render = 'ready'
+    if render_flights.in_flight(_flight_key(song_id, full_variant.key)) or render_flights.in_flight(_job_flight_key(song_id, full_variant.key)):
+        full_render = 'rendering'
+    elif not is_rendered(song, full_variant):
+        # Charged without failing the request, the preview is already paid for
+        if cost_limiter.try_charge(get_remote_address(request), estimate_render_cost(song).total) == 0:
+            if job_queue is not None:
+                await run_in_threadpool(job_queue.enqueue, 'render', render_payload(song, full_variant), render_job_id(song, full_variant))
+            else:
+                background_tasks.add_task(_render_full_quality, song_id, song, full_variant)
+            full_render = 'rendering'
+        else:
+            full_render = 'deferred'
+    return _file_response(path, variant, headers={"X-Full-Render": full_render, "Access-Control-Expose-Headers": "X-Full-Render"})
+
+
+@router.get('/song/peaks/{song_id}')
+async def get_song_peaks(song_id: str, request: Request, source: str = 'auto', profile: bool = False):
+    """
+    Min/max/RMS waveform peaks for the song overview, each loop and each track,
+    quantized to [-scale, scale]. source: audio, timeline or auto.
+    """
+    if source not in ('auto', 'audio', 'timeline'):
+        raise HTTPException(status_code=400, detail='source must be one of auto, audio, timeline')
+    if profile:
+        require_admin(request)
+    song = await _get_ready_song(song_id)
+    cached = True
+    if source == 'audio':
+        cached = _charge_render(request, song, force=profile, label=f'peaks-{source}', song_id=song_id)
+        if job_queue is not None and not cached and not profile:
+            # The worker renders the master, the peaks are then computed from the cached file
+            await _render_in_worker(song_id, song, AudioVariant(AUDIO_FORMATS['wav']))
+            cached = True
+    return await _run_render(song_id, f'peaks-{source}', profile, cached, get_peaks, song, source)
+
+
+@router.get('/song/profile/{song_id}')
+async def get_song_profile(song_id: str, request: Request, format: str = 'json'):
+    """
+    Latest render profile of a song (admin only): timings per stage, generator,
+    loop and track plus the top functions by cumulative time.
+    ?format=pstats downloads the raw cProfile dump, for snakeviz or pstats.
+    """
+    require_admin(request)
+    profiles = list_profiles(song_id)
+    if not profiles:
+        raise HTTPException(status_code=404, detail='No profile recorded for this song')
+    latest = profiles[-1]
+    if format == 'pstats':
+        return FileResponse(latest.with_suffix('.prof'), media_type='application/octet-stream', filename=f'{song_id}.prof')
+    if format != 'json':
+        raise HTTPException(status_code=400, detail='format must be json or pstats')
+    return {**load_profile(latest), 'profiles': [p.stem for p in profiles]}
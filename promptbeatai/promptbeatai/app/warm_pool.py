@@ -0,0 +1,242 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any
+
+from promptbeatai.ai.prompt_builder import estimate_tokens
+from promptbeatai.ai.providers import get_song_generator_client
+from promptbeatai.ai.util import prompt_token_report
+from promptbeatai.app.entities.generation_prompt import GenerationPrompt
+from promptbeatai.app.render.cache import get_encoded
+from promptbeatai.app.render.cost import admit_song
+from promptbeatai.app.render.formats import AUDIO_FORMATS, AudioVariant, available_formats
+from promptbeatai.jobs.queue import get_job_queue
+from promptbeatai.jobs.tasks import render_job_id, render_payload
+from promptbeatai.loopmaker.core import Song
+from promptbeatai.loopmaker.serialize import song_to_json
+from promptbeatai.metrics import Counter, Gauge
+
+
+# JSON file with the preset buckets, see load_buckets. Unset: no warm pool
+WARM_POOL_CONFIG = os.getenv('WARM_POOL_CONFIG', None)
+# Estimated LLM tokens (prompt + completion) the pool may spend per budget window. Every worker process
+# (uvicorn --workers) has its own pool and budget, N workers spend up to N times this
+WARM_POOL_TOKEN_BUDGET = int(os.getenv('WARM_POOL_TOKEN_BUDGET', 200_000))
+WARM_POOL_BUDGET_WINDOW_S = float(os.getenv('WARM_POOL_BUDGET_WINDOW_S', 86_400))
+# The pool is only refilled after this long without a /generate request
+WARM_POOL_IDLE_S = float(os.getenv('WARM_POOL_IDLE_S', 30))
+WARM_POOL_INTERVAL_S = float(os.getenv('WARM_POOL_INTERVAL_S', 5))
+# Formats pooled songs are encoded to ahead of time, ones without an encoder are skipped
+WARM_POOL_FORMATS = os.getenv('WARM_POOL_FORMATS', 'mp3')
+# Longer prompts ask for something specific, they always go to the provider
+WARM_POOL_MAX_PROMPT_WORDS = int(os.getenv('WARM_POOL_MAX_PROMPT_WORDS', 32))
+# Completion size assumed before the first song was generated
+DEFAULT_COMPLETION_TOKENS = 4000
+
+warm_pool_requests_total = Counter(
+    'promptbeatai_warm_pool_requests_total',
+    'Generate requests by pool result: hit (served from the pool), empty (matched a bucket with no song ready), miss (no bucket)',
+    ('bucket', 'result'),
+)
+warm_pool_generations_total = Counter(
+    'promptbeatai_warm_pool_generations_total',
+    'Songs the warm pool generated and rendered, by outcome (ok, failed)',
+    ('bucket', 'outcome'),
+)
+warm_pool_tokens_spent_total = Counter(
+    'promptbeatai_warm_pool_tokens_spent_total',
+    'Estimated LLM tokens spent filling the warm pool',
+    ('bucket',),
+)
+warm_pool_songs = Gauge('promptbeatai_warm_pool_songs', 'Songs ready in the warm pool', ('bucket',))
+warm_pool_budget_remaining = Gauge('promptbeatai_warm_pool_token_budget_remaining', 'Estimated tokens the warm pool may still spend in this budget window')
+
+
+def _words(text: str) -> list[str]:
+    return re.findall(r'[a-z0-9]+', text.lower())
+
+
+@dataclass
+class PoolBucket:
+    name: str
+    # Prompt the pool's songs are generated from
+    text_prompt: str
+    # Requests must send exactly these settings
+    other_settings: dict[str, Any]
+    # Requests must mention one of these (all words of a phrase, in any order)
+    keywords: list[str]
+    size: int = 2
+
+    def prompt(self) -> GenerationPrompt:
+        return GenerationPrompt(text_prompt=self.text_prompt, other_settings=self.other_settings)
+
+    def matches(self, prompt: GenerationPrompt) -> bool:
+        if prompt.reference_composition or prompt.other_settings != self.other_settings:
+            return False
+        words = _words(prompt.text_prompt)
+        if len(words) > WARM_POOL_MAX_PROMPT_WORDS:
+            return False
+        return any(set(_words(keyword)) <= set(words) for keyword in self.keywords)
+
+
+def load_buckets(path: str) -> list[PoolBucket]:
+    """
+    Reads buckets from a JSON file like
+    {"buckets": [{"name": "house-128", "text_prompt": "Deep house groove",
+    "other_settings": {"bpm": 128}, "keywords": ["house"], "size": 3}]}
+    """
+    with open(path) as f:
+        config = json.load(f)
+    return [PoolBucket(**bucket) for bucket in config['buckets']]
+
+
+@dataclass
+class TokenBudget:
+    """
+    Tokens that may be spent per window, the window restarts once it has passed.
+    Kept in memory, so it only counts what this process spends.
+    """
+    tokens: int
+    window_s: float
+    spent: int = 0
+    window_start: float = field(default_factory=time.monotonic)
+
+    def _roll(self):
+        if time.monotonic() - self.window_start >= self.window_s:
+            self.window_start = time.monotonic()
+            self.spent = 0
+
+    @property
+    def remaining(self) -> int:
+        self._roll()
+        return max(0, self.tokens - self.spent)
+
+    def spend(self, tokens: int):
+        self._roll()
+        self.spent += tokens
+
+
+class WarmPool:
+    """
+    Songs generated and rendered ahead of time for preset buckets, handed out
+    to /generate requests that match a bucket. A background task refills the
+    emptiest bucket whenever no request came in for WARM_POOL_IDLE_S, as long
+    as the token budget allows it.
+    """
+    def __init__(self, buckets: list[PoolBucket], budget: TokenBudget, formats: list[str]):
+        self.buckets = buckets
+        self.budget = budget
+        self.formats = formats
+        self._songs: dict[str, deque[Song]] = {bucket.name: deque() for bucket in buckets}
+        self._lock = threading.Lock()
+        self._last_request = 0.0
+        self._completion_tokens = DEFAULT_COMPLETION_TOKENS
+        for bucket in buckets:
+            warm_pool_songs.set(0, bucket=bucket.name)
+        warm_pool_budget_remaining.set_function(lambda: self.budget.remaining)
+
+    def note_request(self):
+        self._last_request = time.monotonic()
+
+    def take(self, prompt: GenerationPrompt) -> Song | None:
+        """
+        A pooled song for the prompt from the first bucket it matches that has
+        one, None when it matches no bucket or all of them are empty.
+        """
+        buckets = [b for b in self.buckets if b.matches(prompt)]
+        if not buckets:
+            warm_pool_requests_total.inc(bucket='', result='miss')
+            return None
+        with self._lock:
+            bucket = next((b for b in buckets if self._songs[b.name]), None)
+            if bucket is not None:
+                songs = self._songs[bucket.name]
+                song = songs.popleft()
+                warm_pool_songs.set(len(songs), bucket=bucket.name)
+        if bucket is None:
+            warm_pool_requests_total.inc(bucket=buckets[0].name, result='empty')
+            return None
+        warm_pool_requests_total.inc(bucket=bucket.name, result='hit')
+        return song
+
+    def _estimated_tokens(self, bucket: PoolBucket) -> int:
+        return prompt_token_report(bucket.prompt())['total'] + self._completion_tokens
+
+    def _next_bucket(self) -> PoolBucket | None:
+        """The bucket missing the most songs, if the budget covers generating one."""
+        with self._lock:
+            missing = [(bucket.size - len(self._songs[bucket.name]), bucket) for bucket in self.buckets]
+        missing = [(n, bucket) for n, bucket in missing if n > 0]
+        if not missing:
+            return None
+        bucket = max(missing, key=lambda m: m[0])[1]
+        return bucket if self._estimated_tokens(bucket) <= self.budget.remaining else None
+
+    def fill(self, bucket: PoolBucket):
+        """
+        Generates one song for the bucket and encodes it ahead of time, or queues
+        its renders when a job queue is configured. Blocks.
+        """
+        prompt = bucket.prompt()
+        prompt_tokens = prompt_token_report(prompt)['total']
+        try:
+            song = admit_song(get_song_generator_client().request_song(prompt))
+        except Exception:
+            # The request was most likely billed anyway
+            self.budget.spend(prompt_tokens)
+            warm_pool_tokens_spent_total.inc(prompt_tokens, bucket=bucket.name)
+            warm_pool_generations_total.inc(bucket=bucket.name, outcome='failed')
+            raise
+        self._completion_tokens = estimate_tokens(json.dumps(song_to_json(song)))
+        self.budget.spend(prompt_tokens + self._completion_tokens)
+        warm_pool_tokens_spent_total.inc(prompt_tokens + self._completion_tokens, bucket=bucket.name)
+        job_queue = get_job_queue()
+        for name in self.formats:
+            audio_format = AUDIO_FORMATS[name]
+            variant = AudioVariant(audio_format, audio_format.default_bitrate)
+            if job_queue is not None:
+                # Rendered by the render workers, a request for the song before they are done waits on the same job
+                job_queue.enqueue('render', render_payload(song, variant), render_job_id(song, variant))
+            else:
+                get_encoded(song, variant)
+        with self._lock:
+            self._songs[bucket.name].append(song)
+            warm_pool_songs.set(len(self._songs[bucket.name]), bucket=bucket.name)
+        warm_pool_generations_total.inc(bucket=bucket.name, outcome='ok')
+        logging.info(f'Warm pool: added a song to {bucket.name}, {self.budget.remaining} tokens left in the budget')
+
+    async def run(self):
+        failures = 0
+        while True:
+            await asyncio.sleep(WARM_POOL_INTERVAL_S * 2 ** min(failures, 6))
+            if time.monotonic() - self._last_request < WARM_POOL_IDLE_S:
+                continue
+            try:
+                bucket = self._next_bucket()
+                if bucket is None:
+                    continue
+                await asyncio.to_thread(self.fill, bucket)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logging.error(f'Warm pool: refilling failed: {e}')
+
+
+@functools.cache
+def get_warm_pool() -> WarmPool | None:
+    if not WARM_POOL_CONFIG:
+        return None
+    buckets = load_buckets(WARM_POOL_CONFIG)
+    requested = [f.strip() for f in WARM_POOL_FORMATS.split(',') if f.strip()]
+    formats = [f for f in requested if f in available_formats()]
+    if formats != requested:
+        logging.warning(f'Warm pool: no encoder for {", ".join(sorted(set(requested) - set(formats)))}, those are encoded on request')
+    logging.info(f'Warm pool: {len(buckets)} buckets, {WARM_POOL_TOKEN_BUDGET} tokens per {WARM_POOL_BUDGET_WINDOW_S:.0f}s')
+    return WarmPool(buckets, TokenBudget(WARM_POOL_TOKEN_BUDGET, WARM_POOL_BUDGET_WINDOW_S), formats)
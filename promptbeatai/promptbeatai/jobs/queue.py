@@ -0,0 +1,263 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, cast
+
+
+# '' runs generation and rendering inside the web process, 'sqlite' hands them to worker processes
+JOB_QUEUE = os.getenv('JOB_QUEUE', '')
+JOB_QUEUE_PATH = os.getenv('JOB_QUEUE_PATH', './.cache/jobs.sqlite3')
+# A worker that stops heartbeating for this long is presumed dead and its job is handed out again
+JOB_LEASE_S = float(os.getenv('JOB_LEASE_S', 30))
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', 3))
+# Failed attempts are retried after JOB_RETRY_BACKOFF_S, doubled on every further attempt
+JOB_RETRY_BACKOFF_S = float(os.getenv('JOB_RETRY_BACKOFF_S', 2))
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class PermanentJobError(Exception):
+    """Raised by a job handler when retrying cannot help, the job fails right away."""
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    payload: dict[str, Any]
+    status: str
+    attempts: int
+    max_attempts: int
+    worker_id: str | None
+    lease_until: float | None
+    result: Any
+    error: str | None
+    created_at: float
+    updated_at: float
+
+
+class JobQueue(ABC):
+    """
+    Durable queue shared by the web processes, which enqueue jobs and read
+    their results, and the worker processes, which claim and run them.
+
+    A claimed job is leased to one worker. The worker extends the lease with
+    heartbeats while it runs, a job whose lease runs out is claimed again by
+    another worker and counts as a failed attempt.
+    """
+    @abstractmethod
+    def enqueue(self, kind: str, payload: dict[str, Any], job_id: str | None = None, max_attempts: int = JOB_MAX_ATTEMPTS) -> Job:
+        """
+        Adds a job and returns it. Enqueueing an id that already exists returns
+        the existing job, or queues it again when it is done or failed, so a
+        deterministic id deduplicates work (e.g. one render job per song and format).
+        """
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def claim(self, worker_id: str, kinds: list[str] | None = None, lease_s: float = JOB_LEASE_S) -> Job | None:
+        """Leases the oldest runnable job of one of the kinds (any kind when None) to the worker."""
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker_id: str, lease_s: float = JOB_LEASE_S) -> bool:
+        """Extends the lease, False when the worker no longer holds it."""
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def complete(self, job_id: str, worker_id: str, result: Any) -> bool:
+        """Stores the result, False when the worker no longer held the lease and the result was dropped."""
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = True) -> str | None:
+        """Records a failed attempt, returns the new status (queued for a retry or failed), None without the lease."""
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job | None:
+        raise NotImplementedError("Subclasses must implement this method.")
+
+    @abstractmethod
+    def counts(self) -> dict[str, int]:
+        """Number of jobs per status."""
+        raise NotImplementedError("Subclasses must implement this method.")
+
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    worker_id TEXT,
+    lease_until REAL,
+    available_at REAL NOT NULL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_runnable ON jobs (status, available_at);
+'''
+_COLUMNS = 'id, kind, payload, status, attempts, max_attempts, worker_id, lease_until, result, error, created_at, updated_at'
+
+
+class SQLiteJobQueue(JobQueue):
+    """
+    JobQueue in a local SQLite database, for web and worker processes on one box.
+
+    WAL mode lets readers (the web tier polling for results) work alongside
+    the single writer. Claims run in an IMMEDIATE transaction, which takes the
+    write lock up front, so two workers can never claim the same job.
+    """
+    def __init__(self, path: str = JOB_QUEUE_PATH):
+        self.path = path
+        self._local = threading.local()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().executescript(_SCHEMA)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, the web tier reads from its threadpool
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _write(self, fn):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = fn(connection)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def _job(row: tuple) -> Job:
+        (job_id, kind, payload, status, attempts, max_attempts, worker_id, lease_until, result, error, created_at, updated_at) = row
+        return Job(
+            job_id, kind, json.loads(payload), status, attempts, max_attempts, worker_id, lease_until,
+            json.loads(result) if result is not None else None, error, created_at, updated_at,
+        )
+
+    def _select(self, connection: sqlite3.Connection, job_id: str) -> Job | None:
+        row = connection.execute(f'SELECT {_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def enqueue(self, kind: str, payload: dict[str, Any], job_id: str | None = None, max_attempts: int = JOB_MAX_ATTEMPTS) -> Job:
+        job_id = job_id or str(uuid.uuid4())
+        encoded = json.dumps(payload, separators=(',', ':'))
+
+        def write(connection: sqlite3.Connection) -> Job:
+            now = time.time()
+            connection.execute(
+                '''INSERT INTO jobs (id, kind, payload, status, max_attempts, available_at, created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (id) DO UPDATE SET
+                       payload = excluded.payload, status = excluded.status, attempts = 0,
+                       max_attempts = excluded.max_attempts, worker_id = NULL, lease_until = NULL,
+                       available_at = excluded.available_at, result = NULL, error = NULL, updated_at = excluded.updated_at
+                   WHERE jobs.status IN (?, ?)''',
+                (job_id, kind, encoded, QUEUED, max_attempts, now, now, now, DONE, FAILED),
+            )
+            return cast(Job, self._select(connection, job_id))
+        return self._write(write)
+
+    def claim(self, worker_id: str, kinds: list[str] | None = None, lease_s: float = JOB_LEASE_S) -> Job | None:
+        kind_filter = f'AND kind IN ({", ".join("?" * len(kinds))})' if kinds else ''
+
+        def write(connection: sqlite3.Connection) -> Job | None:
+            now = time.time()
+            # Jobs whose worker died on their last attempt are not handed out again
+            connection.execute(
+                f'''UPDATE jobs SET status = ?, error = 'Lease expired on the last attempt', worker_id = NULL,
+                        lease_until = NULL, updated_at = ?
+                    WHERE status = ? AND lease_until < ? AND attempts >= max_attempts {kind_filter}''',
+                (FAILED, now, RUNNING, now, *(kinds or ())),
+            )
+            row = connection.execute(
+                f'''SELECT id FROM jobs
+                    WHERE ((status = ? AND available_at <= ?) OR (status = ? AND lease_until < ?)) {kind_filter}
+                    ORDER BY available_at LIMIT 1''',
+                (QUEUED, now, RUNNING, now, *(kinds or ())),
+            ).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                '''UPDATE jobs SET status = ?, attempts = attempts + 1, worker_id = ?, lease_until = ?, updated_at = ?
+                   WHERE id = ?''',
+                (RUNNING, worker_id, now + lease_s, now, row[0]),
+            )
+            return self._select(connection, row[0])
+        return self._write(write)
+
+    def heartbeat(self, job_id: str, worker_id: str, lease_s: float = JOB_LEASE_S) -> bool:
+        now = time.time()
+        cursor = self._connection().execute(
+            'UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ? AND worker_id = ?',
+            (now + lease_s, now, job_id, RUNNING, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: Any) -> bool:
+        cursor = self._connection().execute(
+            '''UPDATE jobs SET status = ?, result = ?, error = NULL, worker_id = NULL, lease_until = NULL, updated_at = ?
+               WHERE id = ? AND status = ? AND worker_id = ?''',
+            (DONE, json.dumps(result, separators=(',', ':')), time.time(), job_id, RUNNING, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str, retry: bool = True) -> str | None:
+        def write(connection: sqlite3.Connection) -> str | None:
+            job = self._select(connection, job_id)
+            if job is None or job.status != RUNNING or job.worker_id != worker_id:
+                return None
+            now = time.time()
+            status = QUEUED if retry and job.attempts < job.max_attempts else FAILED
+            connection.execute(
+                '''UPDATE jobs SET status = ?, error = ?, worker_id = NULL, lease_until = NULL, available_at = ?, updated_at = ?
+                   WHERE id = ?''',
+                (status, error, now + JOB_RETRY_BACKOFF_S * 2 ** (job.attempts - 1), now, job_id),
+            )
+            return status
+        return self._write(write)
+
+    def get(self, job_id: str) -> Job | None:
+        return self._select(self._connection(), job_id)
+
+    def counts(self) -> dict[str, int]:
+        rows = self._connection().execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall()
+        return {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0, **dict(rows)}
+
+
+_job_queue: JobQueue | None = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue | None:
+    """The configured queue, None when jobs run inside the web process."""
+    global _job_queue
+    if not JOB_QUEUE:
+        return None
+    with _job_queue_lock:
+        if _job_queue is None:
+            match JOB_QUEUE:
+                case 'sqlite':
+                    _job_queue = SQLiteJobQueue(JOB_QUEUE_PATH)
+                case _:
+                    raise ValueError(f'Unknown job queue: {JOB_QUEUE}')
+        return _job_queue
@@ -0,0 +1,56 @@
+import logging
+from pathlib import Path
+from typing import Any, Callable
+
+from promptbeatai.ai.providers import get_song_generator_client
+from promptbeatai.app.entities.generation_prompt import GenerationPrompt
+from promptbeatai.app.render.cache import diff_remix, get_encoded
+from promptbeatai.app.render.cost import RenderBudgetExceeded, admit_song
+from promptbeatai.app.render.formats import AUDIO_FORMATS, AudioVariant
+from promptbeatai.jobs.queue import PermanentJobError
+from promptbeatai.loopmaker.blocks import RenderMemoryExceeded
+from promptbeatai.loopmaker.serialize import song_fingerprint, song_from_json, song_to_json
+from promptbeatai.loopmaker.core import Song
+
+
+def generate_payload(prompt: GenerationPrompt) -> dict[str, Any]:
+    return {'prompt': prompt.model_dump()}
+
+
+def run_generate(payload: dict[str, Any]) -> dict[str, Any]:
+    """Asks the provider for a song and returns its JSON, as GET /song/{id} serves it."""
+    prompt = GenerationPrompt(**payload['prompt'])
+    try:
+        song = admit_song(get_song_generator_client().request_song(prompt))
+    except RenderBudgetExceeded as e:
+        raise PermanentJobError(f'Rejected song: {e}')
+    if prompt.reference_composition:
+        diff_remix(prompt.reference_composition, song)
+    return song_to_json(song)
+
+
+def render_job_id(song: Song, variant: AudioVariant) -> str:
+    # One job per render, concurrent requests for it share the job
+    return f'render-{song_fingerprint(song)}-{variant.key}'
+
+
+def render_payload(song: Song, variant: AudioVariant) -> dict[str, Any]:
+    return {'song': song_to_json(song), 'format': variant.format.name, 'bitrate': variant.bitrate, 'mono': variant.mono}
+
+
+def run_render(payload: dict[str, Any]) -> dict[str, Any]:
+    """Renders and encodes into the shared render cache, returns the path of the encoded file."""
+    song = song_from_json(payload['song'])
+    variant = AudioVariant(AUDIO_FORMATS[payload['format']], payload['bitrate'], payload['mono'])
+    try:
+        path = get_encoded(song, variant)
+    except RenderMemoryExceeded as e:
+        raise PermanentJobError(f'Song too large to render: {e}')
+    logging.info(f'Rendered {path}')
+    return {'path': str(Path(path).resolve())}
+
+
+HANDLERS: dict[str, Callable[[dict[str, Any]], Any]] = {
+    'generate': run_generate,
+    'render': run_render,
+}
@@ -0,0 +1,136 @@
+"""
+Run generation and render jobs from the job queue, outside the web processes.
+
+Usage (from the repository root, with the same environment as the API):
+    JOB_QUEUE=sqlite PYTHONPATH=promptbeatai python -m promptbeatai.jobs.worker --kinds generate --processes 4
+    JOB_QUEUE=sqlite PYTHONPATH=promptbeatai python -m promptbeatai.jobs.worker --kinds render --processes 8
+
+Generation mostly waits on the LLM provider, rendering is CPU bound, so the
+two are usually run as separate pools: a few generate workers and one render
+worker per core. Each process claims one job at a time and heartbeats its
+lease while the job runs. SIGTERM or Ctrl-C stops claiming, the running job
+is finished first.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import uuid
+from typing import cast
+
+from promptbeatai.jobs.queue import JOB_LEASE_S, JobQueue, PermanentJobError, SQLiteJobQueue, get_job_queue
+from promptbeatai.jobs.tasks import HANDLERS
+from promptbeatai.loopmaker.serialize import enable_instrument_cache, warm_instruments
+
+
+JOB_POLL_INTERVAL_S = float(os.getenv('JOB_POLL_INTERVAL_S', 0.2))
+
+
+def _heartbeat(queue: JobQueue, job_id: str, worker_id: str, lease_s: float, done: threading.Event):
+    while not done.wait(lease_s / 3):
+        if not queue.heartbeat(job_id, worker_id, lease_s):
+            logging.warning(f'{worker_id} lost the lease on job {job_id}, its result will be dropped')
+            return
+
+
+def run_one(queue: JobQueue, worker_id: str, kinds: list[str], lease_s: float = JOB_LEASE_S) -> bool:
+    """Claims and runs one job, False when there was nothing to claim."""
+    job = queue.claim(worker_id, kinds, lease_s)
+    if job is None:
+        return False
+    logging.info(f'{worker_id} running {job.kind} job {job.id}, attempt {job.attempts}/{job.max_attempts}')
+    done = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(queue, job.id, worker_id, lease_s, done), daemon=True)
+    heartbeat.start()
+    start = time.perf_counter()
+    try:
+        result = HANDLERS[job.kind](job.payload)
+    except PermanentJobError as e:
+        queue.fail(job.id, worker_id, str(e), retry=False)
+        logging.error(f'Job {job.id} failed: {e}')
+    except Exception as e:
+        status = queue.fail(job.id, worker_id, f'{type(e).__name__}: {e}')
+        logging.error(f'Job {job.id} attempt {job.attempts} failed ({status}): {e}')
+    else:
+        queue.complete(job.id, worker_id, result)
+        logging.info(f'Job {job.id} done in {time.perf_counter() - start:.2f}s')
+    finally:
+        done.set()
+        heartbeat.join()
+    return True
+
+
+def work(kinds: list[str], lease_s: float = JOB_LEASE_S, queue: JobQueue | None = None, warmup: bool = False):
+    queue = queue or get_job_queue()
+    if queue is None:
+        raise RuntimeError('No job queue configured, set JOB_QUEUE=sqlite')
+    # Samples are decoded once per worker process and reused across jobs
+    enable_instrument_cache()
+    if warmup:
+        warm_instruments()
+    worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+    logging.info(f'Worker {worker_id} started for {", ".join(kinds)}')
+    while not stopping.is_set():
+        if not run_one(queue, worker_id, kinds, lease_s):
+            stopping.wait(JOB_POLL_INTERVAL_S)
+    logging.info(f'Worker {worker_id} stopped')
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kinds', default=','.join(HANDLERS), help=f'Comma separated job kinds to run ({", ".join(HANDLERS)})')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--lease', type=float, default=JOB_LEASE_S, help='Lease length in seconds, heartbeats renew it every third')
+    parser.add_argument('--warmup', action='store_true', help='Decode every sample under SAMPLE_FOLDER before claiming jobs')
+    parser.add_argument('--queue-path', default=None, help='SQLite database, overrides JOB_QUEUE_PATH')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+
+    kinds = [k.strip() for k in args.kinds.split(',') if k.strip()]
+    unknown = [k for k in kinds if k not in HANDLERS]
+    if unknown:
+        print(f'Unknown job kinds: {", ".join(unknown)}', file=sys.stderr)
+        return 2
+    queue = SQLiteJobQueue(args.queue_path) if args.queue_path else get_job_queue()
+    if queue is None:
+        print('No job queue configured, set JOB_QUEUE=sqlite or pass --queue-path', file=sys.stderr)
+        return 2
+
+    if args.processes == 1:
+        work(kinds, args.lease, queue, args.warmup)
+        return 0
+    # Each process opens its own connection, SQLite connections don't survive a fork
+    processes = [
+        multiprocessing.Process(target=_work_process, args=(kinds, args.lease, cast(SQLiteJobQueue, queue).path, args.warmup), name=f'worker-{i}')
+        for i in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def stop(*_):
+        # Workers finish their running job before they exit
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in processes:
+        process.join()
+    return 0
+
+
+def _work_process(kinds: list[str], lease_s: float, queue_path: str, warmup: bool):
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    work(kinds, lease_s, SQLiteJobQueue(queue_path), warmup)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
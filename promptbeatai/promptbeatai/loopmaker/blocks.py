@@ -0,0 +1,302 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+from pydub import AudioSegment
+
+from promptbeatai.loopmaker.core import SAMPLE_DTYPES, Loop, Song, SoundGenerator, _notify_render
+from promptbeatai.loopmaker.piano import Piano
+from promptbeatai.loopmaker.sampler import Sampler
+from promptbeatai.loopmaker.serialize import stem_fingerprint
+from promptbeatai.loopmaker.synth import SimpleSynth
+
+
+DEFAULT_BLOCK_MS = 10_000
+# Loop.generate overlays every hit onto a fresh copy of the loop canvas, a loop being rendered needs about this many copies
+LOOP_RENDER_COPIES = 3
+# Song.generate starts from AudioSegment.silent, whose format is the floor of the mix
+_CANVAS_FRAME_RATE, _CANVAS_CHANNELS, _CANVAS_SAMPLE_WIDTH = 11025, 1, 2
+# Generators of other types are budgeted as CD audio
+_DEFAULT_FORMAT = (44100, 2, 2)
+
+
+class RenderMemoryExceeded(MemoryError):
+    pass
+
+
+class StemStore(ABC):
+    """Rendered stems (single tracks of a loop) by stem_fingerprint, shared between songs."""
+    @abstractmethod
+    def get(self, key: str) -> AudioSegment | None:
+        pass
+
+    @abstractmethod
+    def put(self, key: str, audio: AudioSegment):
+        pass
+
+
+def _widest_format(formats: Iterable[tuple[int, int, int]]) -> tuple[int, int, int]:
+    """Frame rate, channels and sample width AudioSegment.overlay mixes sounds of these formats at."""
+    frame_rate, channels, sample_width = _CANVAS_FRAME_RATE, _CANVAS_CHANNELS, _CANVAS_SAMPLE_WIDTH
+    for fmt_rate, fmt_channels, fmt_width in formats:
+        frame_rate = max(frame_rate, fmt_rate)
+        channels = max(channels, fmt_channels)
+        sample_width = max(sample_width, fmt_width)
+    return frame_rate, channels, sample_width if sample_width in SAMPLE_DTYPES else 4
+
+
+def _mix_format(segments: list[AudioSegment]) -> tuple[int, int, int]:
+    """Frame rate, channels and sample width AudioSegment.overlay would mix the segments at."""
+    return _widest_format((audio.frame_rate, audio.channels, audio.sample_width) for audio in segments)
+
+
+def _generator_formats(gen: SoundGenerator) -> list[tuple[int, int, int]]:
+    """Formats of the sounds a generator makes, known before it renders anything."""
+    if isinstance(gen, SimpleSynth):
+        return [(gen.sample_rate, 1, 2)]
+    if isinstance(gen, Sampler):
+        return [(gen.sound.frame_rate, gen.sound.channels, gen.sound.sample_width)]
+    if isinstance(gen, Piano):
+        return [(s.frame_rate, s.channels, s.sample_width) for s in gen.samples.values()]
+    return [_DEFAULT_FORMAT]
+
+
+def _loop_format(loop: Loop) -> tuple[int, int, int]:
+    """The format a loop renders at: the widest of its sounding tracks' generators."""
+    return _widest_format(
+        fmt for track in loop.tracks.values() if not track.mute and len(track.hits) for fmt in _generator_formats(track.gen)
+    )
+
+
+def _bytes(duration_ms: int, fmt: tuple[int, int, int], sample_bytes: int | None = None) -> int:
+    """Size of duration_ms of audio in a format, with samples of sample_bytes instead of its width when given."""
+    frame_rate, channels, sample_width = fmt
+    return int(frame_rate * duration_ms / 1000) * channels * (sample_bytes or sample_width)
+
+
+def _samples(audio: AudioSegment, frame_rate: int, channels: int, sample_width: int) -> np.ndarray:
+    audio = audio.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+    return np.frombuffer(audio.raw_data, dtype=SAMPLE_DTYPES[sample_width]).reshape(-1, channels)
+
+
+def _sum_stems(
+    stems: Iterable[AudioSegment], duration_ms: int, fmt: tuple[int, int, int],
+) -> tuple[AudioSegment, tuple[int, int, int]]:
+    """
+    Stems summed into one segment of duration_ms at fmt, one at a time, and
+    the format overlaying them would have mixed at.
+    """
+    frame_rate, channels, sample_width = fmt
+    frames = int(frame_rate * duration_ms / 1000)
+    mix = np.zeros((frames, channels), dtype=np.int64)
+    formats = []
+    for stem in stems:
+        formats.append((stem.frame_rate, stem.channels, stem.sample_width))
+        samples = _samples(stem, frame_rate, channels, sample_width)[:frames]
+        mix[:len(samples)] += samples
+        # Not held while the next stem renders
+        del stem, samples
+    if not formats:
+        return AudioSegment.silent(duration=duration_ms), _widest_format(formats)
+    info = np.iinfo(SAMPLE_DTYPES[sample_width])
+    data = np.clip(mix, info.min, info.max, out=mix).astype(SAMPLE_DTYPES[sample_width]).tobytes()
+    return AudioSegment(data, frame_rate=frame_rate, sample_width=sample_width, channels=channels), _widest_format(formats)
+
+
+def loop_stems(song: Song, loop: Loop, stems: StemStore | None = None) -> Iterator[tuple[str, AudioSegment]]:
+    """
+    Every track of the loop that sounds (not muted, with hits) rendered alone,
+    by name. Taken from the stem store when it has them, stored when rendered.
+    """
+    for name, track in loop.tracks.items():
+        if track.mute or not len(track.hits):
+            continue
+        key = stem_fingerprint(song, loop, name) if stems is not None else None
+        stem = stems.get(key) if stems is not None else None
+        if stem is None:
+            start = time.perf_counter()
+            stem = loop.generate_track(name, song.bpm, song.beats_per_bar, song.steps_per_beat)
+            _notify_render('track', name, track, start)
+            if stems is not None:
+                stems.put(key, stem)
+        yield name, stem
+
+
+def mix_loop_stems(
+    song: Song, loop: Loop, stems: StemStore | None = None, on_stem: Callable[[str, AudioSegment], None] | None = None,
+) -> AudioSegment:
+    """
+    The loop mixed from its stems (see loop_stems), like overlaying them onto
+    a silent canvas would but holding one stem at a time. on_stem sees every
+    stem as it is mixed.
+
+    The mix format is taken from the generators' samples up front. A piano
+    only uses some of its samples, when those are narrower than the others the
+    stems are mixed again at their own format, from the store when there is one.
+    """
+    loop_ms = loop.duration_ms(song.bpm, song.beats_per_bar, song.steps_per_beat)
+
+    def each_stem(on_stem):
+        for name, stem in loop_stems(song, loop, stems):
+            if on_stem is not None:
+                on_stem(name, stem)
+            yield stem
+            del stem
+
+    fmt = _loop_format(loop)
+    audio, stems_format = _sum_stems(each_stem(on_stem), loop_ms, fmt)
+    if stems_format == fmt:
+        return audio
+    del audio
+    return _sum_stems(each_stem(None), loop_ms, stems_format)[0]
+
+
+class BlockRenderer:
+    """
+    Renders a song one fixed-size block of the timeline at a time instead of
+    onto a full-length canvas that every overlay copies. Each loop is rendered
+    once, a block sums the repetitions overlapping it and a repetition still
+    sounding at the end of a block carries over into the next one. Memory is
+    the rendered loops plus one block, whatever the song's duration, and
+    memory_limit_bytes is checked before anything is rendered. The check counts
+    the audio the renderer holds in the formats it will have; what a generator
+    allocates while it renders is approximated (see LOOP_RENDER_COPIES).
+
+    With a stem store, loops are mixed from their tracks' stems and only the
+    stems missing from the store are rendered (and stored), so a song that
+    shares tracks with one rendered before only renders what changed.
+
+    Repetitions are placed like Song.generate places them (see Song.placements),
+    the mix is summed and clipped once instead of after every overlay.
+    """
+    def __init__(
+        self, song: Song, block_ms: int = DEFAULT_BLOCK_MS, memory_limit_bytes: int | None = None, stems: StemStore | None = None,
+    ):
+        self.song = song
+        self.block_ms = block_ms
+        self.memory_limit_bytes = memory_limit_bytes
+        self.stems = stems
+        self.frame_rate = _CANVAS_FRAME_RATE
+        self.channels = _CANVAS_CHANNELS
+        self.sample_width = _CANVAS_SAMPLE_WIDTH
+        self.frames = 0
+        self._loops: dict[int, np.ndarray] = {}
+        # (id of the loop, first frame, repetitions)
+        self._placements: list[tuple[int, int, int]] = []
+        self._prepared = False
+
+    @property
+    def block_frames(self) -> int:
+        return max(1, int(self.frame_rate * self.block_ms / 1000))
+
+    def _check_memory(self, needed: int, what: str):
+        if self.memory_limit_bytes is not None and needed > self.memory_limit_bytes:
+            raise RenderMemoryExceeded(
+                f'{what} needs about {needed / 2**20:.0f} MB, over the {self.memory_limit_bytes / 2**20:.0f} MB render limit'
+            )
+
+    def _render_loop(self, loop: Loop) -> AudioSegment:
+        song = self.song
+        if self.stems is None:
+            return loop.generate(song.bpm, song.beats_per_bar, song.steps_per_beat)
+        return mix_loop_stems(song, loop, self.stems)
+
+    def _render_bytes(self, loop: Loop, loop_ms: int, fmt: tuple[int, int, int]) -> int:
+        """Memory rendering one loop takes on top of the loops rendered before, apply_gain's copy included."""
+        if self.stems is None:
+            return LOOP_RENDER_COPIES * _bytes(loop_ms, fmt)
+        # The int64 mix, plus one stem at a time: rendered, or read and converted (two copies next to it)
+        return _bytes(loop_ms, fmt, 8) + max(LOOP_RENDER_COPIES, 3) * _bytes(loop_ms, fmt)
+
+    def _check_conversion(self, sizes: list[tuple[int, int]]):
+        """
+        Loops are converted to the mix format one at a time, (rendered, converted)
+        bytes each: the ones converted, the ones still to convert and two copies
+        of the one being converted (rate, channels and width change one after the other).
+        """
+        converted, remaining = 0, sum(rendered for rendered, _ in sizes)
+        for rendered, mixed in sizes:
+            self._check_memory(converted + remaining + 2 * mixed, 'Converting the loops to the mix format')
+            converted += mixed
+            remaining -= rendered
+
+    def prepare(self):
+        """
+        Renders every loop once and settles the output format. The peak memory
+        of each stage is estimated from the formats of the generators' samples
+        and checked before anything is rendered, then again with the sizes of
+        the loops actually rendered.
+        """
+        if self._prepared:
+            return
+        song = self.song
+        placements = [(lic, position_ms, times) for lic, position_ms, times in song.placements() if times > 0 and not lic.loop.mute]
+        # (index of the first placement, loop, duration) by id of the loop
+        loops: dict[int, tuple[int, Loop, int]] = {}
+        for index, (lic, _, _) in enumerate(placements):
+            if id(lic.loop) not in loops:
+                loops[id(lic.loop)] = (index, lic.loop, lic.loop.duration_ms(song.bpm, song.beats_per_bar, song.steps_per_beat))
+        formats = {loop_id: _loop_format(loop) for loop_id, (_, loop, _) in loops.items()}
+        mix_format = _widest_format(formats.values())
+
+        kept_bytes = 0
+        for loop_id, (index, loop, loop_ms) in loops.items():
+            self._check_memory(kept_bytes + self._render_bytes(loop, loop_ms, formats[loop_id]), f'Loop {index} ({loop.bars} bars)')
+            kept_bytes += _bytes(loop_ms, formats[loop_id])
+        self._check_conversion([(_bytes(ms, formats[loop_id]), _bytes(ms, mix_format)) for loop_id, (_, _, ms) in loops.items()])
+        # A block is summed in int64 and clipped into a copy in the mix format
+        block_bytes = _bytes(self.block_ms, mix_format, 8) + _bytes(self.block_ms, mix_format)
+        self._check_memory(sum(_bytes(ms, mix_format) for _, _, ms in loops.values()) + block_bytes, 'Mixing the song')
+
+        kept_bytes = 0
+        rendered: dict[int, AudioSegment] = {}
+        for loop_id, (index, loop, loop_ms) in loops.items():
+            # Rendered loops can be larger than their samples' formats say, e.g. generators of unknown types
+            self._check_memory(kept_bytes + self._render_bytes(loop, loop_ms, formats[loop_id]), f'Loop {index} ({loop.bars} bars)')
+            start = time.perf_counter()
+            rendered[loop_id] = self._render_loop(loop).apply_gain(loop.gain)
+            _notify_render('loop', str(index), placements[index][0], start)
+            kept_bytes += len(rendered[loop_id].raw_data)
+
+        self.frame_rate, self.channels, self.sample_width = _mix_format(list(rendered.values()))
+        mix_format = (self.frame_rate, self.channels, self.sample_width)
+        self._check_conversion([(len(audio.raw_data), _bytes(len(audio), mix_format)) for audio in rendered.values()])
+        for loop_id in list(rendered):
+            # The rendered loop is dropped as soon as it is converted
+            self._loops[loop_id] = _samples(rendered.pop(loop_id), self.frame_rate, self.channels, self.sample_width)
+
+        self.frames = int(self.frame_rate * song.duration_ms / 1000)
+        self._placements = [
+            (id(lic.loop), int(position_ms * self.frame_rate / 1000), times) for lic, position_ms, times in placements
+            if len(self._loops[id(lic.loop)])
+        ]
+        self._prepared = True
+
+    def _mix_block(self, first: int, last: int) -> np.ndarray:
+        block = np.zeros((last - first, self.channels), dtype=np.int64)
+        for loop_id, start, times in self._placements:
+            audio = self._loops[loop_id]
+            loop_frames = len(audio)
+            end = min(start + times * loop_frames, self.frames)
+            frame = max(first, start)
+            while frame < min(last, end):
+                # Within one repetition of the loop
+                offset = (frame - start) % loop_frames
+                count = min(loop_frames - offset, min(last, end) - frame)
+                block[frame - first:frame - first + count] += audio[offset:offset + count]
+                frame += count
+        info = np.iinfo(SAMPLE_DTYPES[self.sample_width])
+        return np.clip(block, info.min, info.max, out=block).astype(SAMPLE_DTYPES[self.sample_width])
+
+    def blocks(self) -> Iterator[np.ndarray]:
+        """The song as (frames, channels) sample arrays of block_ms each, the last one shorter."""
+        self.prepare()
+        for first in range(0, self.frames, self.block_frames):
+            yield self._mix_block(first, min(first + self.block_frames, self.frames))
+
+    def render(self) -> AudioSegment:
+        """The whole song as one AudioSegment, for callers that need it in memory anyway."""
+        self.prepare()
+        data = b''.join(block.tobytes() for block in self.blocks())
+        return AudioSegment(data, frame_rate=self.frame_rate, sample_width=self.sample_width, channels=self.channels)
@@ -1,10 +1,28 @@
+import functools
+import time
 from abc import ABC, abstractmethod
+from collections.abc import Iterable, Iterator, Sequence
 from dataclasses import dataclass
-from typing import TypedDict
+from typing import Callable, TypedDict, overload
+import numpy as np
 from pydub import AudioSegment
 
 
 DEFAULT_NOTE = 'C5'
+# Fade applied where a sound is cut short, a hard cut clicks
+CUT_FADE_MS = 5
+
+# Called as observer(kind, name, obj, seconds) after a loop ('loop', index, LoopInContext)
+# or a track ('track', name, Track) has been rendered, used for metrics and profiling
+render_observers: list[Callable[[str, str, object, float], None]] = []
+
+
+def _notify_render(kind: str, name: str, obj: object, start: float):
+    if render_observers:
+        elapsed = time.perf_counter() - start
+        for observer in render_observers:
+            observer(kind, name, obj, elapsed)
+
 
 _NOTE_TO_SEMITONE = {
     'C': 0,  'C#': 1, 'Db': 1,
@@ -51,6 +69,37 @@ class Note:
         return self.name
 
 
+SAMPLE_DTYPES = {1: np.int8, 2: np.int16, 4: np.int32}
+
+
+@functools.lru_cache(maxsize=32)
+def _fade_ramp(frames: int) -> np.ndarray:
+    ramp = np.linspace(1.0, 0.0, frames, endpoint=False)[:, None]
+    ramp.flags.writeable = False
+    return ramp
+
+
+def cut_sound(sound: AudioSegment, length_ms: int, fade_ms: int = CUT_FADE_MS) -> AudioSegment:
+    """The first length_ms of the sound, fading out linearly over the last fade_ms instead of stopping dead."""
+    if length_ms >= len(sound):
+        return sound
+    if length_ms <= 0:
+        return sound[:0]
+    dtype = SAMPLE_DTYPES.get(sound.sample_width)
+    if dtype is None:
+        return sound[:length_ms].fade_out(min(fade_ms, length_ms))
+    # AudioSegment.fade_out works in 1 ms slices, far too slow to run on every hit.
+    # The cut is at the frame AudioSegment slicing would pick, the buffer is only copied once
+    end_frame = int(sound.frame_count(ms=length_ms))
+    raw = sound.raw_data
+    fade_frames = min(end_frame, int(sound.frame_rate * fade_ms / 1000))
+    if fade_frames == 0:
+        return sound._spawn(raw[:end_frame * sound.frame_width])
+    frames = np.frombuffer(raw, dtype=dtype, count=end_frame * sound.channels).reshape(-1, sound.channels)
+    tail = (frames[-fade_frames:] * _fade_ramp(fade_frames)).astype(dtype)
+    return sound._spawn(raw[:(end_frame - fade_frames) * sound.frame_width] + tail.tobytes())
+
+
 class SoundGenerator(ABC):
     @abstractmethod
     def generate(self, note: Note, duration_ms: int) -> AudioSegment:
@@ -66,23 +115,202 @@ class Hit(TypedDict):
     steps: float
 
 
+@functools.lru_cache(maxsize=256)
+def _midi_from_name(name: str) -> int:
+    return Note.from_name(name).midi
+
+
+@functools.lru_cache(maxsize=256)
+def _name_from_midi(midi: int) -> str:
+    return Note(midi).name
+
+
+def _column(values: list) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    The values as an array, plus which of them were ints when ints and floats
+    are mixed, so serializing gives back exactly what was parsed.
+    """
+    ints = [type(v) is int for v in values]
+    if all(ints):
+        return np.array(values, dtype=np.int32), None
+    return np.array(values, dtype=np.float64), np.array(ints) if any(ints) else None
+
+
+def _values(column: np.ndarray, ints: np.ndarray | None) -> list:
+    values = column.tolist()
+    if ints is None:
+        return values
+    return [int(v) if i else v for v, i in zip(values, ints.tolist())]
+
+
+def _value(column: np.ndarray, ints: np.ndarray | None, index: int):
+    value = column[index].item()
+    return int(value) if ints is not None and ints[index] else value
+
+
+class HitArray(Sequence):
+    """
+    Hits of a track as parallel NumPy arrays: start step, MIDI note and length
+    in steps, about 14 bytes per hit instead of a dict and a Note object.
+    A float column that also holds ints keeps a mask of them in step_ints and
+    steps_ints (None otherwise).
+
+    Indexing and iterating give Hit dicts, so code written for list[Hit] keeps
+    working. Those dicts are copies, changes to them are not written back; use
+    append or the arrays themselves.
+    """
+    __slots__ = ('step', 'midi', 'steps', 'step_ints', 'steps_ints')
+
+    def __init__(
+        self,
+        step: np.ndarray,
+        midi: np.ndarray,
+        steps: np.ndarray,
+        step_ints: np.ndarray | None = None,
+        steps_ints: np.ndarray | None = None,
+    ):
+        if not len(step) == len(midi) == len(steps):
+            raise ValueError('Hit columns must have the same length')
+        self.step = step
+        self.midi = midi
+        self.steps = steps
+        self.step_ints = step_ints
+        self.steps_ints = steps_ints
+
+    @classmethod
+    def from_hits(cls, hits: Iterable[Hit]) -> 'HitArray':
+        hits = list(hits)
+        step, step_ints = _column([h['step'] for h in hits])
+        steps, steps_ints = _column([h['steps'] for h in hits])
+        return cls(step, np.array([h['note'].midi for h in hits], dtype=np.int16), steps, step_ints, steps_ints)
+
+    @classmethod
+    def from_json(cls, hits_json: list[dict]) -> 'HitArray':
+        """Bulk constructor from the JSON hit list, which is left untouched."""
+        midi = []
+        for hit_json in hits_json:
+            note = hit_json.get('note', DEFAULT_NOTE)
+            midi.append(note.midi if isinstance(note, Note) else _midi_from_name(note))
+        step, step_ints = _column([h['step'] for h in hits_json])
+        steps, steps_ints = _column([h['steps'] for h in hits_json])
+        return cls(step, np.array(midi, dtype=np.int16), steps, step_ints, steps_ints)
+
+    def to_json(self) -> list[dict]:
+        return [
+            {'step': step, 'note': _name_from_midi(midi), 'steps': steps}
+            for step, midi, steps in zip(
+                _values(self.step, self.step_ints), self.midi.tolist(), _values(self.steps, self.steps_ints),
+            )
+        ]
+
+    def select(self, index: slice | np.ndarray) -> 'HitArray':
+        """The hits at a slice, index array or boolean mask, as a HitArray."""
+        def masked(ints: np.ndarray | None) -> np.ndarray | None:
+            return None if ints is None else ints[index]
+        return HitArray(
+            self.step[index], self.midi[index], self.steps[index], masked(self.step_ints), masked(self.steps_ints),
+        )
+
+    def __len__(self) -> int:
+        return len(self.step)
+
+    @overload
+    def __getitem__(self, index: int) -> Hit: ...
+    @overload
+    def __getitem__(self, index: slice) -> 'HitArray': ...
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.select(index)
+        return Hit(
+            step=_value(self.step, self.step_ints, index),
+            note=Note(int(self.midi[index])),
+            steps=_value(self.steps, self.steps_ints, index),
+        )
+
+    def __iter__(self) -> Iterator[Hit]:
+        for step, midi, steps in zip(
+            _values(self.step, self.step_ints), self.midi.tolist(), _values(self.steps, self.steps_ints),
+        ):
+            yield Hit(step=step, note=Note(midi), steps=steps)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (HitArray, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f'HitArray({len(self)} hits)'
+
+    def append(self, hit: Hit):
+        """Rebuilds the arrays, for occasional edits only."""
+        self.step, self.step_ints = _column(_values(self.step, self.step_ints) + [hit['step']])
+        self.midi = np.append(self.midi, np.int16(hit['note'].midi))
+        self.steps, self.steps_ints = _column(_values(self.steps, self.steps_ints) + [hit['steps']])
+
+
+def hit_columns(hits: 'list[Hit] | HitArray') -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(step, midi, steps) arrays of the hits, without copying when they already are a HitArray."""
+    if isinstance(hits, HitArray):
+        return hits.step, hits.midi, hits.steps
+    return (
+        np.array([h['step'] for h in hits], dtype=np.float64),
+        np.array([h['note'].midi for h in hits], dtype=np.int16),
+        np.array([h['steps'] for h in hits], dtype=np.float64),
+    )
+
+
 @dataclass
 class Track:
     gen: SoundGenerator
-    hits: list[Hit]
+    hits: list[Hit] | HitArray
     gain: float = 0.0
     mute: bool = False
+    # At most this many voices sound at once, a new hit cuts the oldest one (voice stealing). None: unlimited
+    polyphony: int | None = None
+    # A hit cuts every voice still sounding in tracks of the same loop with the same group, e.g. open/closed hi-hats
+    choke_group: str | None = None
 
-    def _overlay_on_loop_canvas(self, canvas: AudioSegment, step_duration_ms: int) -> AudioSegment:
+    def _overlay_on_loop_canvas(self, canvas: AudioSegment, step_duration_ms: int, choke_times: np.ndarray | None = None) -> AudioSegment:
         if self.mute:
             return canvas
 
-        for hit in self.hits:
-            position_ms = int(hit['step'] * step_duration_ms)
-            canvas = self.gen._overlay_on_canvas(canvas, hit['note'], int(hit['steps'] * step_duration_ms), position_ms, gain=self.gain)
+        if self.polyphony is None and choke_times is None:
+            for hit in self.hits:
+                position_ms = int(hit['step'] * step_duration_ms)
+                canvas = self.gen._overlay_on_canvas(canvas, hit['note'], int(hit['steps'] * step_duration_ms), position_ms, gain=self.gain)
+            return canvas
 
+        for position_ms, sound in self._voices(step_duration_ms, choke_times):
+            if len(sound):
+                canvas = canvas.overlay(sound.apply_gain(self.gain), position=position_ms)
         return canvas
 
+    def _voices(self, step_duration_ms: int, choke_times: np.ndarray | None = None) -> list[tuple[int, AudioSegment]]:
+        """
+        (position, sound) of every hit in time order, cut short when a later
+        hit of the choke group starts or when the polyphony limit steals the voice.
+        """
+        steps, _, _ = hit_columns(self.hits)
+        voices: list[tuple[int, AudioSegment]] = []
+        # Indices of the voices still sounding, oldest first
+        sounding: list[int] = []
+        for i in np.argsort(steps, kind='stable'):
+            hit = self.hits[int(i)]
+            position_ms = int(hit['step'] * step_duration_ms)
+            sound = self.gen.generate(hit['note'], int(hit['steps'] * step_duration_ms))
+            if choke_times is not None:
+                next_choke = np.searchsorted(choke_times, position_ms, side='right')
+                if next_choke < len(choke_times):
+                    sound = cut_sound(sound, int(choke_times[next_choke]) - position_ms)
+            sounding = [v for v in sounding if voices[v][0] + len(voices[v][1]) > position_ms]
+            if self.polyphony is not None and len(sounding) >= self.polyphony:
+                stolen = sounding.pop(0)
+                stolen_position_ms, stolen_sound = voices[stolen]
+                voices[stolen] = (stolen_position_ms, cut_sound(stolen_sound, position_ms - stolen_position_ms))
+            voices.append((position_ms, sound))
+            sounding.append(len(voices) - 1)
+        return voices
+
 
 class Loop:
     def __init__(self, bars: int = 4, gain: float = 0.0, mute: bool = False):
@@ -97,16 +325,43 @@ class Loop:
     def remove_track(self, name: str):
         self.tracks.pop(name, None)
 
-    def generate(self, bpm: int, beats_per_bar: int = 4, steps_per_beat: int = 4) -> AudioSegment:
-        step_duration_ms = int(60_000 / (bpm * steps_per_beat))
+    @staticmethod
+    def step_duration_ms(bpm: int, steps_per_beat: int = 4) -> int:
+        return int(60_000 / (bpm * steps_per_beat))
+
+    def choke_times(self, step_duration_ms: int) -> dict[str, np.ndarray]:
+        """Sorted start times (ms) of the hits of every choke group, muted tracks don't choke."""
+        groups: dict[str, list[np.ndarray]] = {}
+        for track in self.tracks.values():
+            if track.choke_group is not None and not track.mute:
+                steps, _, _ = hit_columns(track.hits)
+                groups.setdefault(track.choke_group, []).append((steps * step_duration_ms).astype(np.int64))
+        return {group: np.sort(np.concatenate(times)) for group, times in groups.items()}
+
+    def duration_ms(self, bpm: int, beats_per_bar: int = 4, steps_per_beat: int = 4) -> int:
         total_steps = self.bars * beats_per_bar * steps_per_beat
-        loop_duration_ms = int(total_steps * step_duration_ms)
+        return int(total_steps * self.step_duration_ms(bpm, steps_per_beat))
+
+    def generate(self, bpm: int, beats_per_bar: int = 4, steps_per_beat: int = 4) -> AudioSegment:
+        step_duration_ms = self.step_duration_ms(bpm, steps_per_beat)
+        loop_duration_ms = self.duration_ms(bpm, beats_per_bar, steps_per_beat)
         loop = AudioSegment.silent(duration=loop_duration_ms)
+        choke_times = self.choke_times(step_duration_ms)
 
-        for _, track in self.tracks.items():
-            loop = track._overlay_on_loop_canvas(loop, step_duration_ms)
+        for name, track in self.tracks.items():
+            start = time.perf_counter()
+            loop = track._overlay_on_loop_canvas(loop, step_duration_ms, choke_times.get(track.choke_group) if track.choke_group else None)
+            _notify_render('track', name, track, start)
 
         return loop
+
+    def generate_track(self, name: str, bpm: int, beats_per_bar: int = 4, steps_per_beat: int = 4) -> AudioSegment:
+        """One track of the loop rendered alone (a stem), chokes by the other tracks of its group included."""
+        step_duration_ms = self.step_duration_ms(bpm, steps_per_beat)
+        track = self.tracks[name]
+        choke_times = self.choke_times(step_duration_ms).get(track.choke_group) if track.choke_group else None
+        canvas = AudioSegment.silent(duration=self.duration_ms(bpm, beats_per_bar, steps_per_beat))
+        return track._overlay_on_loop_canvas(canvas, step_duration_ms, choke_times)
     
     def _overlay_on_canvas(self, canvas: AudioSegment, position_ms: int, bpm: int, times: int = 1, beats_per_bar: int = 4, steps_per_beat: int = 4) -> AudioSegment:
         if self.mute:
@@ -129,18 +384,46 @@ class Song:
         self.steps_per_beat = steps_per_beat
         self.loops_in_context: list[LoopInContext] = []
 
-    def generate(self) -> AudioSegment:
-        beat_duration_ms = int(60000 / self.bpm)
-        bar_duration_ms = beat_duration_ms * self.beats_per_bar
+    @property
+    def bar_duration_ms(self) -> int:
+        return int(60000 / self.bpm) * self.beats_per_bar
+
+    @property
+    def duration_ms(self) -> int:
         if self.loops_in_context:
             last_bar_excl = max([l.start_bar + l.loop.bars * l.repeat_times for l in self.loops_in_context])
         else:
             last_bar_excl = 1
-        duration_ms = last_bar_excl * bar_duration_ms
+        return last_bar_excl * self.bar_duration_ms
 
-        canvas = AudioSegment.silent(duration=duration_ms)
+    def placements(self) -> list[tuple[LoopInContext, int, int]]:
+        """
+        (loop in context, position in ms, repetitions) for every loop, with the
+        number of repetitions that actually end up on the canvas.
+
+        Mirrors AudioSegment.overlay: repeat_times 0 is a no-op, a negative value
+        loops until the end of the song, and repetitions past the end are dropped.
+        """
+        duration_ms = self.duration_ms
+        placements = []
+        for lic in self.loops_in_context:
+            position_ms = lic.start_bar * self.bar_duration_ms
+            loop_ms = lic.loop.duration_ms(self.bpm, self.beats_per_bar, self.steps_per_beat)
+            remaining_ms = duration_ms - position_ms
+            if lic.repeat_times == 0 or loop_ms <= 0 or remaining_ms <= 0:
+                times = 0
+            else:
+                fitting = -(-remaining_ms // loop_ms)
+                times = fitting if lic.repeat_times < 0 else min(lic.repeat_times, fitting)
+            placements.append((lic, position_ms, times))
+        return placements
+
+    def generate(self) -> AudioSegment:
+        bar_duration_ms = self.bar_duration_ms
+        canvas = AudioSegment.silent(duration=self.duration_ms)
 
-        for loop_in_context in self.loops_in_context:
+        for index, loop_in_context in enumerate(self.loops_in_context):
+            start = time.perf_counter()
             position_ms = loop_in_context.start_bar * bar_duration_ms
             canvas = loop_in_context.loop._overlay_on_canvas(
                 canvas, 
@@ -150,5 +433,6 @@ class Song:
                 beats_per_bar=self.beats_per_bar,
                 steps_per_beat=self.steps_per_beat
             )
+            _notify_render('loop', str(index), loop_in_context, start)
 
         return canvas
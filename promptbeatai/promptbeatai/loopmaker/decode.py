@@ -0,0 +1,120 @@
+import math
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from pydub import AudioSegment
+
+from promptbeatai.loopmaker.core import SAMPLE_DTYPES, cut_sound
+
+
+AUDIO_EXTENSIONS = {'.wav', '.mp3', '.flac', '.aiff', '.ogg', '.m4a'}
+# Decoding anything but WAV runs an ffmpeg subprocess, the threads mostly wait on it.
+# One pool per process, so loading several instruments at once still runs at most this many decoders
+SAMPLE_DECODE_WORKERS = int(os.getenv('SAMPLE_DECODE_WORKERS', min(16, 2 * (os.cpu_count() or 1))))
+# Sample tails quieter than this are cut off at load, so they aren't mixed on every hit. 'off' keeps them
+SAMPLE_TAIL_THRESHOLD_DBFS = os.getenv('SAMPLE_TAIL_THRESHOLD_DBFS', '-60')
+TAIL_FADE_MS = 10
+# Tails are searched from the end in chunks of this many frames
+TAIL_SCAN_FRAMES = 4096
+# Where each sample file's tail is cut, by path, size, mtime and threshold
+TAIL_CACHE_SIZE = 4096
+_tail_ends: dict[tuple[str, int, int, float], int | None] = {}
+
+_decode_pool: ThreadPoolExecutor | None = None
+_decode_pool_lock = threading.Lock()
+
+
+def _forget_pool_after_fork():
+    # The pool's threads don't exist in a forked child, it starts its own on first use
+    global _decode_pool
+    _decode_pool = None
+
+
+os.register_at_fork(after_in_child=_forget_pool_after_fork)
+
+
+def is_audio_file(path: Path) -> bool:
+    return path.is_file() and path.suffix.lower() in AUDIO_EXTENSIONS
+
+
+def _last_loud_frame(samples: np.ndarray, channels: int, limit: int) -> int | None:
+    """Index of the last frame with a sample beyond ±limit, scanning back from the end one chunk at a time."""
+    chunk = TAIL_SCAN_FRAMES * channels
+    end = len(samples)
+    while end > 0:
+        start = max(0, end - chunk)
+        part = samples[start:end]
+        # Compared in the sample type, no widened copy of the buffer. Most chunks are
+        # all quiet or end loud, min/max tell that without building a mask
+        if part.max() > limit or part.min() < -limit:
+            loud = np.flatnonzero((part > limit) | (part < -limit))
+            return (start + int(loud[-1])) // channels
+        end = start
+    return None
+
+
+def tail_end_ms(sound: AudioSegment, threshold_dbfs: float) -> int | None:
+    """Where trim_silent_tail cuts the sound, None when it is kept whole."""
+    dtype = SAMPLE_DTYPES.get(sound.sample_width)
+    if dtype is None or len(sound) <= TAIL_FADE_MS:
+        return None
+    # |sample| > threshold is |sample| > floor(threshold) for integer samples
+    limit = math.floor(sound.max_possible_amplitude * 10 ** (threshold_dbfs / 20))
+    samples = np.frombuffer(sound.raw_data, dtype=dtype)
+    # A loud frame from here on puts the cut past the end, the usual case for instruments
+    keep_from = max(0, -(-(len(sound) - TAIL_FADE_MS) * sound.frame_rate // 1000) - 1)
+    fade = samples[keep_from * sound.channels:]
+    if fade.max() > limit or fade.min() < -limit:
+        return None
+    last = _last_loud_frame(samples, sound.channels, limit)
+    if last is None:
+        # All of it is quiet, nothing to tell the tail from the rest
+        return None
+    end_ms = int((last + 1) * 1000 / sound.frame_rate) + TAIL_FADE_MS
+    return end_ms if end_ms < len(sound) else None
+
+
+def trim_silent_tail(sound: AudioSegment, threshold_dbfs: float) -> AudioSegment:
+    """Cuts the sound TAIL_FADE_MS after the last frame louder than threshold_dbfs, fading out over that."""
+    end_ms = tail_end_ms(sound, threshold_dbfs)
+    return sound if end_ms is None else cut_sound(sound, end_ms, TAIL_FADE_MS)
+
+
+def load_sample(path: Path) -> AudioSegment:
+    if SAMPLE_TAIL_THRESHOLD_DBFS.lower() in ('', 'off'):
+        return AudioSegment.from_file(path)
+    threshold = float(SAMPLE_TAIL_THRESHOLD_DBFS)
+    stat = os.stat(path)
+    key = (str(path), stat.st_size, stat.st_mtime_ns, threshold)
+    sound = AudioSegment.from_file(path)
+    # Songs load the same files over and over without the instrument cache, the tail is only searched once per file
+    if key not in _tail_ends:
+        if len(_tail_ends) >= TAIL_CACHE_SIZE:
+            _tail_ends.clear()
+        _tail_ends[key] = tail_end_ms(sound, threshold)
+    end_ms = _tail_ends[key]
+    return sound if end_ms is None else cut_sound(sound, end_ms, TAIL_FADE_MS)
+
+
+def decode_file(path: Path) -> tuple[AudioSegment, float]:
+    """The decoded (and tail trimmed) file and how many seconds that took."""
+    start = time.perf_counter()
+    audio = load_sample(path)
+    return audio, time.perf_counter() - start
+
+
+def decode_files(paths: list[Path]) -> list[Future]:
+    """
+    Starts decoding every file in the shared pool, one future of
+    (AudioSegment, seconds) per path, in order. Must not be called from a
+    decode thread, it would wait on a pool it occupies.
+    """
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ThreadPoolExecutor(max_workers=SAMPLE_DECODE_WORKERS, thread_name_prefix='sample-decode')
+    return [_decode_pool.submit(decode_file, path) for path in paths]
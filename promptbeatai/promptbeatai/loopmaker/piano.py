@@ -1,29 +1,58 @@
-from promptbeatai.loopmaker.core import Note, SoundGenerator
+from promptbeatai.loopmaker.core import SAMPLE_DTYPES, Note, SoundGenerator, cut_sound
+from promptbeatai.loopmaker.decode import decode_files, is_audio_file
 from pathlib import Path
 from pydub import AudioSegment
 from typing import cast, Dict
+import numpy as np
+
+
+# A note keeps sounding this long after its duration, fading out, like a released key
+PIANO_RELEASE_MS = 250
+
+
+def resample_nearest(sample: AudioSegment, ratio: float) -> AudioSegment:
+    """Speeds a sample up by ratio keeping its frame rate, picking the nearest frame instead of filtering. Cheap but aliases."""
+    dtype = SAMPLE_DTYPES[sample.sample_width]
+    frames = np.frombuffer(sample.raw_data, dtype=dtype).reshape(-1, sample.channels)
+    indices = (np.arange(int(len(frames) / ratio)) * ratio).astype(np.int64)
+    return sample._spawn(frames[indices].tobytes())
 
 
 class Piano(SoundGenerator):
     def __init__(self, folderpath: Path):
         super().__init__()
         self.folderpath = folderpath
+        # Decoded sample files only, every pitch shift starts from these
         self.samples: Dict[Note, AudioSegment] = {}
-        audio_extensions = {'.wav', '.mp3', '.flac', '.aiff', '.ogg', '.m4a'}
-        for sample_file in self.folderpath.iterdir():
-            if sample_file.is_file() and sample_file.suffix.lower() in audio_extensions:
-                note_name = sample_file.stem
+        # Pitch shifted notes, memoized. Kept apart so a shift never depends on which notes were shifted before
+        self.shifted: Dict[Note, AudioSegment] = {}
+        # Seconds spent decoding each sample file
+        self.decode_times: Dict[str, float] = {}
+        # Lower quality, faster pitch shifting, for previews
+        self.fast_pitch_shift = False
+        self.release_ms = PIANO_RELEASE_MS
+        note_files = []
+        for sample_file in sorted(self.folderpath.iterdir()):
+            if is_audio_file(sample_file):
                 try:
-                    note = Note.from_name(note_name)
-                    self.samples[note] = AudioSegment.from_file(sample_file)
+                    note_files.append((Note.from_name(sample_file.stem), sample_file))
                 except ValueError as e:
                     print(f"Warning: Skipping file {sample_file.name} - {e}")
                     continue
 
+        # Decoded concurrently, every file is its own ffmpeg process
+        futures = decode_files([sample_file for _, sample_file in note_files])
+        for (note, sample_file), future in zip(note_files, futures):
+            try:
+                self.samples[note], self.decode_times[sample_file.name] = future.result()
+            except ValueError as e:
+                print(f"Warning: Skipping file {sample_file.name} - {e}")
+                continue
+
         if not self.samples:
             raise ValueError('No available samples to play')
 
-    def _pitch_shift(self, requested_note: Note):
+    def _pitch_shift(self, requested_note: Note) -> AudioSegment:
         # Find closest note
         min_dist = 1_000_000
         closest_note = None
@@ -38,19 +67,23 @@ class Piano(SoundGenerator):
         semitone_diff = requested_note.midi - closest_note.midi
         sample = self.samples[closest_note]
         octaves = semitone_diff / 12.0
-        new_sample = sample._spawn(sample.raw_data, overrides={
-            "frame_rate": int(sample.frame_rate * (2.0 ** octaves))
-        }).set_frame_rate(sample.frame_rate)
-        # TODO might cause issues in multithreaded context
-        self.samples[requested_note] = new_sample
+        if self.fast_pitch_shift and sample.sample_width in SAMPLE_DTYPES:
+            new_sample = resample_nearest(sample, 2.0 ** octaves)
+        else:
+            new_sample = sample._spawn(sample.raw_data, overrides={
+                "frame_rate": int(sample.frame_rate * (2.0 ** octaves))
+            }).set_frame_rate(sample.frame_rate)
+        self.shifted[requested_note] = new_sample
+        return new_sample
         
     def generate(self, note: Note, duration_ms: int):
-        # TODO smooth clip-off if it ever becomes a problem
-        if note not in self.samples:
+        sample = self.samples.get(note)
+        if sample is None:
+            sample = self.shifted.get(note)
+        if sample is None:
             # Pitch shifting, yay!
             # OLD: raise ValueError(f'No sample found for note {note.name}')
-            self._pitch_shift(note)
+            sample = self._pitch_shift(note)
 
-        sample = self.samples[note]
-        # return cast(AudioSegment, sample[:duration_ms])
-        return sample
+        # Held for the note's duration, then released instead of ringing out the whole sample
+        return cut_sound(sample, duration_ms + self.release_ms, self.release_ms)
@@ -1,16 +1,16 @@
-from promptbeatai.loopmaker.core import Note, SoundGenerator
-from typing import cast
+from promptbeatai.loopmaker.core import Note, SoundGenerator, cut_sound
+from promptbeatai.loopmaker.decode import load_sample
 from pathlib import Path
 from pydub import AudioSegment
 
 
 class Sampler(SoundGenerator):
-    def __init__(self, filepath: Path):
+    def __init__(self, filepath: Path, sound: AudioSegment | None = None):
         super().__init__()
         self.filepath = filepath
-        self.sound: AudioSegment = AudioSegment.from_file(self.filepath)
+        # Already decoded sound, e.g. by a warm-up that decodes many files at once
+        self.sound: AudioSegment = sound if sound is not None else load_sample(self.filepath)
 
     def generate(self, note: Note, duration: int) -> AudioSegment:
-        # PyDub doesn't have type annotations, this is a workaround
-        return cast(AudioSegment, self.sound[:duration])
+        return cut_sound(self.sound, duration)
 
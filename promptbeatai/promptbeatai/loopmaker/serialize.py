@@ -1,12 +1,135 @@
+import hashlib
+import json
+import logging
 import os
+import threading
+import time
 from pathlib import Path
-from promptbeatai.loopmaker.core import Hit, Loop, LoopInContext, Note, Song, Track
+from typing import cast
+from promptbeatai.loopmaker.core import HitArray, Loop, LoopInContext, Note, Song, SoundGenerator, Track
+from promptbeatai.loopmaker.decode import decode_files, is_audio_file
 from promptbeatai.loopmaker.piano import Piano
 from promptbeatai.loopmaker.sampler import Sampler
 from promptbeatai.loopmaker.synth import SimpleSynth
 
 
 SAMPLE_FOLDER = os.getenv('SAMPLE_FOLDER', None)
+# Part of every song and stem fingerprint. Bump it whenever the same song JSON starts rendering differently,
+# renders cached under the old fingerprints are then never served again.
+# 2: piano notes released after their duration, 5 ms fades on cut sampler hits, trimmed silent tails
+RENDERER_VERSION = 2
+
+# Loaded samplers and pianos by path, shared between songs once enable_instrument_cache is called
+_instrument_cache: dict[tuple[str, Path], Sampler | Piano] | None = None
+_instrument_cache_lock = threading.Lock()
+
+
+def enable_instrument_cache():
+    """
+    Makes every song that refers to the same sample file or folder reuse one
+    Sampler/Piano, so samples are decoded once per process instead of once per
+    song. Songs then share generator instances, a Piano's pitch shift cache
+    included: concurrent renders may shift the same note twice, but never
+    see a half-built sample.
+    """
+    global _instrument_cache
+    if _instrument_cache is None:
+        _instrument_cache = {}
+
+
+def _relative_to_sample_folder(path: Path) -> Path | None:
+    if SAMPLE_FOLDER is None:
+        return None
+    try:
+        return path.relative_to(SAMPLE_FOLDER)
+    except ValueError:
+        return None
+
+
+def resolve_sample_path(path: str) -> Path:
+    # Paths already under SAMPLE_FOLDER are left as they are, resolving twice doesn't prefix it again
+    if SAMPLE_FOLDER is not None and _relative_to_sample_folder(Path(path)) is None:
+        return Path(SAMPLE_FOLDER) / Path(path)
+    return Path(path)
+
+
+def unresolve_sample_path(path: Path) -> str:
+    """The path as song JSON refers to it, relative to SAMPLE_FOLDER, so songs round trip through JSON."""
+    relative = _relative_to_sample_folder(Path(path))
+    return relative.as_posix() if relative is not None else str(path)
+
+
+def load_instrument(kind: str, path: Path) -> Sampler | Piano:
+    """A 'sampler' or 'piano' for an already resolved path, from the instrument cache when it is enabled."""
+    create = {'sampler': Sampler, 'piano': Piano}[kind]
+    if _instrument_cache is None:
+        return create(path)
+    key = (kind, path)
+    with _instrument_cache_lock:
+        instrument = _instrument_cache.get(key)
+    if instrument is None:
+        # Decoded outside the lock, two threads may race to load the same instrument but only one copy is kept
+        instrument = create(path)
+        with _instrument_cache_lock:
+            instrument = _instrument_cache.setdefault(key, instrument)
+    return instrument
+
+
+def _is_piano_folder(folder: Path) -> bool:
+    for f in folder.iterdir():
+        if is_audio_file(f):
+            try:
+                Note.from_name(f.stem)
+                return True
+            except ValueError:
+                pass
+    return False
+
+
+def warm_instruments(folder: str | None = SAMPLE_FOLDER) -> dict[str, float]:
+    """
+    Decodes every instrument below folder into the instrument cache (enabling
+    it), so the first songs don't pay for decoding: folders of files named
+    after notes become pianos, every other audio file a sampler. Returns the
+    decode seconds per file, relative to folder.
+    """
+    if folder is None:
+        logging.warning('Sample folder not set, nothing to warm up')
+        return {}
+    enable_instrument_cache()
+    assert _instrument_cache is not None
+    root = Path(folder)
+    start = time.perf_counter()
+    decode_times = {}
+    piano_folders = sorted({f.parent for f in root.rglob('*') if is_audio_file(f) and _is_piano_folder(f.parent)})
+    for piano_folder in piano_folders:
+        try:
+            piano = cast(Piano, load_instrument('piano', piano_folder))
+        except (OSError, ValueError) as e:
+            logging.warning(f'Could not load piano {piano_folder}: {e}')
+            continue
+        for name, seconds in piano.decode_times.items():
+            decode_times[str((piano_folder / name).relative_to(root))] = seconds
+
+    sample_files = sorted(f for f in root.rglob('*') if is_audio_file(f) and f.parent not in piano_folders)
+    for sample_file, future in zip(sample_files, decode_files(sample_files)):
+        try:
+            sound, seconds = future.result()
+        except Exception as e:
+            logging.warning(f'Could not load sample {sample_file}: {e}')
+            continue
+        with _instrument_cache_lock:
+            _instrument_cache.setdefault(('sampler', sample_file), Sampler(sample_file, sound))
+        decode_times[str(sample_file.relative_to(root))] = seconds
+
+    if decode_times:
+        slowest = sorted(decode_times.items(), key=lambda item: item[1], reverse=True)[:5]
+        logging.info(
+            f'Decoded {len(decode_times)} sample files in {time.perf_counter() - start:.2f}s '
+            f'({sum(decode_times.values()):.2f}s of decoding), slowest: '
+            + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in slowest)
+        )
+    return decode_times
 
 
 def synth_from_json(synth_json: dict) -> SimpleSynth:
@@ -42,19 +165,13 @@ def sampler_from_json(sampler_json: dict) -> Sampler:
     filepath = sampler_json.get('filepath')
     if filepath is None:
         raise ValueError("Missing 'filepath' in sampler_json")
-    if SAMPLE_FOLDER is not None:
-        filepathpath = Path(SAMPLE_FOLDER) / Path(filepath)
-    else:
-        filepathpath = Path(filepath)
-
-    sampler = Sampler(filepathpath)
-    return sampler
+    return cast(Sampler, load_instrument('sampler', resolve_sample_path(filepath)))
 
 
 def sampler_to_json(sampler: Sampler) -> dict:
     return {
         'type': 'sampler',
-        'filepath': str(sampler.filepath)
+        'filepath': unresolve_sample_path(sampler.filepath)
     }
     
 
@@ -62,18 +179,13 @@ def piano_from_json(piano_json: dict) -> Piano:
     folderpath = piano_json.get('folderpath')
     if folderpath is None:
         raise ValueError("Missing 'folderpath' in piano_json")
-    if SAMPLE_FOLDER is not None:
-        folderpathpath = Path(SAMPLE_FOLDER) / Path(folderpath)
-    else:
-        folderpathpath = Path(folderpath)
-    piano = Piano(folderpathpath)
-    return piano
+    return cast(Piano, load_instrument('piano', resolve_sample_path(folderpath)))
     
 
 def piano_to_json(piano: Piano) -> dict:
     return {
         'type': 'piano',
-        'folderpath': str(piano.folderpath)
+        'folderpath': unresolve_sample_path(piano.folderpath)
     }
 
 
@@ -87,19 +199,16 @@ def track_from_json(track_json: dict) -> Track:
         case 'piano':
             gen = piano_from_json(gen_json)
     
-    hits_json = track_json.get('hits', [])
-    hits = []
-    for hit_json in hits_json:
-        note = hit_json.get('note', 'C5')
-        if isinstance(note, str):
-            note = Note.from_name(note)
-        hit_json['note'] = note
-        hits.append(Hit(**hit_json))
+    hits = HitArray.from_json(track_json.get('hits', []))
 
     gain = track_json.get('gain', 0.0)
     mute = track_json.get('mute', False)
+    polyphony = track_json.get('polyphony')
+    if polyphony is not None and int(polyphony) < 1:
+        raise ValueError(f'polyphony must be at least 1, got {polyphony}')
+    choke_group = track_json.get('choke_group')
 
-    return Track(gen, hits, gain, mute)
+    return Track(gen, hits, gain, mute, int(polyphony) if polyphony is not None else None, str(choke_group) if choke_group is not None else None)
 
 
 def track_to_json(track: Track) -> dict:
@@ -114,9 +223,9 @@ def track_to_json(track: Track) -> dict:
         gen_json['type'] = 'piano'
     else:
         raise ValueError(f"Unsupported generator type: {type(track.gen)}")
-    return {
+    track_json = {
         'gen': gen_json,
-        'hits': [{
+        'hits': track.hits.to_json() if isinstance(track.hits, HitArray) else [{
                 'step': h['step'],
                 'note': h['note'].name,
                 'steps': h['steps']
@@ -124,6 +233,12 @@ def track_to_json(track: Track) -> dict:
         'gain': track.gain,
         'mute': track.mute
     }
+    # Only written when set, so songs without them keep their fingerprints
+    if track.polyphony is not None:
+        track_json['polyphony'] = track.polyphony
+    if track.choke_group is not None:
+        track_json['choke_group'] = track.choke_group
+    return track_json
 
 
 def loop_from_json(loop_json: dict) -> Loop:
@@ -175,3 +290,150 @@ def song_to_json(song: Song) -> dict:
             } for lic in song.loops_in_context
         ]
     }
+
+
+def file_signature(path: Path) -> str:
+    try:
+        stat = path.stat()
+    except OSError:
+        return f'{path}:missing'
+    return f'{path}:{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def sample_files(gen: SoundGenerator) -> list[Path]:
+    """Files a generator's sound comes from: a sampler's file, every file in a piano's folder."""
+    if isinstance(gen, Sampler):
+        return [Path(gen.filepath)]
+    if isinstance(gen, Piano):
+        folder = Path(gen.folderpath)
+        return sorted(folder.iterdir()) if folder.is_dir() else [folder]
+    return []
+
+
+def song_fingerprint(song: Song) -> str:
+    """
+    Content hash of a song, of the sample files it uses (size and mtime) and
+    of RENDERER_VERSION, equal for songs that render identically. Replacing a
+    sample or changing how songs render changes it.
+    """
+    generators = {id(t.gen): t.gen for lic in song.loops_in_context for t in lic.loop.tracks.values()}
+    return _fingerprint(song_to_json(song), {f for gen in generators.values() for f in sample_files(gen)})
+
+
+def json_fingerprint(song_json: dict) -> str:
+    """
+    song_fingerprint of the song a JSON parses to, without loading its samples.
+    Only equal for JSON as song_to_json writes it, like the API returns songs.
+    """
+    files = set()
+    for lic_json in song_json.get('loops_in_context', []):
+        for track_json in (lic_json.get('loop') or {}).get('tracks', {}).values():
+            gen_json = track_json.get('gen', {})
+            match gen_json.get('type'):
+                case 'sampler' if gen_json.get('filepath'):
+                    files.add(resolve_sample_path(gen_json['filepath']))
+                case 'piano' if gen_json.get('folderpath'):
+                    folder = resolve_sample_path(gen_json['folderpath'])
+                    files.update(folder.iterdir() if folder.is_dir() else [folder])
+    return _fingerprint(song_json, files)
+
+
+def _fingerprint(song_json: dict, files: set[Path]) -> str:
+    digest = hashlib.sha256(f'renderer-{RENDERER_VERSION}\n'.encode())
+    digest.update(json.dumps(song_json, sort_keys=True, separators=(',', ':')).encode())
+    for path in sorted(files):
+        digest.update(file_signature(path).encode())
+    return digest.hexdigest()
+
+
+def render_params(gen: SoundGenerator) -> dict:
+    """
+    How a generator renders beyond what its JSON says: the format its samples
+    were decoded (or resampled, for previews) to and a piano's pitch shifting.
+    """
+    if isinstance(gen, SimpleSynth):
+        return {'sample_rate': gen.sample_rate}
+    if isinstance(gen, Sampler):
+        return {'frame_rate': gen.sound.frame_rate, 'channels': gen.sound.channels, 'sample_width': gen.sound.sample_width}
+    if isinstance(gen, Piano):
+        return {
+            'formats': sorted({(s.frame_rate, s.channels, s.sample_width) for s in gen.samples.values()}),
+            'fast_pitch_shift': gen.fast_pitch_shift,
+            'release_ms': gen.release_ms,
+        }
+    return {}
+
+
+def stem_fingerprint(song: Song, loop: Loop, name: str) -> str:
+    """
+    Content hash of one track of a loop rendered alone, equal in every song where
+    it sounds the same: same track, generator render parameters and sample files,
+    tempo, loop length and chokes from its group. A preview's downsampled copy of
+    a generator gets stems of its own.
+    """
+    track = loop.tracks[name]
+    choke_times = None
+    if track.choke_group:
+        choke_times = loop.choke_times(Loop.step_duration_ms(song.bpm, song.steps_per_beat)).get(track.choke_group)
+    canonical = json.dumps({
+        'renderer': RENDERER_VERSION,
+        'track': track_to_json(track),
+        'render': render_params(track.gen),
+        'samples': [file_signature(path) for path in sample_files(track.gen)],
+        'bpm': song.bpm,
+        'beats_per_bar': song.beats_per_bar,
+        'steps_per_beat': song.steps_per_beat,
+        'bars': loop.bars,
+        'choke_times': None if choke_times is None else choke_times.tolist(),
+    }, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def _content_track_json(track_json: dict) -> dict:
+    gen_json = dict(track_json.get('gen', {}))
+    for key in ('filepath', 'folderpath'):
+        if key in gen_json:
+            gen_json[key] = unresolve_sample_path(Path(gen_json[key]))
+    return {
+        'gen': gen_json,
+        'hits': HitArray.from_json(track_json.get('hits', [])).to_json(),
+        'gain': track_json.get('gain', 0.0),
+        'polyphony': track_json.get('polyphony'),
+        'choke_group': track_json.get('choke_group'),
+    }
+
+
+def stems_from_json(song_json: dict) -> set[str]:
+    """
+    Content keys of every stem that sounds in a song, read from its JSON
+    without loading any samples: equal for tracks that render the same in
+    songs using the same samples. For comparing songs, not for the stem cache,
+    whose keys also cover how the generators render (see stem_fingerprint).
+    """
+    song = Song(int(song_json.get('bpm', 0)))
+    beats_per_bar = song_json.get('beats_per_bar', song.beats_per_bar)
+    steps_per_beat = song_json.get('steps_per_beat', song.steps_per_beat)
+    step_duration_ms = Loop.step_duration_ms(song.bpm, steps_per_beat)
+    stems = set()
+    for lic_json in song_json.get('loops_in_context', []):
+        loop_json = lic_json.get('loop', {})
+        if loop_json.get('mute', False):
+            continue
+        tracks = {name: _content_track_json(t) for name, t in loop_json.get('tracks', {}).items() if not t.get('mute', False)}
+        groups: dict[str, list[int]] = {}
+        for track in tracks.values():
+            if track['choke_group'] is not None:
+                groups.setdefault(track['choke_group'], []).extend(hit['step'] * step_duration_ms for hit in track['hits'])
+        for track in tracks.values():
+            if not track['hits']:
+                continue
+            canonical = json.dumps({
+                'track': track,
+                'bpm': song.bpm,
+                'beats_per_bar': beats_per_bar,
+                'steps_per_beat': steps_per_beat,
+                'bars': loop_json.get('bars', 4),
+                'choke_times': sorted(groups[track['choke_group']]) if track['choke_group'] is not None else None,
+            }, sort_keys=True, separators=(',', ':'))
+            stems.add(hashlib.sha256(canonical.encode()).hexdigest())
+    return stems
@@ -4,7 +4,6 @@ from enum import Enum
 from pydub import AudioSegment
 from typing import Union
 import numpy as np
-from scipy.signal import square, sawtooth
 
 
 class Waveform(Enum):
@@ -46,14 +45,18 @@ class SimpleSynth(SoundGenerator):
         freq = note.to_frequency()
         angle = 2 * np.pi * freq * t
 
+        # scipy.signal is slow to import, so only pull it in when a non-sine waveform is rendered
         match self.waveform:
             case Waveform.SINE:
                 wave = np.sin(angle)
             case Waveform.SQUARE:
+                from scipy.signal import square
                 wave = square(angle)
             case Waveform.SAWTOOTH:
+                from scipy.signal import sawtooth
                 wave = sawtooth(angle)
             case Waveform.TRIANGLE:
+                from scipy.signal import sawtooth
                 # width is incorrectly typed as int
                 wave = sawtooth(angle, width=0.5) # type: ignore
         
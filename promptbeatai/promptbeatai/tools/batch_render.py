@@ -0,0 +1,244 @@
+"""
+Render a corpus of song JSON files offline, across a process pool.
+
+Usage (from the repository root):
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.batch_render songs/ -o renders/
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.batch_render catalog.jsonl -o renders/ --format opus --workers 8
+
+Inputs are directories (every *.json below them) or JSONL files (one song
+per line), either bare songs or GET /song/{id} responses. Each output is
+named after its input and recorded in <output>/manifest.jsonl with a content
+hash of the song JSON, the output variant and the sample files it uses.
+A re-run skips every song whose hash and output are unchanged, so an
+interrupted run resumes where it stopped and changing a sample only
+re-renders the songs that use it.
+
+Songs are rendered like the API renders masters, block by block under a
+memory limit (RENDER_MEMORY_LIMIT_MB, or --memory-limit-mb), and WAV output
+is written straight from the blocks. Other formats are encoded from the
+rendered song in memory.
+
+Samples are decoded once per worker and reused across songs. With the fork
+start method (Linux) they are loaded once in the parent with --preload and
+shared copy-on-write by all workers.
+"""
+import argparse
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+
+from promptbeatai.app.render.cache import RENDER_BLOCK_MS, RENDER_MEMORY_LIMIT_MB, atomic_write
+from promptbeatai.app.render.formats import AudioVariant, UnsupportedFormatError, export_variant, negotiate_variant
+from promptbeatai.app.render.wav import write_wav_blocks
+from promptbeatai.loopmaker.blocks import BlockRenderer
+from promptbeatai.loopmaker.serialize import enable_instrument_cache, file_signature, load_instrument, resolve_sample_path, song_from_json
+
+
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+
+@dataclass
+class Job:
+    name: str
+    song_json: dict
+    content_hash: str
+
+
+def safe_name(name: str) -> str:
+    """
+    The name with anything but letters, digits, '-', '_' and inner dots
+    replaced, so it can't leave the output directory. Changed names get a
+    hash of the original, two ids can't end up with the same file.
+    """
+    safe = re.sub(r'[^A-Za-z0-9_.-]', '_', name).strip('.') or '_'
+    if safe == name:
+        return name
+    return f'{safe}-{hashlib.sha256(name.encode()).hexdigest()[:8]}'
+
+
+def iter_songs(inputs: list[Path]):
+    """(name, song JSON) for every song in the inputs, names are unique and filesystem safe."""
+    for input_path in inputs:
+        if input_path.is_dir():
+            for song_file in sorted(input_path.rglob('*.json')):
+                with open(song_file) as f:
+                    document = json.load(f)
+                yield song_file.relative_to(input_path).with_suffix('').as_posix().replace('/', '__'), document.get('result', document)
+        else:
+            with open(input_path) as f:
+                for line_no, line in enumerate(f, 1):
+                    if line.strip():
+                        document = json.loads(line)
+                        # Ids come from the file, they are used as file names
+                        name = safe_name(str(document.get('id') or f'{input_path.stem}-{line_no:06d}'))
+                        yield name, document.get('result', document)
+
+
+def _sample_paths(song_json: dict) -> list[tuple[str, Path]]:
+    paths = set()
+    for lic in song_json.get('loops_in_context', []):
+        for track in (lic.get('loop') or {}).get('tracks', {}).values():
+            gen = track.get('gen', {})
+            match str(gen.get('type', '')).lower():
+                case 'sampler' if gen.get('filepath'):
+                    paths.add(('sampler', resolve_sample_path(gen['filepath'])))
+                case 'piano' if gen.get('folderpath'):
+                    paths.add(('piano', resolve_sample_path(gen['folderpath'])))
+    return sorted(paths)
+
+
+def content_hash(song_json: dict, variant: AudioVariant) -> str:
+    """Changes when the song, the output variant or any sample file it uses changes."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(song_json, sort_keys=True, separators=(',', ':')).encode())
+    digest.update(variant.key.encode())
+    for kind, path in _sample_paths(song_json):
+        files = sorted(path.iterdir()) if kind == 'piano' and path.is_dir() else [path]
+        for file in files:
+            digest.update(file_signature(file).encode())
+    return digest.hexdigest()
+
+
+def load_manifest(output_dir: Path) -> dict[str, dict]:
+    """Latest manifest entry per song."""
+    manifest = {}
+    path = output_dir / MANIFEST_FILENAME
+    if path.exists():
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last line may be cut off when a run was killed
+                    continue
+                manifest[entry['name']] = entry
+    return manifest
+
+
+def preload_instruments(jobs: list[Job]):
+    """Decodes every sample the jobs use, in this process, so forked workers inherit them."""
+    enable_instrument_cache()
+    for kind, path in sorted({p for job in jobs for p in _sample_paths(job.song_json)}):
+        try:
+            load_instrument(kind, path)
+        except (OSError, ValueError) as e:
+            print(f'Could not preload {kind} {path}: {e}', file=sys.stderr)
+
+
+def _init_worker():
+    enable_instrument_cache()
+
+
+def render_job(job: Job, output_path: str, variant: AudioVariant, memory_limit_bytes: int | None = None) -> dict:
+    """Runs in a worker process: builds, renders and encodes one song."""
+    start = time.perf_counter()
+    try:
+        # song_from_json mutates its input
+        song = song_from_json(copy.deepcopy(job.song_json))
+        renderer = BlockRenderer(song, RENDER_BLOCK_MS, memory_limit_bytes)
+        renderer.prepare()
+        if variant.format.name == 'wav' and not variant.mono:
+            # Like the API's master, the song is never in memory as a whole
+            atomic_write(Path(output_path), lambda tmp: write_wav_blocks(
+                tmp, renderer.blocks(), renderer.frames, renderer.channels, renderer.sample_width, renderer.frame_rate,
+            ))
+            render_s = time.perf_counter() - start
+        else:
+            audio = renderer.render()
+            render_s = time.perf_counter() - start
+            atomic_write(Path(output_path), lambda tmp: export_variant(audio, variant, tmp))
+    except Exception as e:
+        return {'name': job.name, 'error': f'{type(e).__name__}: {e}', 'seconds': time.perf_counter() - start}
+    return {
+        'name': job.name,
+        'hash': job.content_hash,
+        'output': Path(output_path).name,
+        'duration_ms': song.duration_ms,
+        'render_s': render_s,
+        'seconds': time.perf_counter() - start,
+        'rendered_at': time.time(),
+    }
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', type=Path, help='Directories of *.json songs or JSONL files')
+    parser.add_argument('-o', '--output', type=Path, required=True)
+    parser.add_argument('--format', default='mp3', help='mp3, opus, aac, flac, wav or preview')
+    parser.add_argument('--bitrate', default=None)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--memory-limit-mb', type=float, default=RENDER_MEMORY_LIMIT_MB,
+                        help='Songs whose loops need more than this per worker fail instead of rendering')
+    parser.add_argument('--force', action='store_true', help='Re-render songs that are up to date')
+    parser.add_argument('--preload', action=argparse.BooleanOptionalAction, default=True,
+                        help='Decode all samples before forking the workers (fork start method only)')
+    args = parser.parse_args(argv)
+
+    try:
+        variant = negotiate_variant(args.format, args.bitrate)
+    except UnsupportedFormatError as e:
+        print(e, file=sys.stderr)
+        return 2
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(args.output)
+    jobs, skipped = [], 0
+    for name, song_json in iter_songs(args.inputs):
+        job = Job(name, song_json, content_hash(song_json, variant))
+        entry = manifest.get(name)
+        output_path = args.output / f'{name}.{variant.format.extension}'
+        if not args.force and entry and entry.get('hash') == job.content_hash and output_path.exists():
+            skipped += 1
+            continue
+        jobs.append(job)
+    print(f'{len(jobs)} songs to render, {skipped} up to date', file=sys.stderr)
+
+    fork = multiprocessing.get_start_method() == 'fork'
+    if jobs and args.preload and fork:
+        preload_instruments(jobs)
+
+    start = time.perf_counter()
+    rendered, failed, audio_ms, cpu_s = 0, 0, 0, 0.0
+    with open(args.output / MANIFEST_FILENAME, 'a') as manifest_file, \
+            ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) as pool:
+        futures = [
+            pool.submit(
+                render_job, job, str(args.output / f'{job.name}.{variant.format.extension}'), variant,
+                int(args.memory_limit_mb * 2**20),
+            )
+            for job in jobs
+        ]
+        for future in as_completed(futures):
+            result = future.result()
+            if 'error' in result:
+                failed += 1
+                print(f'FAILED {result["name"]}: {result["error"]}', file=sys.stderr)
+                continue
+            rendered += 1
+            audio_ms += result['duration_ms']
+            cpu_s += result['seconds']
+            # Written as soon as a song is done, so an interrupted run resumes from here
+            manifest_file.write(json.dumps(result) + '\n')
+            manifest_file.flush()
+            print(f'[{rendered + failed}/{len(jobs)}] {result["name"]} in {result["seconds"]:.2f}s', file=sys.stderr)
+
+    elapsed = time.perf_counter() - start
+    print(
+        f'Rendered {rendered}, skipped {skipped}, failed {failed} in {elapsed:.1f}s with {args.workers} workers: '
+        f'{rendered / elapsed if elapsed else 0:.2f} songs/s, '
+        f'{audio_ms / 1000 / elapsed if elapsed else 0:.1f}x realtime, '
+        f'{cpu_s / rendered if rendered else 0:.2f}s per song'
+    )
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
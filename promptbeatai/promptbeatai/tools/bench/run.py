@@ -0,0 +1,199 @@
+"""
+Benchmark the loopmaker rendering pipeline on synthetic songs and compare against a baseline.
+
+Usage (from the repository root):
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.bench.run
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.bench.run --only song.generate --repeat 10
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.bench.run --update-baseline
+
+Every case is timed over several runs (median and min) and its peak memory
+(Python and NumPy allocations, traced with tracemalloc) in one extra run.
+MP3 export is skipped when ffmpeg has no MP3 encoder. Exits with 1 when a
+case is slower or uses more memory than the baseline plus the tolerance.
+Baselines are machine specific, regenerate them on the machine that checks them.
+"""
+import argparse
+import copy
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable
+
+from promptbeatai.app.render import cache
+from promptbeatai.app.render.formats import AUDIO_FORMATS, is_format_available
+from promptbeatai.loopmaker.core import Note
+from promptbeatai.loopmaker.piano import Piano
+from promptbeatai.loopmaker.serialize import song_from_json, song_to_json
+from promptbeatai.loopmaker.synth import AHDSREnvelope, SimpleSynth
+from promptbeatai.tools.bench.synthetic import SampleSet, SongSpec, build_loop, build_song, write_sample_files
+
+
+BASELINE_PATH = Path(__file__).with_name('baseline.json')
+DEFAULT_TOLERANCE = 0.25
+# Sub-millisecond cases are dominated by timer noise, slowdowns smaller than this never count
+MIN_SLOWDOWN_S = 0.002
+
+SPECS = {
+    'small': SongSpec(bars=8, loops=2, tracks_per_loop=3, hits_per_bar=4),
+    'medium': SongSpec(bars=32, loops=4, tracks_per_loop=5, hits_per_bar=6),
+    'dense': SongSpec(bars=16, loops=2, tracks_per_loop=8, hits_per_bar=16),
+}
+
+
+@dataclass
+class Case:
+    name: str
+    # Builds a fresh input for every run, not timed
+    setup: Callable[[], Any]
+    run: Callable[[Any], Any]
+
+
+def _cases(samples: SampleSet, work_dir: Path) -> list[Case]:
+    def synth_generate(_):
+        synth = SimpleSynth('sawtooth', AHDSREnvelope(10, 20, 100, 0.6, 150))
+        return synth.generate(Note.from_name('A3'), 500)
+
+    def fresh_piano():
+        # Pitch shifts are cached on the instance, so every run gets a new one
+        return Piano(samples.piano_folder)
+
+    def song_json(name: str) -> dict:
+        return song_to_json(build_song(SPECS[name], samples))
+
+    medium_json = song_json('medium')
+
+    def cold_render_cache(name: str):
+        # An empty render cache for every run: the master and every stem are rendered and written
+        cache.RENDER_CACHE_DIR = tempfile.mkdtemp(dir=work_dir)
+        return build_song(SPECS[name], samples)
+
+    cases = [
+        Case('synth.generate', lambda: None, synth_generate),
+        Case('piano.pitch_shift', fresh_piano, lambda piano: piano._pitch_shift(Note.from_name('E4'))),
+        Case(
+            'loop.generate',
+            lambda: build_loop(SPECS['medium'], samples),
+            lambda loop: loop.generate(100),
+        ),
+        *(
+            Case(f'song.generate[{name}]', lambda name=name: build_song(SPECS[name], samples), lambda song: song.generate())
+            for name in SPECS
+        ),
+        # What the API renders: the song block by block into the master WAV (remixes also go through the stem cache)
+        *(
+            Case(f'render_master[{name}]', lambda name=name: cold_render_cache(name), cache.render_master)
+            for name in SPECS
+        ),
+        # song_from_json mutates its input and loads the samples from disk
+        Case('song_from_json[medium]', lambda: copy.deepcopy(medium_json), song_from_json),
+        Case('song_to_json[medium]', lambda: build_song(SPECS['medium'], samples), song_to_json),
+    ]
+    if is_format_available(AUDIO_FORMATS['mp3']):
+        medium_master = build_song(SPECS['medium'], samples).generate()
+        mp3_path = Path(tempfile.gettempdir()) / 'promptbeatai-bench.mp3'
+        cases.append(Case(
+            'export.mp3[medium]',
+            lambda: medium_master,
+            lambda audio: audio.export(mp3_path, format='mp3', bitrate='192k').close(),
+        ))
+    return cases
+
+
+def measure(case: Case, repeat: int) -> dict:
+    times = []
+    for _ in range(repeat):
+        arg = case.setup()
+        start = time.perf_counter()
+        case.run(arg)
+        times.append(time.perf_counter() - start)
+
+    arg = case.setup()
+    tracemalloc.start()
+    try:
+        case.run(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'median_s': statistics.median(times),
+        'min_s': min(times),
+        'peak_mb': peak / 2**20,
+    }
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """Names of the cases that regressed against the baseline."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['median_s'] > max(base['median_s'] * (1 + tolerance), base['median_s'] + MIN_SLOWDOWN_S)
+        if slower or result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def _print_table(results: dict[str, dict], baseline: dict[str, dict], regressions: list[str]):
+    print(f'{"case":28} {"median ms":>10} {"min ms":>9} {"base ms":>9} {"delta":>8} {"peak MB":>8} {"base MB":>8}')
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base:
+            delta = f'{(r["median_s"] / base["median_s"] - 1) * 100:+.0f}%'
+            base_ms, base_mb = f'{base["median_s"] * 1000:.1f}', f'{base["peak_mb"]:.1f}'
+        else:
+            delta, base_ms, base_mb = '', '-', '-'
+        flag = '  REGRESSION' if name in regressions else ''
+        print(f'{name:28} {r["median_s"] * 1000:10.1f} {r["min_s"] * 1000:9.1f} {base_ms:>9} {delta:>8} {r["peak_mb"]:8.1f} {base_mb:>8}{flag}')
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', action='append', default=[], help='Run only cases whose name starts with this, repeatable')
+    parser.add_argument('--baseline', type=Path, default=BASELINE_PATH)
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed slowdown/memory growth, 0.25 = 25%%')
+    parser.add_argument('--update-baseline', action='store_true', help='Write the results as the new baseline')
+    parser.add_argument('--samples-dir', type=Path, default=None, help='Where to generate the sample files (default: a temporary directory)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        samples = write_sample_files(args.samples_dir or Path(tmp))
+        results = {}
+        for case in _cases(samples, Path(tmp)):
+            if args.only and not any(case.name.startswith(prefix) for prefix in args.only):
+                continue
+            results[case.name] = measure(case, args.repeat)
+            print(f'  {case.name}: {results[case.name]["median_s"] * 1000:.1f} ms', file=sys.stderr)
+
+    baseline = {}
+    if args.baseline.exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f).get('cases', {})
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({
+                'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor()},
+                'cases': {**baseline, **results},
+            }, f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    _print_table(results, baseline, regressions)
+    if regressions:
+        print(f'{len(regressions)} case(s) regressed by more than {args.tolerance:.0%}: {", ".join(regressions)}')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
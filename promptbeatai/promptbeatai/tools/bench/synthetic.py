@@ -0,0 +1,119 @@
+"""
+Synthetic songs for benchmarks, built from generated sample files so no sample library is needed.
+"""
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+from pydub import AudioSegment
+
+from promptbeatai.loopmaker.core import Hit, Loop, LoopInContext, Note, Song, Track
+from promptbeatai.loopmaker.piano import Piano
+from promptbeatai.loopmaker.sampler import Sampler
+from promptbeatai.loopmaker.synth import AHDSREnvelope, SimpleSynth
+
+
+SAMPLE_RATE = 44100
+PIANO_NOTES = ('C3', 'G3', 'C4', 'G4', 'C5')
+DRUM_SAMPLES = ('kick', 'snare', 'hihat')
+SCALE = ('C', 'D', 'E', 'G', 'A')
+
+
+@dataclass(frozen=True)
+class SampleSet:
+    piano_folder: Path
+    drum_files: tuple[Path, ...]
+
+
+@dataclass(frozen=True)
+class SongSpec:
+    bars: int = 16
+    loops: int = 2
+    tracks_per_loop: int = 4
+    # Average hits per track per bar
+    hits_per_bar: float = 4.0
+    # Generator types cycled through the tracks of every loop
+    mix: tuple[str, ...] = ('synth', 'piano', 'sampler')
+    bpm: int = 100
+    seed: int = 0
+
+
+def _write_wav(path: Path, samples: np.ndarray):
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    AudioSegment(pcm.tobytes(), frame_rate=SAMPLE_RATE, sample_width=2, channels=1).export(path, format='wav').close()
+
+
+def write_sample_files(directory: Path, seconds: float = 2.0) -> SampleSet:
+    """Decaying tones named after their note for the piano, and short noise/tone bursts for drums."""
+    rng = np.random.default_rng(0)
+    piano_folder = directory / 'piano'
+    piano_folder.mkdir(parents=True, exist_ok=True)
+    t = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    for name in PIANO_NOTES:
+        freq = Note.from_name(name).to_frequency()
+        tone = np.sin(2 * np.pi * freq * t) + 0.3 * np.sin(4 * np.pi * freq * t)
+        _write_wav(piano_folder / f'{name}.wav', 0.5 * tone * np.exp(-3 * t))
+
+    drum_folder = directory / 'drums'
+    drum_folder.mkdir(parents=True, exist_ok=True)
+    t = t[:SAMPLE_RATE // 2]
+    bursts = {
+        'kick': np.sin(2 * np.pi * 60 * t) * np.exp(-12 * t),
+        'snare': rng.uniform(-1, 1, len(t)) * np.exp(-20 * t),
+        'hihat': rng.uniform(-1, 1, len(t)) * np.exp(-60 * t),
+    }
+    drum_files = []
+    for name in DRUM_SAMPLES:
+        path = drum_folder / f'{name}.wav'
+        _write_wav(path, 0.8 * bursts[name])
+        drum_files.append(path)
+    return SampleSet(piano_folder, tuple(drum_files))
+
+
+def _random_note(rng: random.Random, octaves: tuple[int, ...]) -> Note:
+    return Note.from_name(f'{rng.choice(SCALE)}{rng.choice(octaves)}')
+
+
+def _build_track(kind: str, loop_bars: int, spec: SongSpec, samples: SampleSet, rng: random.Random) -> Track:
+    steps_per_bar = 16
+    total_steps = loop_bars * steps_per_bar
+    n_hits = max(1, round(spec.hits_per_bar * loop_bars))
+    steps = sorted(rng.sample(range(total_steps), min(n_hits, total_steps)))
+    match kind:
+        case 'synth':
+            gen = SimpleSynth(
+                rng.choice(('sine', 'square', 'sawtooth', 'triangle')),
+                AHDSREnvelope(attack_ms=10, hold_ms=20, decay_ms=100, sustain_level=0.6, release_ms=150),
+                amplitude=0.4,
+            )
+            hits = [Hit(step=s, note=_random_note(rng, (3, 4)), steps=float(rng.choice((1, 2, 4)))) for s in steps]
+        case 'piano':
+            gen = Piano(samples.piano_folder)
+            hits = [Hit(step=s, note=_random_note(rng, (3, 4, 5)), steps=float(rng.choice((2, 4)))) for s in steps]
+        case 'sampler':
+            gen = Sampler(rng.choice(samples.drum_files))
+            hits = [Hit(step=s, note=Note.from_name('C1'), steps=1.0) for s in steps]
+        case _:
+            raise ValueError(f'Unknown generator type {kind}')
+    return Track(gen, hits, gain=-6.0)
+
+
+def build_loop(spec: SongSpec, samples: SampleSet, bars: int = 4, rng: random.Random | None = None) -> Loop:
+    rng = rng or random.Random(spec.seed)
+    loop = Loop(bars=bars, gain=-3.0)
+    for i in range(spec.tracks_per_loop):
+        loop.add_track(f'track{i}', _build_track(spec.mix[i % len(spec.mix)], bars, spec, samples, rng))
+    return loop
+
+
+def build_song(spec: SongSpec, samples: SampleSet) -> Song:
+    """Song with spec.loops loops played one after another, each repeated to fill its share of the bars."""
+    rng = random.Random(spec.seed)
+    song = Song(spec.bpm)
+    section_bars = max(1, spec.bars // spec.loops)
+    loop_bars = next(b for b in (4, 2, 1) if section_bars % b == 0)
+    for i in range(spec.loops):
+        loop = build_loop(spec, samples, loop_bars, rng)
+        song.loops_in_context.append(LoopInContext(loop, i * section_bars, section_bars // loop_bars))
+    return song
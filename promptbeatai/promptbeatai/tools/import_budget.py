@@ -0,0 +1,59 @@
+"""
+Measure the import time of a module in a fresh interpreter and check it against a budget.
+
+Usage (from the repository root):
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.import_budget --budget-ms 1500
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+
+DEFAULT_MODULE = 'promptbeatai.app.main'
+DEFAULT_BUDGET_MS = float(os.getenv('IMPORT_TIME_BUDGET_MS', 1500))
+
+
+def measure_import_time(module: str) -> list[tuple[str, int, int]]:
+    """Returns (module, self_us, cumulative_us) for every import, as reported by -X importtime."""
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        env=os.environ.copy(),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f'Importing {module} failed:\n{proc.stderr[-2000:]}')
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        entries.append((name.strip(), int(self_us), int(cumulative_us)))
+    return entries
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('module', nargs='?', default=DEFAULT_MODULE)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+    parser.add_argument('--top', type=int, default=15, help='Number of slowest imports to print')
+    args = parser.parse_args(argv)
+
+    entries = measure_import_time(args.module)
+    total_ms = next(c for name, _, c in entries if name == args.module) / 1000
+
+    print(f'Slowest imports (cumulative) for {args.module}:')
+    for name, _, cumulative_us in sorted(entries, key=lambda e: e[2], reverse=True)[:args.top]:
+        print(f'  {cumulative_us / 1000:9.1f} ms  {name}')
+    print(f'Total: {total_ms:.1f} ms (budget {args.budget_ms:.1f} ms)')
+
+    if total_ms > args.budget_ms:
+        print('Import time budget exceeded!')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
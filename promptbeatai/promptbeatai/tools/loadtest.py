@@ -0,0 +1,258 @@
+"""
+Drive the generate -> poll -> download flow against a running server and report latencies.
+
+Start the server with the mock provider and without rate limits, e.g.:
+    SONG_PROVIDERS=mock RATE_LIMIT_ENABLED=0 MOCK_LATENCY_MEDIAN_S=2 \\
+        CLIENT_RENDER_COST_CAPACITY=1e9 GLOBAL_RENDER_COST_CAPACITY=1e9 \\
+        uvicorn promptbeatai.app.main:app --app-dir promptbeatai --port 35789
+
+Then, from the repository root:
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.loadtest --url http://localhost:35789 --concurrency 20 --duration 60
+
+Every virtual user repeats: POST /generate, poll GET /song/{id} until it is
+complete or failed, then download GET /song/mp3/{id}. Reports throughput,
+p50/p95/p99 per endpoint, the load generator's own event-loop lag (it is
+the bottleneck when that grows) and the server's event-loop lag from /metrics.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+
+import httpx
+
+
+DEFAULT_PROMPT = {'text_prompt': 'Chill lofi beat with a soft piano', 'other_settings': {}}
+SERVER_LAG_METRIC = 'promptbeatai_event_loop_lag_seconds'
+
+
+@dataclass
+class Stats:
+    latencies: dict[str, list[float]] = field(default_factory=lambda: defaultdict(list))
+    statuses: dict[str, Counter] = field(default_factory=lambda: defaultdict(Counter))
+    flows: Counter = field(default_factory=Counter)
+    client_lag: list[float] = field(default_factory=list)
+
+    def record(self, endpoint: str, seconds: float, status: int | str):
+        self.latencies[endpoint].append(seconds)
+        self.statuses[endpoint][status] += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))]
+
+
+async def _timed(stats: Stats, endpoint: str, request) -> httpx.Response | None:
+    start = time.perf_counter()
+    try:
+        response = await request
+    except httpx.HTTPError as e:
+        stats.record(endpoint, time.perf_counter() - start, type(e).__name__)
+        return None
+    stats.record(endpoint, time.perf_counter() - start, response.status_code)
+    return response
+
+
+async def _download(client: httpx.AsyncClient, url: str) -> httpx.Response:
+    # Read the whole body like a player would, without keeping it
+    async with client.stream('GET', url) as response:
+        async for _ in response.aiter_bytes():
+            pass
+        return response
+
+
+def _json_body(response: httpx.Response) -> dict | None:
+    """The JSON object in the body, None for anything else (e.g. a proxy's HTML error page)."""
+    try:
+        body = response.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+async def run_flow(client: httpx.AsyncClient, stats: Stats, prompt: dict, poll_interval_s: float, poll_timeout_s: float):
+    flow_start = time.perf_counter()
+    response = await _timed(stats, 'POST /generate', client.post('/generate', json=prompt))
+    if response is None or response.status_code != 200:
+        stats.flows['generate_failed'] += 1
+        return
+    body = _json_body(response)
+    if body is None or 'id' not in body:
+        stats.flows['bad_response'] += 1
+        return
+    song_id = body['id']
+
+    deadline = time.perf_counter() + poll_timeout_s
+    while True:
+        response = await _timed(stats, 'GET /song/{id}', client.get(f'/song/{song_id}'))
+        if response is not None and response.status_code == 200:
+            body = _json_body(response)
+            if body is None:
+                stats.flows['bad_response'] += 1
+                return
+            status = body.get('status')
+        else:
+            status = None
+        if status == 'complete':
+            break
+        if status == 'failed' or time.perf_counter() > deadline:
+            stats.flows['generation_failed' if status == 'failed' else 'timed_out'] += 1
+            return
+        await asyncio.sleep(poll_interval_s)
+
+    response = await _timed(stats, 'GET /song/mp3/{id}', _download(client, f'/song/mp3/{song_id}'))
+    if response is None or response.status_code != 200:
+        stats.flows['download_failed'] += 1
+        return
+    stats.record('flow', time.perf_counter() - flow_start, 'ok')
+    stats.flows['ok'] += 1
+
+
+async def _virtual_user(client: httpx.AsyncClient, stats: Stats, deadline: float, args: argparse.Namespace, prompt: dict):
+    while time.perf_counter() < deadline:
+        await run_flow(client, stats, prompt, args.poll_interval, args.poll_timeout)
+
+
+async def _monitor_lag(stats: Stats, interval_s: float = 0.1):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval_s)
+        stats.client_lag.append(max(0.0, time.perf_counter() - start - interval_s))
+
+
+def parse_histogram(metrics_text: str, name: str) -> dict[str, float]:
+    """Cumulative bucket counts by le, plus _sum and _count, of an unlabelled histogram."""
+    values = {}
+    for line in metrics_text.splitlines():
+        if line.startswith(f'{name}_bucket{{le="'):
+            le = line[len(name) + 12:line.index('"}')]
+            values[le] = float(line.rsplit(' ', 1)[1])
+        elif line.startswith(f'{name}_sum ') or line.startswith(f'{name}_count '):
+            key, value = line.split(' ')
+            values[key[len(name):]] = float(value)
+    return values
+
+
+def histogram_quantile(before: dict[str, float], after: dict[str, float], q: float) -> float | None:
+    """Upper bound of the bucket holding quantile q of the observations made between two scrapes."""
+    buckets = sorted(((float(le), after[le] - before.get(le, 0.0)) for le in after if not le.startswith('_')))
+    total = buckets[-1][1] if buckets else 0
+    if total <= 0:
+        return None
+    return next(le for le, count in buckets if count >= q * total)
+
+
+async def _scrape(client: httpx.AsyncClient) -> dict[str, float]:
+    try:
+        response = await client.get('/metrics')
+        return parse_histogram(response.text, SERVER_LAG_METRIC) if response.status_code == 200 else {}
+    except httpx.HTTPError:
+        return {}
+
+
+def _ms(seconds: float | None) -> str:
+    return '-' if seconds is None else f'{seconds * 1000:.1f}'
+
+
+def build_report(stats: Stats, elapsed_s: float, lag_before: dict, lag_after: dict) -> dict:
+    endpoints = {}
+    for endpoint, latencies in stats.latencies.items():
+        endpoints[endpoint] = {
+            'count': len(latencies),
+            'per_s': len(latencies) / elapsed_s,
+            'p50_s': percentile(latencies, 50),
+            'p95_s': percentile(latencies, 95),
+            'p99_s': percentile(latencies, 99),
+            'max_s': max(latencies),
+            'statuses': {str(k): v for k, v in stats.statuses[endpoint].items()},
+        }
+    server_lag = None
+    if lag_after:
+        count = lag_after.get('_count', 0) - lag_before.get('_count', 0)
+        server_lag = {
+            'samples': count,
+            'mean_s': (lag_after.get('_sum', 0) - lag_before.get('_sum', 0)) / count if count else None,
+            'p50_le_s': histogram_quantile(lag_before, lag_after, 0.5),
+            'p99_le_s': histogram_quantile(lag_before, lag_after, 0.99),
+        }
+    return {
+        'elapsed_s': elapsed_s,
+        'flows': dict(stats.flows),
+        'flows_per_s': stats.flows['ok'] / elapsed_s,
+        'endpoints': endpoints,
+        'client_lag': {
+            'p50_s': percentile(stats.client_lag, 50),
+            'p99_s': percentile(stats.client_lag, 99),
+            'max_s': max(stats.client_lag),
+        } if stats.client_lag else None,
+        'server_lag': server_lag,
+    }
+
+
+def print_report(report: dict):
+    print(f'Elapsed {report["elapsed_s"]:.1f}s, flows {report["flows"]}, {report["flows_per_s"]:.2f} completed flows/s')
+    print(f'{"endpoint":22} {"count":>7} {"req/s":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"max ms":>9}  statuses')
+    for endpoint, e in report['endpoints'].items():
+        print(
+            f'{endpoint:22} {e["count"]:7d} {e["per_s"]:7.2f} {_ms(e["p50_s"]):>9} {_ms(e["p95_s"]):>9} '
+            f'{_ms(e["p99_s"]):>9} {_ms(e["max_s"]):>9}  {e["statuses"]}'
+        )
+    if report['client_lag']:
+        lag = report['client_lag']
+        print(f'Load generator event-loop lag: p50 {_ms(lag["p50_s"])} ms, p99 {_ms(lag["p99_s"])} ms, max {_ms(lag["max_s"])} ms')
+    if report['server_lag']:
+        lag = report['server_lag']
+        print(
+            f'Server event-loop lag ({lag["samples"]:.0f} samples): mean {_ms(lag["mean_s"])} ms, '
+            f'p50 <= {_ms(lag["p50_le_s"])} ms, p99 <= {_ms(lag["p99_le_s"])} ms'
+        )
+    else:
+        print('Server event-loop lag: /metrics not available')
+
+
+async def run(args: argparse.Namespace) -> dict:
+    prompt = DEFAULT_PROMPT
+    if args.prompt:
+        with open(args.prompt) as f:
+            prompt = json.load(f)
+    stats = Stats()
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        lag_before = await _scrape(client)
+        monitor = asyncio.create_task(_monitor_lag(stats))
+        start = time.perf_counter()
+        deadline = start + args.duration
+        await asyncio.gather(*(_virtual_user(client, stats, deadline, args, prompt) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+        monitor.cancel()
+        lag_after = await _scrape(client)
+    return build_report(stats, elapsed, lag_before, lag_after)
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:35789')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of virtual users running flows in parallel')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to start new flows for, running flows are finished')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--poll-timeout', type=float, default=120.0)
+    parser.add_argument('--timeout', type=float, default=120.0, help='Per-request timeout in seconds')
+    parser.add_argument('--prompt', default=None, help='JSON file with the /generate request body')
+    parser.add_argument('--json', dest='json_path', default=None, help='Also write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if report['flows'].get('ok') else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,38 @@
+"""
+Delete the least recently used renders and stems until the render cache fits a size.
+
+Usage (from the repository root, with the server's RENDER_CACHE_DIR):
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.prune_render_cache --max-mb 2048
+    PYTHONPATH=promptbeatai python -m promptbeatai.tools.prune_render_cache --max-mb 2048 --dry-run
+
+A song's master, encoded variants and peaks are deleted together, stems one
+by one. Cache hits refresh an entry's modification time, that is what "least
+recently used" goes by. The server prunes on its own with RENDER_CACHE_MAX_MB.
+"""
+import argparse
+import sys
+
+from promptbeatai.app.render import cache
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max-mb', type=float, required=True, help='Size the cache is pruned down to')
+    parser.add_argument('--cache-dir', default=cache.RENDER_CACHE_DIR)
+    parser.add_argument('--dry-run', action='store_true', help='Only report the cache size')
+    args = parser.parse_args(argv)
+
+    cache.RENDER_CACHE_DIR = args.cache_dir
+    entries = cache.cache_entries()
+    total = sum(size for _, size, _, _ in entries)
+    songs = sum(1 for _, _, kind, _ in entries if kind == 'song')
+    print(f'{args.cache_dir}: {total / 2**20:.1f} MB in {songs} songs and {len(entries) - songs} stems')
+    if args.dry_run:
+        return 0
+    deleted, freed = cache.prune_render_cache(int(args.max_mb * 2**20))
+    print(f'Deleted {deleted} entries, {freed / 2**20:.1f} MB')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())